@@ -8,6 +8,7 @@ export const useWsStore = defineStore("wsData", {
     userId: null,
     roomId: null,
     messagesPlayer: [],
+    chunks: {},
   }),
   getters: {},
   actions: {
@@ -48,6 +49,7 @@ export const useWsStore = defineStore("wsData", {
           room: this.roomId,
           action: "joined",
           user: userId,
+          chunks: true,
         });
         this.socket.onmessage = this.onSocketMessage;
         this.socket.onclose = (e) => {
@@ -74,6 +76,17 @@ export const useWsStore = defineStore("wsData", {
     onSocketMessage(event) {
       let data = JSON.parse(event.data);
       // console.log("Rec1a", data)
+      if (data.action == "chunk") {
+        // large messages come in chunks: add the message once all are here
+        let parts = this.chunks[data.chunk_id] || [];
+        parts[data.index] = data.data;
+        this.chunks[data.chunk_id] = parts;
+        if (parts.filter((part) => part !== undefined).length < data.total) {
+          return
+        }
+        delete this.chunks[data.chunk_id];
+        data = JSON.parse(parts.join(""));
+      }
       this.add(data)
     },
     sendWSMessage(data) {
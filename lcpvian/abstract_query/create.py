@@ -7,6 +7,9 @@ from .results import ResultsMaker
 from .typed import QueryJSON
 from .utils import Config, escape_single_quotes
 
+# Stands for the suffix (digits or "rest") of the batch in SQL templates
+BATCH_PLACEHOLDER = "9081726354"
+
 BASE = """
 {query}
 {results}
@@ -30,16 +33,26 @@ def json_to_sql(
     batch: str = "token_rest",
     config: QueryJSON = {},
     lang: str | None = None,
+    pretty: bool = True,
+    count_only: bool = False,
+    limit: int | None = None,
+    keyset: bool = False,
 ) -> tuple[str, QueryJSON, dict[int, Any]]:
     """
     The only public thing exposed by this module.
 
     It requires a query in JSON format plus configuration stuff
+    Set pretty to False to skip the (slow) reformatting of the SQL
+    Set count_only to only count the lines of the plain result sets
+    Set limit to only return the first lines of each plain result set
+    Set keyset to only return the lines after the bound :after_rstype and :after_line
     """
     query_json = cast(QueryJSON, escape_single_quotes(query_json))
     language: str | None = lang.lower() if lang else None
     conf: Config = Config(schema, batch, config, language)
-    query_json, result_data = ResultsMaker(query_json, conf).results()
+    query_json, result_data = ResultsMaker(query_json, conf).results(
+        count_only, limit, keyset
+    )
     query_part: str
     seg_label: str
     query_part, seg_label, has_char_range = QueryMaker(
@@ -56,8 +69,34 @@ def json_to_sql(
     }
 
     script = BASE.format(**formatters)
-    script = sqlparse.format(
-        script, reindent=True, keyword_case="upper", use_space_around_operators=False
-    )
+    if pretty:
+        script = sqlparse.format(
+            script,
+            reindent=True,
+            keyword_case="upper",
+            use_space_around_operators=False,
+        )
 
     return script, result_data.meta_json, result_data.post_processes
+
+
+def batch_template(batch: str) -> str:
+    """
+    The name of the batch to compile a template for the batches of the same family
+    (eg. token_en for token_en0, token_en1, token_enrest) or an empty string
+    """
+    if batch.endswith("rest"):
+        return batch[:-4] + BATCH_PLACEHOLDER
+    if batch[-1:].isnumeric():
+        return batch.rstrip("0123456789") + BATCH_PLACEHOLDER
+    return ""
+
+
+def fill_batch_template(template: str, batch: str) -> str:
+    """
+    Turn SQL compiled for batch_template(batch) into the SQL for batch
+    """
+    suffix = (
+        "rest" if batch.endswith("rest") else batch[len(batch.rstrip("0123456789")) :]
+    )
+    return template.replace(BATCH_PLACEHOLDER, suffix)
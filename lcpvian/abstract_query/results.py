@@ -193,9 +193,17 @@ class ResultsMaker:
                     return v
         return None
 
-    def results(self) -> tuple[QueryJSON, QueryData]:
+    def results(
+        self, count_only: bool = False, limit: int | None = None, keyset: bool = False
+    ) -> tuple[QueryJSON, QueryData]:
         """
         Build the results section of the postgres query
+
+        With count_only, each plain result set only yields the number of its lines
+        and the other result sets yield nothing
+        With limit, each plain result set yields at most that many lines
+        With keyset, the plain result sets only yield the lines that come after
+        the line bound to :after_line in the result set bound to :after_rstype
         """
         # strings = [COUNTER]
         strings = []
@@ -283,7 +291,9 @@ class ResultsMaker:
                 )  # list in case of parallel corpus
                 # todo: handle 1+ contexts in case of parallel corpus queries
                 enti = cast(list[str], r.get("entities", []))
-                made, meta = self._kwic(i, varname, context, enti)
+                made, meta = self._kwic(
+                    i, varname, context, enti, limit, not count_only, keyset
+                )
             elif kind == "resultsAnalysis":
                 made, meta, filter_meta = self.stats(i, varname, r)
                 if filter_meta:
@@ -292,6 +302,8 @@ class ResultsMaker:
                 self._add_collocation_selects(r)
                 made, meta = self.collocation(i, varname, r)
 
+            if count_only:
+                made = self._count_only(i, kind, made)
             strings.append(made)
             attribs.append(meta)
 
@@ -300,6 +312,19 @@ class ResultsMaker:
         self.r.needed_results = "\n , ".join(strings)
         return self.query_json, self.r
 
+    def _count_only(self, i: int, kind: str, made: str) -> str:
+        """
+        Replace the CTE of a result set with one that counts its lines
+        (plain results) or that is empty (other results)
+        """
+        if kind != "resultsPlain":
+            return f"res{i} AS (SELECT {i}::int2 AS rstype, jsonb_build_array() WHERE false)"
+        rows = made.replace(f"res{i} AS", f"res{i}_rows AS", 1)
+        return (
+            f"{rows}\n , res{i} AS (SELECT {i}::int2 AS rstype, "
+            f"jsonb_build_array(count(*)) FROM res{i}_rows)"
+        )
+
     def _add_collocation_selects(self, result: dict) -> None:
         """
         For collocation query with space, we add the 'space' obj to entities
@@ -451,12 +476,15 @@ class ResultsMaker:
 
         functions = cast(list[str], result["functions"])
         filt = cast(JSONObject, result.get("filter", {}))
+        # only keep the `limit` most frequent rows
+        limit = cast(int | None, result.get("limit"))
         made, meta, filter_meta = self._stat_analysis(
             i,
             varname,
             [a for a in attributes if isinstance(a, dict)],
             functions,
             filt,
+            int(limit) if limit else None,
         )
         return made, meta, filter_meta
 
@@ -466,9 +494,15 @@ class ResultsMaker:
         label: str,
         context: str,
         ents: list[str],
+        limit: int | None = None,
+        ordered: bool = True,
+        keyset: bool = False,
     ) -> tuple[str, ResultMetadata]:
         """
         Produce a KWIC query and its JSON metadata
+
+        The lines are sorted by their content (segment ID, then token IDs)
+        so that each batch always yields them in the same order
         """
         entout: list[str] = []
         select_extra = ""
@@ -638,13 +672,26 @@ WHERE {entity}.char_range && contained_token.char_range
                 {"name": "disjunction_matches", "type": "set", "multiple": True}
             )
 
+        line = f"jsonb_build_array({context}, jsonb_build_array({ents_form}) {select_extra})"
+        tail: list[str] = []
+        if keyset:
+            tail.append(
+                f"WHERE {i} > :after_rstype OR ({i} = :after_rstype "
+                f"AND {line} > CAST(:after_line AS jsonb))"
+            )
+        if ordered:
+            tail.append("ORDER BY 2")
+        if limit is not None:
+            tail.append(f"LIMIT {int(limit)}")
+        tail_clauses = "".join(f"\n            {t}" for t in tail)
+
         out = f"""
             res{i} AS ( SELECT DISTINCT
             {i}::int2 AS rstype,
-            jsonb_build_array({context}, jsonb_build_array({ents_form}) {select_extra})
+            {line}
         FROM
             match_list
-            {doc_join}
+            {doc_join}{tail_clauses}
         )
         """
         metadata: ResultMetadata = {
@@ -757,9 +804,14 @@ WHERE {entity}.char_range && contained_token.char_range
         attributes: list[dict[str, Any]],
         functions: list[str],
         filt: JSONObject,
+        limit: int | None = None,
     ) -> tuple[str, ResultMetadata, list[dict[str, Any]]]:
         """
         Produce a frequency table and its JSON metadata
+
+        With a limit, each batch only returns its `limit` rows with the highest
+        value of the first function (the rows are merged across batches
+        by QueryInfo, see convert.Aggregation.top)
         """
         count_entities: dict[str, str] = {
             x["entity"]: "" for x in attributes if "entity" in x
@@ -886,6 +938,7 @@ WHERE {entity}.char_range && contained_token.char_range
             )
         nodes = " , ".join(p for p, _ in parsed_attributes)
         wheres, filter_meta = self._process_filters(filt)
+        top = f" ORDER BY {functions[0]} DESC, {nodes} LIMIT {limit}" if limit else ""
         out = f"""
             res{i} AS ( SELECT
                 {i}::int2 AS rstype,
@@ -898,7 +951,7 @@ WHERE {entity}.char_range && contained_token.char_range
                     FROM
                         match_list
                     GROUP BY {nodes}{', '+','.join(jgroups) if jgroups else ''}
-                ) x {wheres} )
+                ) x {wheres}{top} )
         """
         attribs: Attribs = []
         # for att in attributes:
@@ -921,6 +974,8 @@ WHERE {entity}.char_range && contained_token.char_range
             "name": label,
             "type": "analysis",
         }
+        if limit:
+            meta["limit"] = limit
         return out, meta, filter_meta
 
     def _space_item(self, item: str) -> tuple[set[str], Joins]:
@@ -38,6 +38,7 @@ from .utils import (
     handle_timeout,
     load_env,
     refresh_config,
+    register_socket,
 )
 
 load_env()
@@ -60,7 +61,7 @@ from .project import project_users_invite, project_users
 from .project import project_users_invitation_remove, project_user_update
 from .query import post_query
 from .query_service import QueryService
-from .sock import listen_to_redis, sock, ws_cleanup
+from .sock import listen_to_redis, listen_to_stream, sock, ws_cleanup
 from .store import fetch_queries, store_query, delete_query
 from .typed import Endpoint, Task, Websockets
 from .upload import make_schema, upload
@@ -117,6 +118,11 @@ async def on_shutdown(app: web.Application) -> None:
     """
     Close websocket connections on app shutdown
     """
+    for room, conns in app["websockets"].items():
+        try:
+            register_socket(app["redis"], room, -len(conns))
+        except Exception:
+            pass
     try:
         await app["aredis"].quit()
     except Exception:
@@ -145,7 +151,16 @@ async def start_background_tasks(app: web.Application) -> None:
             continue
         listener = f"{instance}_listener"
         lapp.addkey(listener, Task, asyncio.create_task(listen_to_redis(app, instance)))
-    lapp.addkey("ws_cleanup", Task, asyncio.create_task(ws_cleanup(app["websockets"])))
+        lapp.addkey(
+            f"{instance}_stream_listener",
+            Task,
+            asyncio.create_task(listen_to_stream(app, instance)),
+        )
+    lapp.addkey(
+        "ws_cleanup",
+        Task,
+        asyncio.create_task(ws_cleanup(app["websockets"], app["redis"])),
+    )
 
 
 async def cleanup_background_tasks(app: web.Application) -> None:
@@ -154,6 +169,11 @@ async def cleanup_background_tasks(app: web.Application) -> None:
     """
     app["redis_listener"].cancel()
     await app["redis_listener"]
+    app["redis_stream_listener"].cancel()
+    try:
+        await app["redis_stream_listener"]
+    except asyncio.CancelledError:
+        pass
     app["ws_cleanup"].cancel()
     await app["ws_cleanup"]
 
@@ -237,7 +257,7 @@ async def create_app(test: bool = False) -> web.Application:
         ("/download_export", "GET", download_export),
         ("/fcs-endpoint", "GET", get_fcs),
         ("/fetch", "POST", fetch_queries),
-        ("/get_message/{fn}", "GET", get_message),
+        ("/get_message/{uuid}", "GET", get_message),
         ("/project", "POST", project_create),
         ("/project/{project}", "POST", project_update),
         ("/project/{project}/api/create", "POST", project_api_create),
@@ -345,6 +365,8 @@ async def create_app(test: bool = False) -> web.Application:
     if not test:
         await qs.get_config()
     app.addkey("canceled", deque[str], deque(maxlen=99999))
+    # set when a request that this process waits for is over (see Request.wait_until_done)
+    app.addkey("query_events", dict[str, asyncio.Event], {})
 
     if test:
         return app
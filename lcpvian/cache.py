@@ -0,0 +1,124 @@
+"""
+cache.py: (de)serialization of the query results cached in redis
+
+The batch results and the segment+meta results are written once by a worker
+and read again for every request, segment hash and export payload,
+so they are stored in a compact binary format rather than as JSON text.
+
+The format is set with RESULTS_CACHE_FORMAT (msgpack by default, or json)
+and the entries can be compressed with zstandard by setting
+RESULTS_CACHE_COMPRESSION=zstd (requires the optional zstandard package).
+Every entry starts with a one-byte header describing how it was written,
+so entries written with a different setting (or plain JSON entries)
+can still be read.
+"""
+
+import json
+import os
+
+from collections.abc import Callable
+from typing import Any
+
+import msgpack
+
+zstandard: Any
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from .utils import CustomEncoder
+
+RESULTS_CACHE_FORMAT = os.getenv("RESULTS_CACHE_FORMAT", "msgpack").strip().lower()
+RESULTS_CACHE_COMPRESSION = (
+    os.getenv("RESULTS_CACHE_COMPRESSION", "").strip().lower() or None
+)
+RESULTS_CACHE_ZSTD_LEVEL = int(os.getenv("RESULTS_CACHE_ZSTD_LEVEL", 3))
+
+COMPRESSED = 0x80
+
+_encoder = CustomEncoder()
+
+
+def _msgpack_default(obj: Any) -> Any:
+    """
+    Same conversions as for JSON (numpy types, dates, ranges...)
+    """
+    converted = _encoder.default(obj)
+    if converted is obj:
+        return str(obj)
+    return converted
+
+
+def _json_dumps(data: Any) -> bytes:
+    return json.dumps(data, cls=CustomEncoder).encode("utf-8")
+
+
+def _msgpack_dumps(data: Any) -> bytes:
+    return msgpack.packb(data, default=_msgpack_default, use_bin_type=True)
+
+
+def _msgpack_loads(raw: bytes) -> Any:
+    return msgpack.unpackb(raw, raw=False, strict_map_key=False)
+
+
+# name -> (header code, dumps, loads); codes must stay below COMPRESSED
+CACHE_FORMATS: dict[str, tuple[int, Callable[[Any], bytes], Callable[[bytes], Any]]] = {
+    "msgpack": (0x01, _msgpack_dumps, _msgpack_loads),
+    "json": (0x02, _json_dumps, json.loads),
+}
+
+
+def _compressor() -> Any:
+    if RESULTS_CACHE_COMPRESSION != "zstd":
+        return None
+    if zstandard is None:
+        print("Warning: zstandard is not installed, cache entries are not compressed")
+        return None
+    return zstandard.ZstdCompressor(level=RESULTS_CACHE_ZSTD_LEVEL)
+
+
+_COMPRESSOR = _compressor()
+
+
+def dumps(data: Any, fmt: str | None = None, compress: bool | None = None) -> bytes:
+    """
+    Serialize data for the results cache (using the configured format by default)
+    """
+    fmt = fmt or RESULTS_CACHE_FORMAT
+    code, dump, _load = CACHE_FORMATS.get(fmt, CACHE_FORMATS["json"])
+    raw = dump(data)
+    compressor = _COMPRESSOR
+    if compress is not None:
+        compressor = (
+            zstandard.ZstdCompressor(level=RESULTS_CACHE_ZSTD_LEVEL)
+            if compress and zstandard
+            else None
+        )
+    if compressor:
+        return bytes([code | COMPRESSED]) + compressor.compress(raw)
+    if fmt == "json":
+        # plain JSON is stored as is, as it used to be
+        return raw
+    return bytes([code]) + raw
+
+
+def loads(raw: bytes | str) -> Any:
+    """
+    Deserialize an entry of the results cache, whatever format it was written in
+    """
+    if isinstance(raw, str):
+        return json.loads(raw)
+    header = raw[0] if raw else 0
+    code = header & ~COMPRESSED
+    load = next((ld for c, _, ld in CACHE_FORMATS.values() if c == code), None)
+    if load is None:
+        # no header: plain JSON
+        return json.loads(raw)
+    body = raw[1:]
+    if header & COMPRESSED:
+        if zstandard is None:
+            raise RuntimeError("zstandard is needed to read this cache entry")
+        body = zstandard.ZstdDecompressor().decompress(body)
+    return load(body)
@@ -5,11 +5,12 @@ The role of these functions is to work together to create the Results
 object, which holds kwic, collocation and frequency results, plus query
 metadata and prepared_segment objects.
 
-If a query has res1=kwic, res2=collocation, res3=freq, two objects would
-be created. First, the non-kwic data would be made by _aggregate_results
-via callbacks._query:
+If a query has res1=kwic, res2=collocation, res3=freq, the non-kwic data
+is aggregated batch after batch: _merge_batch adds the rows of a batch to an
+Aggregation per result set, which QueryInfo.run_aggregate then adds to the
+stats stored in redis hashes and reads back as
 
-{0: query_metadata, 2: collocation_data, 3: freq_data}
+{2: collocation_data, 3: freq_data}
 
 and after that, _format_kwics via callbacks._sentences would produce:
 
@@ -17,8 +18,9 @@ and after that, _format_kwics via callbacks._sentences would produce:
 
 the dicts could therefore be combined without losing any info if need be
 
-Once non-kwic results are created, they need to be filtered with _apply_filters
-so that certain transformations not possible to do in SQL can be applied.
+Once non-kwic results are created, they need to be filtered (see _make_filters
+and Aggregation.select) so that certain transformations not possible to do in
+SQL can be applied.
 Most commonly, this is when there is a "frequency > 10" type filter: we cannot
 apply it in postgres because a given match could have 5 matches in one batch,
 and 5 in another...
@@ -28,8 +30,11 @@ is inserted as the -1 key in the Results object. FE does the job of formatting
 the kwic line from matching token ids plus the relevant prepared_segment.
 """
 
+import json
 import operator
 
+import numpy as np
+
 from collections import defaultdict
 from collections.abc import Sequence
 from typing import Any, cast
@@ -42,7 +47,6 @@ from .typed import (
     QueryMeta,
     RawSent,
     ResultSents,
-    ResultsValue,
     Results,
     Sentence,
 )
@@ -60,59 +64,188 @@ OPS = {
 }
 
 
-def _prepare_existing(
-    res: Results, kwics: set[int], colls: set[int], result_set: list
-) -> dict[int, dict[str, tuple[int, float]]]:
-    out: dict[int, Any] = {}
-    for k, v in res.items():
-        k = int(k)
-        if k < 1 or k in kwics:
-            continue
-        if k not in out:
-            out[k] = {}
-        v = cast(list, v)
-        if k in colls:
-            for text, total, e in v:
-                if text not in out[k]:
-                    out[k][text] = (total, e)
-                else:
-                    print("Todo: if this happens, we need to combine scores")
-                    pretotal, pree = out[k][text]
-                    out[k][text] = (total + pretotal, (e + pree / 2))
-        else:
-            attrs = result_set[k - 1].get("attributes", [])
-            for r in v:
-                body, totals_this_batch = _body_totals(r, attrs)
-                # body = r[:-1]
-                tk = tuple(body)
-                if tk not in out[k]:
-                    out[k][tk] = [0 for _ in totals_this_batch]
-                out[k][tk] = [
-                    out[k][tk][n] + totals_this_batch[n]  # type: ignore
-                    for n, _ in enumerate(totals_this_batch)
-                ]
-    return out
+class Aggregation:
+    """
+    The aggregated rows of one frequency or collocation result set, kept in
+    key -> counts form between batches: the keys (the non-aggregate values of
+    a frequency row, the text of a collocation) in order of appearance,
+    an index key -> position, and the aggregates as a 2D array
+    (plus the E values of a collocation)
+
+    The rows of a batch are looked up in the index once and their counts
+    are added with a single numpy operation
+    """
 
+    def __init__(self, collocation: bool = False, width: int = 1) -> None:
+        self.collocation = collocation
+        self.keys: list[Any] = []
+        self.index: dict[Any, int] = {}
+        self.counts: np.ndarray = np.zeros((0, width), dtype=np.int64)
+        self.e: np.ndarray = np.zeros(0, dtype=np.float64)
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def _positions(self, keys: list[Any]) -> np.ndarray:
+        """
+        Positions of the keys in the index, adding the new ones
+        """
+        index = self.index
+        positions = np.empty(len(keys), dtype=np.int64)
+        for n, key in enumerate(keys):
+            pos = index.get(key)
+            if pos is None:
+                pos = index[key] = len(self.keys)
+                self.keys.append(key)
+            positions[n] = pos
+        return positions
+
+    def _grow(self, width: int, dtype: Any) -> None:
+        n_new = len(self.keys) - self.counts.shape[0]
+        dtype = np.result_type(self.counts.dtype, dtype)
+        if self.counts.shape[1] != width and not self.counts.shape[0]:
+            self.counts = np.zeros((0, width), dtype=dtype)
+        pad = np.zeros((n_new, self.counts.shape[1]), dtype=dtype)
+        self.counts = np.concatenate([self.counts.astype(dtype, copy=False), pad])
+        if self.collocation:
+            self.e = np.concatenate([self.e, np.zeros(n_new, dtype=np.float64)])
+
+    def merge(
+        self,
+        keys: list[Any],
+        counts: list[list[int]],
+        e: list[float] | None = None,
+        e_weights: tuple[float, float] | None = None,
+    ) -> None:
+        """
+        Add the counts of the rows of a batch. The E values of a collocation
+        are averaged over the batches with e_weights (see _e_weights)
+        """
+        if not keys:
+            return
+        batch_counts = np.asarray(counts)
+        positions = self._positions(keys)
+        self._grow(batch_counts.shape[1], batch_counts.dtype)
+        np.add.at(self.counts, positions, batch_counts)
+        if e is None:
+            return
+        batch_e = np.asarray(e, dtype=np.float64)
+        if e_weights is None:
+            self.e[positions] = batch_e
+            return
+        current_size, done_size = e_weights
+        self.e[positions] = (batch_e * current_size + self.e[positions] * done_size) / (
+            current_size + done_size
+        )
 
-def _unfold(exist: dict, kwics: set[int], colls: set[int]) -> Results:
-    out: Results = {}
-    for k, v in exist.items():
-        k = int(k)
-        if k < 1:
-            continue
-        if k in kwics:
-            continue
-        if k not in out:
-            out[k] = []
-        if k in colls:
-            for text, (a, b) in v.items():
-                ok = cast(list, out[k])
-                ok.append([text, a, b])
-        else:
-            for body, scores in v.items():
-                ok = cast(list, out[k])
-                ok.append(list(body) + scores)
-    return out
+    def rows(self) -> list[list]:
+        """
+        The aggregated rows, as sent to the frontend
+        """
+        counts = self.counts.tolist()
+        if self.collocation:
+            return [
+                [text, total[0], e]
+                for text, total, e in zip(self.keys, counts, self.e.tolist())
+            ]
+        return [[*body, *totals] for body, totals in zip(self.keys, counts)]
+
+    def mask(self, filters: list[tuple[str, str, str | int | float]]) -> np.ndarray:
+        """
+        Which rows pass the filters on their last value
+        """
+        column = self.e if self.collocation else self.counts[:, -1]
+        mask = np.ones(len(self), dtype=bool)
+        for _, op, num in filters:
+            if isinstance(num, str):
+                passed = [OPS[op](v, num) for v in column.tolist()]
+                mask &= np.array(passed, dtype=bool)
+            else:
+                mask &= OPS[op](column, num)
+        return mask
+
+    def select(
+        self, rows: list[list], filters: list[tuple[str, str, str | int | float]]
+    ) -> list[list]:
+        """
+        The rows (as returned by rows()) that pass the filters
+        """
+        if not filters:
+            return rows
+        return [rows[i] for i in np.flatnonzero(self.mask(filters)).tolist()]
+
+    def top(
+        self, k: int, filters: list[tuple[str, str, str | int | float]] = []
+    ) -> np.ndarray:
+        """
+        Positions of the k rows with the highest first aggregate (by order
+        of appearance among equals) that pass the filters
+        """
+        passed = np.flatnonzero(self.mask(filters)) if filters else np.arange(len(self))
+        order = np.argsort(-self.counts[passed, 0], kind="stable")
+        return passed[order[:k]]
+
+    def prune(self, capacity: int) -> int:
+        """
+        Only keep the `capacity` rows with the highest first aggregate and return
+        the highest count evicted: a row seen again later can be undercounted
+        by up to that much (as in the Space-Saving algorithm)
+        """
+        if len(self) <= capacity:
+            return 0
+        kept = np.sort(self.top(capacity))
+        evicted = np.ones(len(self), dtype=bool)
+        evicted[kept] = False
+        highest = int(self.counts[evicted, 0].max())
+        self.keys = [self.keys[i] for i in kept.tolist()]
+        self.index = {k: n for n, k in enumerate(self.keys)}
+        self.counts = self.counts[kept]
+        if self.collocation:
+            self.e = self.e[kept]
+        return highest
+
+    @classmethod
+    def from_columns(
+        cls,
+        keys: list[Any],
+        counts: np.ndarray,
+        e: np.ndarray | None = None,
+    ) -> "Aggregation":
+        """
+        Build an aggregation from its keys (unique) and their aggregates
+        """
+        agg = cls(e is not None, counts.shape[1])
+        agg.keys = list(keys)
+        agg.index = {k: n for n, k in enumerate(agg.keys)}
+        agg.counts = counts
+        if e is not None:
+            agg.e = e
+        return agg
+
+
+AggregationState = dict[int, Aggregation]
+
+
+def _split_rows(
+    rows: list[list], attrs: list[dict], collocation: bool
+) -> tuple[list[Any], list[list[int]], list[float] | None]:
+    """
+    Keys, counts (and E values) of rows of a frequency or collocation result set
+    """
+    if collocation:
+        return (
+            [text for text, _, _ in rows],
+            [[total] for _, total, _ in rows],
+            [e for _, _, e in rows],
+        )
+    aggregate = [a.get("type") == "aggregate" for a in attrs]
+    n_body = aggregate.count(False)
+    keys: list[Any] = []
+    counts: list[list[int]] = []
+    for row in rows:
+        keys.append(tuple([str(x) for x, agg in zip(row, aggregate) if not agg]))
+        counts.append(row[n_body - len(row) :] if n_body < len(row) else [])
+    return keys, counts, None
 
 
 def _body_totals(rest: list, attrs: list[dict]) -> tuple[list, list[int]]:
@@ -125,96 +258,114 @@ def _body_totals(rest: list, attrs: list[dict]) -> tuple[list, list[int]]:
     return body, totals_this_batch
 
 
-def _aggregate_results(
+def _merge_batch(
+    state: AggregationState,
     result: list,
-    existing: Results,
     meta_json: QueryMeta,
-    post_processes: dict[int, Any],
     current: Any,
     done: list[Batch] | None = None,
-) -> tuple[Results, Results, int, bool, bool]:
+) -> int:
     """
-    Combine non-kwic results for storing and for sending to frontend
+    Add the stats rows of the result of a batch to the aggregation state
+    and return the number of results reported by the batch
     """
-    results_to_send: Results = {0: meta_json}
     n_results = 0
     rs = meta_json["result_sets"]
     kwics = set([i for i, r in enumerate(rs, start=1) if r.get("type") == "plain"])
-    freqs = set([i for i, r in enumerate(rs, start=1) if r.get("type") == "analysis"])
     colls = set(
         [i for i, r in enumerate(rs, start=1) if r.get("type") == "collocation"]
     )
-    counts: defaultdict[int, int | list[int]] = defaultdict(int)
-
-    minus_one: ResultsValue = existing.get(-1, cast(ResultsValue, {}))
-    zero: ResultsValue = existing.get(0, cast(ResultsValue, {}))
-
-    precalcs: dict = _prepare_existing(existing, kwics, colls, rs)
-
+    batch_rows: defaultdict[int, list] = defaultdict(list)
     for line in result:
         key = int(line[0])
-        rest: list[Any] = line[1]
         if not key and not n_results:
-            n_results = rest[0]
+            n_results = line[1][0]
             continue
-        if key in kwics:
-            counts[key] += 1  # type: ignore
+        if key < 1 or key in kwics:
             continue
-        if key not in existing:
-            existing[key] = []
-        if key not in precalcs:
-            precalcs[key] = {}
-        if key in colls:
-            text, total_this_batch, e = rest
-            preexist, preexist_e = precalcs[key].get(text, (0, 0))
-            combined = preexist + total_this_batch
-            counts[key] = combined
-            combined_e = _combine_e(e, preexist_e, current, done)
-            precalcs[key][text] = (combined, combined_e)
-            continue
-        # frequency table:
+        batch_rows[key].append(line[1])
+
+    e_weights = _e_weights(current, done) if colls & set(batch_rows) else None
+    for key, rows in batch_rows.items():
         attrs: list[dict] = cast(dict, rs[key - 1]).get("attributes", [])
-        # body = cast(list, [str(x) for x in rest[:-1]])
-        body, totals_this_batch = _body_totals(rest, attrs)
-        # need_update = body in precalcs[key]
-        preexist = precalcs[key].get(
-            tuple(body), [0 for n, _ in enumerate(totals_this_batch)]
-        )
-        combined = [
-            preexist[n] + totals_this_batch[n] for n, _ in enumerate(totals_this_batch)
-        ]
-        precalcs[key][tuple(body)] = combined
-        counts[key] = combined
+        collocation = key in colls
+        keys, counts, e = _split_rows(rows, attrs, collocation)
+        agg = state.setdefault(key, Aggregation(collocation))
+        agg.merge(keys, counts, e, e_weights)
+    return n_results
 
-    existing = _unfold(precalcs, kwics, colls)
-    existing[-1] = minus_one
-    existing[0] = zero
 
-    results_to_send = _apply_filters(existing, post_processes)
+def _e_weights(
+    current: Batch | None, done: list[Batch] | None
+) -> tuple[float, float] | None:
+    """
+    Weights of the E value of a collocation in the current batch and in the
+    batches done before it (None for the first batch: its E values are kept)
+    """
+    assert current is not None and done is not None
+    done_minus_current = [x for x in done if x[0] != current[0]]
+    if not done_minus_current:
+        return None
+    current_size: int = current[-1]
+    done_size = sum(d[-1] for d in done_minus_current)
+    return (current_size, done_size)
 
-    show_total = bool(kwics) or (not kwics and len(freqs) == 1)
 
-    return existing, results_to_send, n_results, not bool(kwics), show_total
+def _stats_row_id(row: list, attrs: list[dict], collocation: bool) -> Any:
+    """
+    What identifies a row of a stats result set across batches:
+    the text of a collocation, the non-aggregate values of a frequency row
+    """
+    if collocation:
+        return row[0]
+    body, _ = _body_totals(row, attrs)
+    return tuple(body)
 
 
-def _combine_e(
-    this_time_e: int | float,
-    e_so_far: int | float,
-    current: Batch | None,
-    done: list[Batch] | None,
-):
+def _encode_stats_key(key: Any) -> str:
     """
-    Get the combined E value for collocation
+    A key of an aggregation as a field of the redis hashes of the stats
     """
-    assert current is not None and done is not None
-    done_minus_current = [x for x in done if x != current]
-    if not done_minus_current:
-        return this_time_e
-    current_size: int = current[-1]
-    done_size = sum(d[-1] for d in done_minus_current if d != current)
-    prop = this_time_e * current_size
-    done_prop = e_so_far * done_size
-    return (prop + done_prop) / (current_size + done_size)
+    return json.dumps(list(key) if isinstance(key, tuple) else key)
+
+
+def _decode_stats_key(field: bytes | str) -> Any:
+    key = json.loads(field)
+    return tuple(key) if isinstance(key, list) else key
+
+
+def _merge_stats_deltas(
+    deltas: list[dict[str, dict[str, list]]], meta_json: QueryMeta
+) -> tuple[dict[str, list], dict[str, list]]:
+    """
+    Combine consecutive deltas (see QueryInfo._store_aggregation) into one:
+    the latest version of the changed rows and the IDs of the removed rows
+    """
+    rs = meta_json["result_sets"]
+    changed: dict[str, dict[Any, list]] = {}
+    removed: dict[str, set] = {}
+    for delta in deltas:
+        for k, ids in delta.get("removed", {}).items():
+            rows = changed.setdefault(k, {})
+            for row_id in ids:
+                row_id = tuple(row_id) if isinstance(row_id, list) else row_id
+                rows.pop(row_id, None)
+                removed.setdefault(k, set()).add(row_id)
+        for k, new_rows in delta.get("changed", {}).items():
+            result_set = cast(dict, rs[int(k) - 1])
+            attrs = result_set.get("attributes", [])
+            collocation = result_set.get("type") == "collocation"
+            rows = changed.setdefault(k, {})
+            for row in new_rows:
+                row_id = _stats_row_id(row, attrs, collocation)
+                removed.get(k, set()).discard(row_id)
+                rows[row_id] = row
+    results = {k: list(rows.values()) for k, rows in changed.items()}
+    gone = {
+        k: [list(i) if isinstance(i, tuple) else i for i in ids]
+        for k, ids in removed.items()
+    }
+    return results, gone
 
 
 def _format_kwics(
@@ -367,13 +518,14 @@ def _limit_kwic_to_max(to_send: Results, current_lines: int, max_kwic: int) -> R
 
 
 def _make_filters(
-    post: dict[int, list[dict[str, Any]]],
+    post: dict[Any, list[dict[str, Any]]],
 ) -> dict[int, list[tuple[str, str, str | int | float]]]:
     """
     Because we iterate over them a lot, turn the filters object into something
-    as performant as possible
+    as performant as possible (keyed by the int number of the result set:
+    the keys of post_processes are strings once stored as JSON)
     """
-    out = {}
+    out: dict[int, list[tuple[str, str, str | int | float]]] = {}
     for idx, filters in post.items():
         fixed: list[tuple[str, str, str | int | float]] = []
         for filt in filters:
@@ -394,54 +546,5 @@ def _make_filters(
                 value = float(value)
             made = cast(tuple[str, str, int | str | float], (entity, operator, value))
             fixed.append(made)
-        out[idx] = fixed
-    return out
-
-
-def _apply_filters(results_so_far: Results, post_processes: dict[int, Any]) -> Results:
-    """
-    Take the unioned results and apply any post process functions
-    """
-    if not post_processes:
-        return results_so_far
-    out: Results = {}
-    post = _make_filters(post_processes)
-    for k, v in results_so_far.items():
-        for key, filters in post.items():
-            if not filters:
-                continue
-            if int(k) < 1:
-                continue
-            if int(k) != int(key):
-                continue
-            for name, op, num in filters:
-                v = _apply_filter(cast(list, v), name, op, num)
-        out[k] = v
+        out[int(idx)] = fixed
     return out
-
-
-def _apply_filter(result: list, name: str, op: str, num: int | str | float) -> list:
-    """
-    Apply a single filter to a group of results, returning only those that match
-    """
-    out: list = []
-    for r in result:
-        total = r[-1]
-        res = OPS[op](total, num)
-        if res and r not in out:
-            out.append(r)
-    return out
-
-
-def _fix_freq(v: list[list]) -> list[list]:
-    """
-    Sum frequency objects and remove duplicate
-    """
-    fixed = []
-    for r in v:
-        body = r[:-1]
-        total = sum(x[-1] for x in v if x[:-1] == body)
-        body.append(total)
-        if body not in fixed:
-            fixed.append(body)
-    return fixed
@@ -99,20 +99,28 @@ async def _check_request_complete(
     app: web.Application,
     request_ids: dict[str, dict],
     requested: int,
+    enough: asyncio.Event,
 ):
-    while 1:
-        await asyncio.sleep(0.5)
-        if not qi.has_request(request):
-            request_ids[request.id]["done"] = True
-            break
-        n_results = sum(
-            len(app["query_buffers"].get(rid, {}).get("1", []))
-            for rid, rprops in request_ids.items()
-            if rprops.get("done")
-        )
-        if n_results >= requested:
-            qi.stop_request(request)
-            break
+    """
+    Wait until the request is over, or stop it as soon as the requests
+    that are over have enough results between them
+    """
+    done = asyncio.create_task(request.wait_until_done(app, qi))
+    stop = asyncio.create_task(enough.wait())
+    await asyncio.wait((done, stop), return_when=asyncio.FIRST_COMPLETED)
+    if not done.done():
+        done.cancel()
+        qi.stop_request(request)
+        return
+    stop.cancel()
+    request_ids[request.id]["done"] = True
+    n_results = sum(
+        len(app["query_buffers"].get(rid, {}).get("1", []))
+        for rid, rprops in request_ids.items()
+        if rprops.get("done")
+    )
+    if n_results >= requested:
+        enough.set()
     return
 
 
@@ -241,6 +249,7 @@ async def search_retrieve(
         app.addkey("query_buffers", dict[str, dict], query_buffers)
 
     request_ids: dict[str, dict] = {}
+    enough = asyncio.Event()
     async with asyncio.TaskGroup() as tg:
         for cid, conf, lg in corpora:
             langs = [lg if "partitions" in conf else "en"]
@@ -266,6 +275,7 @@ async def search_retrieve(
                 },
             )
             query_buffers[req.id] = {}
+            req.done_event(app)  # registered before any response comes in
             request_ids[req.id] = {
                 "cid": cid,
                 "conf": conf,
@@ -274,7 +284,7 @@ async def search_retrieve(
                 "done": False,
             }
             tg.create_task(
-                _check_request_complete(qi, req, app, request_ids, requested)
+                _check_request_complete(qi, req, app, request_ids, requested, enough)
             )
     return _make_search_response(
         query_buffers, request_ids, startRecord=startRecord, requested=requested
@@ -2,8 +2,11 @@ import json
 import logging
 import os
 import shutil
+import time
 import traceback
 
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
 from typing import Any, cast
 
 from sqlalchemy.exc import SQLAlchemyError
@@ -15,7 +18,14 @@ from rq.job import get_current_job, Job
 from .impo import Importer
 from .project import refresh_config
 from .typed import DBQueryParams, JSONObject, MainCorpus, Sentence, UserQuery
-from .utils import _get_sent_ids
+from .utils import _get_sent_ids, TRUES
+
+# log how long the queries take, with an estimate of their planning time
+# (one more round trip per query, see _planning_time)
+QUERY_TIMING = os.getenv("QUERY_TIMING", "false").strip().lower() in TRUES
+
+# pool attribute of the job -> number of connections taken, total and max wait (s)
+POOL_WAITS: dict[str, dict[str, float]] = {}
 
 
 async def _upload_data(
@@ -137,6 +147,49 @@ async def _create_schema(
     return None
 
 
+@asynccontextmanager
+async def _connect(name: str, method: str = "connect") -> AsyncIterator[Any]:
+    """
+    A connection from one of the pools of the worker (see worker.SQLJob),
+    recording how long it took to get it in POOL_WAITS
+    """
+    pool = getattr(get_current_job(), name)
+    start = time.perf_counter()
+    async with getattr(pool, method)() as conn:
+        wait = time.perf_counter() - start
+        waits = POOL_WAITS.setdefault(name, {"taken": 0, "wait": 0.0, "max_wait": 0.0})
+        waits["taken"] += 1
+        waits["wait"] += wait
+        waits["max_wait"] = max(waits["max_wait"], wait)
+        yield conn
+
+
+async def _planning_time(conn: Any, query: str, params: DBQueryParams) -> float:
+    """
+    Estimate how long Postgres took to plan the query, in ms
+
+    EXPLAIN without ANALYZE plans the query again, in one more round trip,
+    but does not run it. The statement that ran may instead have reused
+    a generic plan of the statement cache, and then was not planned at all
+    """
+    res = await conn.execute(text(f"EXPLAIN (SUMMARY, FORMAT JSON) {query}"), params)
+    plan = res.scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return float(plan[0]["Planning Time"])
+
+
+def _print_timing(planning: float, total: float, n_rows: int) -> None:
+    """
+    Log the time a query took (total, in ms) and its planning time estimate
+    """
+    running = max(total - planning, 0.0)
+    print(
+        f"Query took {total:.1f} ms: planned in ~{planning:.1f} ms, "
+        f"ran in ~{running:.1f} ms, {n_rows} rows"
+    )
+
+
 async def _db_query(
     query: str,
     params: DBQueryParams = {},
@@ -175,7 +228,6 @@ async def _db_query(
 
     name = "_upool" if (store or delete or is_import) else ("_wpool" if (config or is_main) else "_pool")
     job = get_current_job()
-    pool = getattr(job, name)
     method = "begin" if (store or delete or is_import) else "connect"
 
     first_job_id = cast(str, kwargs.get("first_job", ""))
@@ -192,8 +244,9 @@ async def _db_query(
     if job and cast(dict, job.kwargs).get("refresh_config", None):
         await refresh_config()
 
-    async with getattr(pool, method)() as conn:
+    async with _connect(name, method) as conn:
         try:
+            start = time.perf_counter()
             res = await conn.execute(text(query), params)
 
             if store or delete:
@@ -209,11 +262,47 @@ async def _db_query(
 
             out: list[tuple[Any, ...]] = [tuple(i) for i in res.fetchall()]
 
+            if QUERY_TIMING:
+                elapsed = (time.perf_counter() - start) * 1000
+                planning = await _planning_time(conn, query, params)
+                _print_timing(planning, elapsed, len(out))
+
             return out
         except SQLAlchemyError as err:
             print(f"SQL error: {err}")
             raise err
 
+
+async def _db_stream(
+    query: str, params: DBQueryParams = {}, size: int = 1000
+) -> AsyncIterator[list[tuple[Any, ...]]]:
+    """
+    Execute a read-only query through a server-side cursor and yield its rows
+    by lists of up to `size` rows, instead of fetching them all at once
+
+    The first lists are small and grow up to `size` rows, so that the first
+    rows are yielded as soon as the DB produces them
+    """
+    async with _connect("_pool") as conn:
+        try:
+            start = time.perf_counter()
+            res = await conn.stream(
+                text(query), params or {}, execution_options={"max_row_buffer": size}
+            )
+            n, n_rows = 1, 0
+            while rows := await res.fetchmany(n):
+                n_rows += len(rows)
+                yield [tuple(i) for i in rows]
+                n = min(size, n * 8)
+            if QUERY_TIMING:
+                elapsed = (time.perf_counter() - start) * 1000
+                planning = await _planning_time(conn, query, params or {})
+                _print_timing(planning, elapsed, n_rows)
+        except SQLAlchemyError as err:
+            print(f"SQL error: {err}")
+            raise err
+
+
 # import json
 # import logging
 # import os
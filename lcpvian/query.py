@@ -12,13 +12,11 @@ from rq.job import get_current_job, Job
 from typing import cast, Any
 from uuid import uuid4
 
-from .abstract_query.create import json_to_sql
-from .abstract_query.typed import QueryJSON
 from .authenticate import Authentication
 from .callbacks import _general_failure
 from .dqd_parser import convert
 from .jobfuncs import _handle_export
-from .query_classes import QueryInfo, Request
+from .query_classes import QueryInfo, Request, compile_query
 from .utils import (
     sanitize_filename,
     _get_query_batches,
@@ -33,22 +31,43 @@ EXPORT_TTL = 5000
 RESULTS_USERS = os.environ.get("RESULTS_USERS", os.path.join("results", "users"))
 
 
-def batch_callback(job: Job, connection: RedisConnection, batch_name: str):
+def batch_callback(
+    job: Job, connection: RedisConnection, batch_name: str | list[str] | None
+):
     """
     Publish a message that we got some results (to be captured by the requests)
     then schedule the query on the next batch
     and run the appropriate segment/meta queries now (if applicable)
+
+    In parallel mode, batch_name is the list of the batches that were just done
+    (possibly empty if a batch that comes before is still running)
     """
 
-    if not batch_name:
+    if batch_name is None or batch_name == "":
         return
 
     qhash: str = job.args[0]
     qi: QueryInfo = QueryInfo(qhash, connection)
+    batch_names: list[str] = (
+        batch_name if isinstance(batch_name, list) else [batch_name]
+    )
 
     # do next batch (if needed)
-    schedule_next_batch(qhash, connection, batch_name)
+    if batch_names:
+        schedule_next_batch(qhash, connection, batch_names[-1])
+    else:
+        schedule_parallel_batches(qi)
 
+    for name in batch_names:
+        enqueue_segment_and_meta(qi, name)
+
+
+def enqueue_segment_and_meta(qi: QueryInfo, batch_name: str):
+    """
+    Enqueue the segment/meta query of a batch that was just done, if needed
+    """
+    if not qi.requests:
+        return
     # run needed segment+meta queries
     lines_before, lines_now = qi.get_lines_batch(batch_name)
     lines_so_far = lines_before + lines_now
@@ -101,11 +120,9 @@ async def do_segment_and_meta(
     if not qi.requests:
         return
     batch_hash, _ = qi.query_batches[batch_name]
-    batch_results: list = qi.get_from_cache(batch_hash)
 
-    all_segment_ids: dict[str, int] = qi.segment_ids_in_results(
-        batch_results,
-        qi.kwic_keys,
+    all_segment_ids: dict[str, int] = qi.get_batch_segment_ids(
+        batch_hash,
         offset_this_batch,
         offset_this_batch + lines_this_batch,
     )
@@ -131,12 +148,13 @@ async def do_segment_and_meta(
         squery_id = str(uuid4())
         print(f"Running new segment query for {batch_name} -- {squery_id}")
         await qi.query(squery_id, script, params={"sids": [sid for sid in needed_sids]})
+        qi.refresh()  # requests may have changed while the query was running
         segments_this_batch = {squery_id: needed_sids, **segments_this_batch}
         qi.segments_for_batch[batch_name] = segments_this_batch
     # Calculate which lines from res should be sent to each request
     reqs_offsets = {r.id: r.lines_for_batch(qi, batch_name) for r in qi.requests}
     reqs_sids: dict[str, dict[str, int]] = {
-        req_id: qi.segment_ids_in_results(batch_results, qi.kwic_keys, o, o + l)
+        req_id: qi.get_batch_segment_ids(batch_hash, o, o + l)
         for req_id, (o, l) in reqs_offsets.items()
     }
     for sqid in segments_this_batch:
@@ -165,25 +183,169 @@ async def do_batch(qhash: str, batch: list):
     if not qi.requests:
         return
     batch_name = cast(str, batch[0])
+    if qi.parallel and batch not in qi.done_batches:
+        return await do_parallel_batch(qi, batch)
     if batch_name == qi.running_batch:
         # This batch is already running: stop here
         return
+    if batch_name == qi.prefetching:
+        # This batch is being prefetched: do_prefetch will publish it
+        return
     # Now this is the running batch
     qi.running_batch = batch_name
-    try:
+    limit = qi.batch_limit(batch_name)
+    if qi.batch_in_cache(batch_name, limit):
         batch_hash, _ = qi.query_batches[batch_name]
-        qi.get_from_cache(batch_hash)
         print(f"Retrieved query from cache: {batch_name} -- {batch_hash}")
-    except:
-        print(f"No job in cache for {batch_name}, running it now")
-        await qi.run_query_on_batch(batch)
-        batch_hash, _ = qi.query_batches.get(batch_name, ("", 0))
+        if batch not in qi.done_batches:
+            # Prefetched batch: its lines are only consumed now
+            qi.done_batches.append(batch)
+    else:
+        print(f"No job in cache for {batch_name}, running it now (limit {limit})")
+        await qi.run_query_on_batch(batch, limit=limit, partial=True)
+        qi.refresh()  # requests may have changed while the query was running
     min_offset = min(r.offset for r in qi.requests)
     await qi.run_aggregate(min_offset, batch)
     qi.publish(batch_name, "main")
     return batch_name
 
 
+async def do_parallel_batch(qi: QueryInfo, batch: list) -> list[str]:
+    """
+    Parallel mode: run the query on the batch (unless cached) and release it
+    along with any finished batch that was waiting for it
+    """
+    batch_name = cast(str, batch[0])
+    if qi.batch_in_cache(batch_name):
+        batch_hash, _ = qi.query_batches[batch_name]
+        print(f"Retrieved query from cache: {batch_name} -- {batch_hash}")
+    else:
+        print(f"No job in cache for {batch_name}, running it now (parallel)")
+        await qi.run_query_on_batch(batch, done=False)
+    qi.running_batches.pop(batch_name, "")
+    return await qi.release_finished_batches(batch_name)
+
+
+async def do_prefetch(qhash: str, batch: list) -> str | None:
+    """
+    Run the query on a batch ahead of time, from within a worker listening
+    to the low-priority prefetch queue. The results are only cached,
+    unless a request started needing the batch in the meantime
+    """
+    current_job: Job | None = get_current_job()
+    assert current_job, RuntimeError(f"No current job found for do_prefetch {batch}")
+    connection = current_job.connection
+    qi = QueryInfo(qhash, connection=connection)
+    batch_name = cast(str, batch[0])
+    if not qi.requests:
+        qi.prefetching = ""
+        return None
+    if not qi.batch_in_cache(batch_name):
+        print(f"Prefetching {batch_name}")
+        # Not done yet: the batch is marked done and its stats are aggregated
+        # once a request needs its lines (here or in do_batch)
+        await qi.run_query_on_batch(batch, done=False)
+    qi.prefetching = ""
+    qi.refresh()
+    lines_before, _ = qi.get_lines_batch(batch_name)
+    if not qi.requests or qi.required <= lines_before:
+        print(f"Prefetched {batch_name}")
+        return None
+    # A request came in while prefetching and needs this batch
+    if batch not in qi.done_batches:
+        qi.done_batches.append(batch)
+    min_offset = min(r.offset for r in qi.requests)
+    await qi.run_aggregate(min_offset, batch)
+    qi.publish(batch_name, "main")
+    return batch_name
+
+
+def prefetch_next_batch(qi: QueryInfo, previous_batch_name: str) -> Job | None:
+    """
+    Enqueue the query on the batch after previous_batch_name on the prefetch queue,
+    if the prefetch policy of QueryInfo says so
+    """
+    batch = qi.batch_to_prefetch(previous_batch_name)
+    if not batch:
+        return None
+    qi.prefetching = cast(str, batch[0])
+    return qi.enqueue(
+        do_prefetch, qi.hash, list(batch), callback=batch_callback, queue="prefetch"
+    )
+
+
+def schedule_parallel_batches(qi: QueryInfo) -> list[Job]:
+    """
+    Parallel mode: enqueue the next batches that are not done nor running,
+    so that up to qi.parallel_batches batches run at the same time
+    """
+    if not qi.requests:
+        return []
+    jobs: list[Job] = []
+    with qi.lock("schedule"):
+        qi.refresh()
+        running = qi.running_batches
+        done = [bn for bn, *_ in qi.done_batches]
+        skip = {*done, *running, *qi.finished_batches}
+        to_run = [b for b in qi.all_batches if b[0] not in skip]
+        for batch in to_run[: max(0, qi.parallel_batches - len(running))]:
+            running[cast(str, batch[0])] = 1
+            jobs.append(
+                qi.enqueue(do_batch, qi.hash, list(batch), callback=batch_callback)
+            )
+    return jobs
+
+
+async def do_count(qhash: str, batch: list) -> str | None:
+    """
+    Count the lines of a batch from within a worker and publish the counts so far
+    """
+    current_job: Job | None = get_current_job()
+    assert current_job, RuntimeError(f"No current job found for do_count {batch}")
+    connection = current_job.connection
+    qi = QueryInfo(qhash, connection=connection)
+    batch_name = cast(str, batch[0])
+    if not qi.requests:
+        qi.counting_batches.pop(batch_name, "")
+        return None
+    if batch_name not in qi.batch_counts:
+        await qi.run_count_on_batch(batch)
+    qi.counting_batches.pop(batch_name, "")
+    qi.refresh()
+    qi.publish(batch_name, "count")
+    return batch_name
+
+
+def count_callback(job: Job, connection: RedisConnection, batch_name: str | None):
+    """
+    Count the next batches once a count query is over
+    """
+    if not batch_name:
+        return
+    schedule_count_batches(QueryInfo(job.args[0], connection))
+
+
+def schedule_count_batches(qi: QueryInfo) -> list[Job]:
+    """
+    Enqueue the count queries of the batches that are not counted yet,
+    so that up to qi.parallel_batches of them run at the same time
+    """
+    if not qi.requests:
+        return []
+    jobs: list[Job] = []
+    with qi.lock("count"):
+        qi.refresh()
+        counting = qi.counting_batches
+        skip = {*qi.batch_counts, *counting}
+        to_count = [b for b in qi.all_batches if b[0] not in skip]
+        for batch in to_count[: max(0, qi.parallel_batches - len(counting))]:
+            counting[cast(str, batch[0])] = 1
+            jobs.append(
+                qi.enqueue(do_count, qi.hash, list(batch), callback=count_callback)
+            )
+    return jobs
+
+
 def schedule_next_batch(
     qhash: str,
     connection: RedisConnection,
@@ -200,11 +362,16 @@ def schedule_next_batch(
         lines_before, lines_batch = qi.get_lines_batch(previous_batch_name)
         if lines_before + lines_batch >= qi.required:
             qi.running_batch = ""
+            prefetch_next_batch(qi, previous_batch_name)
             return None
     next_batch = qi.decide_next_batch(previous_batch_name)
     if not next_batch:
         qi.running_batch = ""
         return None
+    if qi.parallel and list(next_batch) not in qi.done_batches:
+        # Done batches are replayed one at a time, the others run in parallel
+        jobs = schedule_parallel_batches(qi)
+        return jobs[0] if jobs else None
     min_offset = min(r.offset for r in qi.requests)
     while min_offset > 0 and list(next_batch) in qi.done_batches:
         lines_before_batch, lines_next_batch = qi.get_lines_batch(next_batch[0])
@@ -232,15 +399,17 @@ def process_query(
     except json.JSONDecodeError:
         json_query = convert(request.query, config)
     all_batches = _get_query_batches(config, request.languages)
-    sql_query, meta_json, post_processes = json_to_sql(
-        cast(QueryJSON, json_query),
-        schema=config.get("schema_path", ""),
-        batch=cast(str, all_batches[0][0]),
-        config=config,
-        lang=request.languages[0] if request.languages else None,
+    sql_query, meta_json, post_processes = compile_query(
+        app["redis"],
+        json_query,
+        config,
+        cast(str, all_batches[0][0]),
+        request.languages[0] if request.languages else None,
+        keyset=bool(request.after),
     )
     print("SQL query:", sql_query)
-    shash = hasher(sql_query)
+    # requests resuming after different lines need different queries
+    shash = hasher([sql_query, request.after]) if request.after else hasher(sql_query)
     qi = QueryInfo(
         shash,
         app["redis"],
@@ -249,6 +418,7 @@ def process_query(
         post_processes,
         request.languages,
         config,
+        request.after,
     )
     qi.add_request(request)
     if request.to_export and request.user:
@@ -289,6 +459,11 @@ def process_query(
                 "corpus_id": request.corpus,
             },
         )
+    if request.count_first:
+        if qi.counts_complete:
+            qi.publish("", "count")
+        else:
+            schedule_count_batches(qi)
     job: Job | None = schedule_next_batch(shash, connection=app["redis"])
     return (request, qi, job)
 
@@ -344,6 +519,9 @@ async def post_query(request: web.Request) -> web.Response:
     except Exception as e:
         raise web.HTTPBadRequest(reason=str(e))
 
+    if req.synchronous:
+        req.done_event(app)  # registered before any response comes in
+
     if req.to_export and req.user:
         xpformat = req.to_export.get("format", "xml") or "xml"
         await push_msg(
@@ -361,10 +539,7 @@ async def post_query(request: web.Request) -> web.Response:
             query_buffers = {}
             app.addkey("query_buffers", dict[str, dict], query_buffers)
         query_buffers[req.id] = {}
-        while 1:
-            await asyncio.sleep(0.5)
-            if not qi.has_request(req):
-                break
+        await req.wait_until_done(app, qi)
         res = query_buffers[req.id]
         query_buffers.pop(req.id, None)
         print(f"[{req.id}] Done with synchronous request")
@@ -1,9 +1,14 @@
+import asyncio
 import json
+import time
 import traceback
 import os
 
+import numpy as np
+
 from aiohttp import web
 from redis import Redis as RedisConnection
+from redis.lock import Lock
 from rq import Callback, Queue
 from rq.command import send_stop_job_command
 from rq.job import Job
@@ -11,28 +16,58 @@ from types import TracebackType
 from typing import cast, Any, Callable
 from uuid import uuid4
 
-from .abstract_query.create import json_to_sql
+from . import cache
+from .abstract_query.create import batch_template, fill_batch_template, json_to_sql
 from .abstract_query.typed import QueryJSON
 from .callbacks import _general_failure
-from .convert import _aggregate_results
-from .jobfuncs import _db_query
-from .typed import JSONObject, ObservableDict, ObservableList
+from .convert import (
+    Aggregation,
+    AggregationState,
+    _decode_stats_key,
+    _e_weights,
+    _encode_stats_key,
+    _make_filters,
+    _merge_batch,
+    _merge_stats_deltas,
+)
+from .jobfuncs import _db_query, _db_stream
+from .typed import Batch, JSONObject, ObservableDict, ObservableList
 from .utils import (
     _get_query_batches,
     _publish_msg,
-    _get_query_info,
-    _update_query_info,
-    _get_request,
-    _update_request,
+    _publish_to_process,
     hasher,
     push_msg,
-    CustomEncoder,
+    socket_processes,
+    RedisRecord,
+    PROCESS_ID,
+    TRUES,
 )
 
 QUERY_TTL = int(os.getenv("QUERY_TTL", 5000))
 QUERY_TIMEOUT = int(os.getenv("QUERY_TIMEOUT", 1000))
 FULL_QUERY_TIMEOUT = int(os.getenv("QUERY_ENTIRE_CORPUS_CALLBACK_TIMEOUT", 99999))
 MAX_KWIC_LINES = int(os.getenv("DEFAULT_MAX_KWIC_LINES", 9999999))
+PARALLEL_BATCHES = int(os.getenv("QUERY_PARALLEL_BATCHES", 4))
+PREFETCH = os.getenv("QUERY_PREFETCH", "true").strip().lower() in TRUES
+PRETTY_SQL = os.getenv("QUERY_PRETTY_SQL", "true").strip().lower() in TRUES
+LIMIT_PUSHDOWN = os.getenv("QUERY_LIMIT_PUSHDOWN", "true").strip().lower() in TRUES
+SQL_CACHE_SIZE = int(os.getenv("QUERY_SQL_CACHE_SIZE", 256))
+# frequency tables with a limit keep up to limit * this many rows across batches
+STATS_TOP_CAPACITY = int(os.getenv("QUERY_STATS_TOP_CAPACITY", 10))
+# how often a process waiting for a request checks that no other process stopped it
+SYNC_CHECK_INTERVAL = float(os.getenv("QUERY_SYNC_CHECK_INTERVAL", 10))
+
+# In-process copy of the compiled queries stored in redis by compile_query
+_SQL_CACHE: dict[str, dict[str, Any]] = {}
+RESULTS_CHUNK_SIZE = int(os.getenv("RESULTS_CACHE_CHUNK_SIZE", 5000))
+# read the batch results through a server-side cursor, STREAM_ROWS rows at a time
+STREAM_RESULTS = os.getenv("QUERY_STREAM_RESULTS", "true").strip().lower() in TRUES
+STREAM_ROWS = int(os.getenv("QUERY_STREAM_ROWS", RESULTS_CHUNK_SIZE))
+# while streaming a batch, publish its new KWIC lines every PARTIAL_ROWS lines
+# or PARTIAL_INTERVAL seconds (for the requests with partial_results)
+PARTIAL_ROWS = int(os.getenv("QUERY_PARTIAL_ROWS", 1000))
+PARTIAL_INTERVAL = float(os.getenv("QUERY_PARTIAL_INTERVAL", 2))
 
 SERIALIZABLES = (
     int,
@@ -73,63 +108,327 @@ def _merge_results(exisitng: dict, incoming: dict):
             exisitng[k] = incoming[k]
 
 
+def compile_query(
+    connection: RedisConnection,
+    query_json: dict,
+    config: dict,
+    batch: str,
+    lang: str | None = None,
+    count_only: bool = False,
+    limit: int | None = None,
+    keyset: bool = False,
+) -> tuple[str, dict, dict]:
+    """
+    json_to_sql with a cache keyed by the normalized query JSON, the corpus
+    (ID, version and schema), the family of the batch and the language.
+
+    The query is compiled once for a placeholder batch and the SQL of each batch
+    of the family is obtained by substituting the batch suffix in that template.
+    The template is checked against a real compilation the first time; if they
+    differ, the SQL of each batch is compiled and cached separately.
+    Set QUERY_PRETTY_SQL=false to skip the reformatting of the SQL
+    Set count_only to get the query that only counts the lines of each plain result set
+    Set limit to get the query that only returns the first lines of each plain result set
+    Set keyset to get the query that resumes after a line (see QueryInfo.batch_params)
+    """
+    key = "sql::" + hasher(
+        [
+            json.dumps(query_json, sort_keys=True),
+            config.get("corpus_id"),
+            config.get("current_version"),
+            config.get("schema_path"),
+            batch_template(batch) or batch,
+            lang,
+            PRETTY_SQL,
+            count_only,
+            limit,
+            keyset,
+        ]
+    )
+    kwargs: dict[str, Any] = dict(
+        schema=config.get("schema_path", ""),
+        config=config,
+        lang=lang,
+        pretty=PRETTY_SQL,
+        count_only=count_only,
+        limit=limit,
+        keyset=keyset,
+    )
+    entry: dict[str, Any] | None = _SQL_CACHE.get(key)
+    if entry is None:
+        raw = cast(dict, connection.hgetall(key))
+        entry = {k.decode(): json.loads(v) for k, v in raw.items()}
+    new_fields: dict[str, Any] = {}
+    if "template" not in entry:
+        sql, meta_json, post_processes = json_to_sql(
+            cast(QueryJSON, query_json), batch=batch, **kwargs
+        )
+        template: str = ""
+        if batch_template(batch):
+            template, _, _ = json_to_sql(
+                cast(QueryJSON, query_json), batch=batch_template(batch), **kwargs
+            )
+            if fill_batch_template(template, batch) != sql:
+                template = ""
+        new_fields = {
+            "template": template,
+            "meta_json": meta_json,
+            "post_processes": post_processes,
+        }
+        if not template:
+            new_fields[f"batch::{batch}"] = sql
+    elif not entry["template"] and f"batch::{batch}" not in entry:
+        sql, _, _ = json_to_sql(cast(QueryJSON, query_json), batch=batch, **kwargs)
+        new_fields = {f"batch::{batch}": sql}
+    if new_fields:
+        encoded = {k: json.dumps(v) for k, v in new_fields.items()}
+        with connection.pipeline(transaction=False) as pipe:
+            pipe.hset(key, mapping=cast(dict[str | bytes, str], encoded))
+            pipe.expire(key, QUERY_TTL)
+            pipe.execute()
+        entry.update({k: json.loads(v) for k, v in encoded.items()})
+    if len(_SQL_CACHE) >= SQL_CACHE_SIZE and key not in _SQL_CACHE:
+        _SQL_CACHE.pop(next(iter(_SQL_CACHE)))
+    _SQL_CACHE[key] = entry
+    if entry["template"]:
+        sql = fill_batch_template(entry["template"], batch)
+    else:
+        sql = entry[f"batch::{batch}"]
+    return sql, entry["meta_json"], entry["post_processes"]
+
+
+class BatchResultsWriter:
+    """
+    Write the results of a batch to the cache as they come from the DB
+
+    The KWIC lines are written by chunks of RESULTS_CHUNK_SIZE lines and the
+    other lines by parts of up to STREAM_ROWS lines, so that at most about
+    RESULTS_CHUNK_SIZE + STREAM_ROWS lines are held in memory whatever the size
+    of the batch. The lines go to temporary keys which finish swaps in along
+    with the index: until then, an entry already in the cache for the batch
+    stays whole (see QueryInfo.set_batch_results for the layout)
+    """
+
+    def __init__(
+        self, connection: RedisConnection, batch_hash: str, kwic_keys: list[str]
+    ):
+        self._connection = connection
+        self.batch_hash = batch_hash
+        self.kwic_keys = set(kwic_keys)
+        self.chunks_key, self.segments_key = QueryInfo._batch_keys(
+            f"{batch_hash}::tmp::{uuid4()}"
+        )
+        self.counts: dict[str, int] = {}
+        self.n_chunks = 0
+        self.n_rest = 0
+        self._kwic: list = []
+        self._rest: list = []
+
+    def add(self, lines: list) -> None:
+        """
+        Buffer some lines and write the full chunks/parts to the cache
+        """
+        for line in lines:
+            key = str(line[0])
+            if key not in self.kwic_keys:
+                self._rest.append(line)
+                continue
+            self._kwic.append(line)
+            self.counts[key] = self.counts.get(key, 0) + 1
+        self._flush()
+
+    def _flush(self, last: bool = False) -> None:
+        n_full = len(self._kwic) // RESULTS_CHUNK_SIZE * RESULTS_CHUNK_SIZE
+        kwic, self._kwic = self._kwic[:n_full], self._kwic[n_full:]
+        if last and self._kwic:
+            kwic, self._kwic = kwic + self._kwic, []
+        rest: list = []
+        # the first part of the other lines is always written, even if empty
+        write_rest = len(self._rest) >= STREAM_ROWS or (
+            last and (bool(self._rest) or not self.n_rest)
+        )
+        if write_rest:
+            rest, self._rest = self._rest, []
+        if not kwic and not write_rest:
+            return
+        with self._connection.pipeline(transaction=False) as pipe:
+            for n in range(0, len(kwic), RESULTS_CHUNK_SIZE):
+                chunk = kwic[n : n + RESULTS_CHUNK_SIZE]
+                pipe.hset(self.chunks_key, str(self.n_chunks), cache.dumps(chunk))
+                sids = [str(sid) for _, (sid, *_) in chunk]
+                pipe.hset(self.segments_key, str(self.n_chunks), cache.dumps(sids))
+                self.n_chunks += 1
+            if write_rest:
+                field = f"rest::{self.n_rest}" if self.n_rest else "rest"
+                pipe.hset(self.chunks_key, field, cache.dumps(rest))
+                self.n_rest += 1
+            pipe.expire(self.chunks_key, QUERY_TTL)
+            if self.n_chunks:
+                pipe.expire(self.segments_key, QUERY_TTL)
+            pipe.execute()
+
+    def finish(
+        self, limit: int | None = None, total_counts: dict[str, int] | None = None
+    ) -> int:
+        """
+        Write what is left and the index, return the number of KWIC lines
+        """
+        self._flush(last=True)
+        index: dict[str, Any] = {
+            "chunk_size": RESULTS_CHUNK_SIZE,
+            "n_lines": sum(self.counts.values()),
+            "n_chunks": self.n_chunks,
+            "counts": self.counts,
+        }
+        if self.n_rest > 1:
+            index["rest_parts"] = self.n_rest
+        if limit is not None and total_counts is not None:
+            # the lines keep their numbers in the whole batch (see _cached_ranges)
+            index.update(
+                {"limit": limit, "counts": total_counts, "cached": self.counts}
+            )
+        chunks_key, segments_key = QueryInfo._batch_keys(self.batch_hash)
+        with self._connection.pipeline() as pipe:
+            pipe.rename(self.chunks_key, chunks_key)
+            if self.n_chunks:
+                pipe.rename(self.segments_key, segments_key)
+            else:
+                pipe.delete(segments_key)
+            pipe.set(self.batch_hash, cache.dumps(index), ex=QUERY_TTL)
+            pipe.execute()
+        return sum(index["counts"].values())
+
+
+class PartialResults:
+    """
+    Publish the KWIC lines of a batch as they come from the DB ("partial"
+    callbacks, see Request.send_partial), by PARTIAL_ROWS lines or after
+    PARTIAL_INTERVAL seconds, until the requests have all the lines they need.
+    Nothing is published if no request opted for partial results
+    """
+
+    def __init__(self, qi: "QueryInfo", batch_name: str):
+        self.qi = qi
+        self.batch_name = batch_name
+        self.kwic_keys = set(qi.kwic_keys)
+        done = {bn for bn, *_ in qi.done_batches}
+        self.lines_before = sum(
+            n for bn, (_, n) in qi.ordered_query_batches() if bn in done
+        )
+        self.needed = qi.required - self.lines_before
+        if not PARTIAL_ROWS or not any(r.partial_results for r in qi.requests):
+            self.needed = 0
+        self.sent = 0
+        self._pending: list = []
+        self._last = time.monotonic()
+
+    def add(self, lines: list) -> None:
+        if self.sent >= self.needed:
+            return
+        self._pending += [line for line in lines if str(line[0]) in self.kwic_keys]
+        del self._pending[self.needed - self.sent :]
+        now = time.monotonic()
+        if len(self._pending) < PARTIAL_ROWS and now - self._last < PARTIAL_INTERVAL:
+            return
+        self._last = now
+        if not self._pending:
+            return
+        payload = {
+            "lines_before": self.lines_before,
+            "start": self.sent,
+            "lines": self._pending,
+        }
+        self.qi.publish(self.batch_name, "partial", payload)
+        self.sent += len(self._pending)
+        self._pending = []
+
+
 class Request:
     """
     Received POST requests
+
+    The redis entry is loaded once (or passed preloaded as `data`)
+    and the attributes are read from that local copy; changes are written back
+    field by field, see RedisRecord
     """
 
-    def __init__(self, connection: RedisConnection, request: dict = {}):
+    # the web process that received the request (unknown for older requests)
+    owner: str = ""
+
+    def __init__(
+        self,
+        connection: RedisConnection,
+        request: dict = {},
+        data: dict | None = None,
+    ):
         self._connection = connection
         request = cast(dict, request)
-        try:
-            request = _get_request(connection, request["id"])
-        except:
-            request["id"] = str(request.setdefault("id", uuid4()))
-            # The attributes below are immutable
-            self.id: str = request["id"]
-            self.synchronous: bool = request.get("synchronous", False)
-            self.requested: int = request.get("requested", 0)
-            self.full: bool = request.get("full", False)
-            self.offset: int = request.get("offset", 0)
-            self.corpus: int = request.get("corpus", 1)
-            self.user: str = request.get("user", "")
-            self.room: str = request.get("room", "")
-            self.languages: list[str] = request.get("languages", [])
-            self.query: str = request.get("query", "")
-            to_export = request.get("to_export", None)
-            if not isinstance(to_export, dict):
-                to_export = {"format": "xml"} if to_export else {}
-            self.to_export: dict | None = to_export
-            # The attributes below are dynamic and need to update redis
-            # job1: [200,400,30] --> sent lines 200 through 400, need 30 segments
-            self.lines_batch: dict[str, tuple[int, int, int]] = request.get(
-                "lines_batch", {}
+        if "id" in request:
+            self._record = RedisRecord(
+                connection, f"request::{request['id']}", data=data
             )
-            # keep track of which hashes were already sent
-            self.sent_hashes: dict[str, int] = request.get("sent_hashes", {})
-            self.segment_lines_for_hash: dict[str, dict[int, int]] = request.get(
-                "segment_lines_for_hash", {}
-            )
-            if "hash" in request:
-                self.hash: str = request["hash"]
+            request = self._record.data
+        else:
+            request["id"] = str(uuid4())
+            self._record = RedisRecord(connection, f"request::{request['id']}", {})
+            with self._record.deferred():
+                self._init_attributes(request)
         self._full = request.get("full", False)
         self._id = request["id"]
 
+    def _init_attributes(self, request: dict):
+        """
+        Set the attributes of a new request (written to redis in one go)
+        """
+        # The attributes below are immutable
+        self.id: str = request["id"]
+        self.synchronous: bool = request.get("synchronous", False)
+        self.requested: int = request.get("requested", 0)
+        self.full: bool = request.get("full", False)
+        self.offset: int = request.get("offset", 0)
+        self.corpus: int = request.get("corpus", 1)
+        self.user: str = request.get("user", "")
+        self.room: str = request.get("room", "")
+        self.languages: list[str] = request.get("languages", [])
+        self.query: str = request.get("query", "")
+        # count the lines of every batch first, the lines themselves come lazily
+        self.count_first: bool = request.get("count_first", False)
+        # resume after a line: {"batch": name, "rstype": n, "line": [...], "skip": [names]}
+        self.after: dict = request.get("after", {})
+        to_export = request.get("to_export", None)
+        if not isinstance(to_export, dict):
+            to_export = {"format": "xml"} if to_export else {}
+        self.to_export: dict | None = to_export
+        self.owner = request.get("owner", PROCESS_ID)
+        # The attributes below are dynamic and need to update redis
+        # job1: [200,400,30] --> sent lines 200 through 400, need 30 segments
+        self.lines_batch: dict[str, tuple[int, int, int]] = request.get(
+            "lines_batch", {}
+        )
+        # keep track of which hashes were already sent
+        self.sent_hashes: dict[str, int] = request.get("sent_hashes", {})
+        self.segment_lines_for_hash: dict[str, dict[int, int]] = request.get(
+            "segment_lines_for_hash", {}
+        )
+        # websocket clients can opt for receiving only the stats rows that changed
+        self.stats_delta: bool = request.get("stats_delta", False)
+        # the version of the stats last sent to the client (see QueryInfo.get_stats)
+        self.stats_version: int = request.get("stats_version", 0)
+        # websocket clients can opt for receiving the lines of a batch as they come
+        self.partial_results: bool = request.get("partial_results", False)
+        if "hash" in request:
+            self.hash: str = request["hash"]
+
     def update(self, name: str | None = None, value: Any = None):
         """
         Update the associated redis entry
         """
-        try:
-            redis = self._connection
-            id = self.id
-        except:
-            return
         if name:
-            _update_request(redis, id, info={"id": id, name: value})
-        else:
-            self_serialized = self.serialize()
-            self_serialized["id"] = id
-            _update_request(redis, id, info=self_serialized)
+            self._record.set(name, value)
+            return
+        with self._record.deferred():
+            for k, v in self.serialize().items():
+                self._record.set(k, v)
 
     def update_dict(self, attribute_name: str, update_dict: dict):
         """
@@ -153,19 +452,15 @@ class Request:
             return sum(up for _, up, _ in lines_batch.values())
         elif full and name in ("requested", "offset"):
             return 0 if name == "offset" else MAX_KWIC_LINES
-        try:
-            # Try to retrieve the value from redis first
-            connection = super().__getattribute__("_connection")
-            request = _get_request(connection, self._id)
-            assert name in request, Exception()
-            value = request[name]
-        except:
-            # Retrieve the internal value instead
-            value = super().__getattribute__(name)
-        return value
+        request: dict = self._record.data
+        if name in request:
+            return request[name]
+        # Retrieve the internal value instead
+        return super().__getattribute__(name)
 
     def __setattr__(self, name, value):
-        self.update(name, value)  # make sure to update redis first
+        if not name.startswith("_"):
+            self.update(name, value)  # make sure to update redis first
         super().__setattr__(name, value)
 
     def serialize(self) -> dict:
@@ -190,7 +485,7 @@ class Request:
             return False
         relevant_batches: list[str] = []
         nlines = 0
-        for batch_hash, n in qi.query_batches.values():
+        for _, (batch_hash, n) in qi.ordered_query_batches():
             if nlines >= self.offset:
                 relevant_batches.append(batch_hash)
             nlines += n
@@ -203,6 +498,8 @@ class Request:
         """
         if not self.all_queries_done(qi):
             return False
+        if self.count_first and not qi.counts_complete:
+            return False
         if not qi.kwic_keys:
             return True
         all_segs_sent = True
@@ -216,11 +513,55 @@ class Request:
             all_segs_sent = all_segs_sent and batch_segs_sent
         return all_segs_sent
 
-    def delete_if_done(self, qi: "QueryInfo"):
+    def delete_if_done(self, qi: "QueryInfo") -> bool:
         if not self.is_done(qi):
-            return
+            return False
         print(f"[{self.id}] DELETE REQUEST NOW")
         qi.delete_request(self)
+        return True
+
+    def handled_here(self, app: web.Application, routed: bool = False) -> bool:
+        """
+        Whether this web process responds to the request: synchronous requests
+        and exports are handled by the process that received them, the others
+        by the process holding the socket of their room (or by the process
+        that received them if no process holds one, unless the message was routed)
+        """
+        mine = not self.owner or self.owner == PROCESS_ID
+        if self.synchronous or self.to_export or not self.room:
+            return mine
+        if app["websockets"].get(self.room):
+            return True
+        return mine and not routed
+
+    def done_event(self, app: web.Application) -> asyncio.Event:
+        """
+        The event set by this web process once the request is over
+        """
+        return app["query_events"].setdefault(self.id, asyncio.Event())
+
+    def set_done(self, app: web.Application):
+        event: asyncio.Event | None = app["query_events"].get(self.id)
+        if event is not None:
+            event.set()
+
+    async def wait_until_done(self, app: web.Application, qi: "QueryInfo"):
+        """
+        Wait until the responses to the request are over, without polling redis
+        (except for checking that the request is still there, in case it was
+        stopped by another process or its event was missed: after 0.5 seconds,
+        then twice as long each time up to SYNC_CHECK_INTERVAL seconds)
+        """
+        event = self.done_event(app)
+        interval = min(0.5, SYNC_CHECK_INTERVAL)
+        try:
+            while not event.is_set() and qi.has_request(self):
+                try:
+                    await asyncio.wait_for(event.wait(), interval)
+                except asyncio.TimeoutError:
+                    interval = min(interval * 2, SYNC_CHECK_INTERVAL)
+        finally:
+            app["query_events"].pop(self.id, None)
 
     def lines_for_batch(self, qi: "QueryInfo", batch_name: str) -> tuple[int, int]:
         """
@@ -358,45 +699,40 @@ class Request:
         if batch_hash in self.sent_hashes:
             # If some lines were already sent for this job
             return
-        batch_res: list = qi.get_from_cache(batch_hash)
         offset_this_batch, lines_this_batch = self.lines_for_batch(qi, batch_name)
+        batch_index = qi.get_batch_index(batch_hash)
+        batch_res: list = []
+        if lines_this_batch > 0:
+            batch_res = qi.get_batch_lines(
+                batch_hash, offset_this_batch, offset_this_batch + lines_this_batch
+            )
         n_seg_ids: int = 0
         if lines_this_batch > 0 and qi.kwic_keys:
-            n_seg_ids = len(
-                qi.segment_ids_in_results(
-                    batch_res,
-                    qi.kwic_keys,
-                    offset_this_batch,
-                    offset_this_batch + lines_this_batch,
-                )
-            )
+            n_seg_ids = len(qi.segment_ids_in_results(batch_res, qi.kwic_keys))
         self.update_dict(
             "lines_batch",
             {batch_hash: (offset_this_batch, lines_this_batch, n_seg_ids)},
         )
         _, results = qi.get_stats_results()  # fetch any stats results first
-        lines_so_far = -1
+        for sk in batch_index["counts"]:
+            results.setdefault(sk, [])
         for k, v in batch_res:
-            sk = str(k)
-            if sk not in qi.kwic_keys:
-                continue
-            if sk not in results:
-                results[sk] = []
-            lines_so_far += 1
-            if lines_so_far < offset_this_batch:
-                continue
-            if lines_so_far >= offset_this_batch + lines_this_batch:
-                continue
-            results[sk].append(v)
+            results[str(k)].append(v)
         self.update_dict("sent_hashes", {batch_hash: len(results)})
         results["0"] = {"result_sets": qi.result_sets, "meta_labels": qi.meta_labels}
-        try:
-            stats_key = f"{qi.hash}::stats"
-            _, stats_res = qi.get_from_cache(stats_key)
-            results.update(stats_res)
-        except:
-            pass
         payload = self.get_payload(qi, batch_name)
+        deltas = self.stats_delta and not self.synchronous and not self.to_export
+        stats_since = self.stats_version if deltas else 0
+        stats_version, stats_res, removed = qi.get_stats(stats_since)
+        results.update(stats_res)
+        if stats_res:
+            payload["stats_version"] = stats_version
+        if stats_res and qi.stats_limits:
+            payload["stats_error"] = qi.get_stats_errors()
+        if removed is not None:
+            payload["stats_delta"] = {"from": stats_since, "removed": removed}
+        if deltas and stats_version != stats_since:
+            self.stats_version = stats_version
         payload.update({"action": "query_result", "result": results})
         more_in_batch = (
             offset_this_batch + lines_this_batch < qi.get_lines_batch(batch_name)[1]
@@ -426,6 +762,109 @@ class Request:
                 just=(self.room, self.user),
             )
 
+    async def send_stats(self, app: web.Application, qi: "QueryInfo"):
+        """
+        Send a full snapshot of the stats, which the next deltas build upon
+        """
+        payload = qi.stats_snapshot()
+        payload.update({"user": self.user, "room": self.room, "request": self.id})
+        stats_version: int = payload["stats_version"]
+        print(f"[{self.id}] Sending stats snapshot version {stats_version}")
+        self.stats_version = stats_version
+        await push_msg(
+            app["websockets"],
+            self.room,
+            cast(JSONObject, payload),
+            skip=None,
+            just=(self.room, self.user),
+        )
+
+    async def send_partial(self, app: web.Application, qi: "QueryInfo", payload: dict):
+        """
+        Forward the lines of a batch whose query is still running, as published
+        by QueryInfo.run_query_on_batch, if the request needs some of them.
+        The main callback of the batch sends all its lines as usual
+        """
+        if not self.partial_results or self.synchronous or self.to_export:
+            return
+        start: int = payload["lines_before"] + payload["start"]
+        lines: list = payload["lines"]
+        lower = max(self.offset, start)
+        upper = min(self.offset + self.requested, start + len(lines))
+        if upper <= lower:
+            return
+        results: dict[str, Any] = {k: [] for k in qi.kwic_keys}
+        for k, v in lines[lower - start : upper - start]:
+            results[str(k)].append(v)
+        results["0"] = {"result_sets": qi.result_sets, "meta_labels": qi.meta_labels}
+        batch_name: str = payload["batch"]
+        message: dict = {
+            "job": qi.hash,
+            "user": self.user,
+            "room": self.room,
+            "hash": self.hash,
+            "request": self.id,
+            "batch_name": batch_name,
+            "status": "started",
+            "action": "query_result",
+            "partial": True,
+            "first_line": lower,
+            "result": results,
+        }
+        print(
+            f"[{self.id}] Sending {upper - lower} partial lines for batch {batch_name}"
+        )
+        await push_msg(
+            app["websockets"],
+            self.room,
+            cast(JSONObject, message),
+            skip=None,
+            just=(self.room, self.user),
+        )
+
+    async def send_count(self, app: web.Application, qi: "QueryInfo", batch_name: str):
+        """
+        Send the number of lines of each plain result set, summed over
+        the batches counted so far
+        """
+        batch_counts = qi.batch_counts
+        counts = qi.total_counts
+        counted_words = sum(int(n) for bn, n in qi.all_batches if bn in batch_counts)
+        total_words = sum(int(n) for (_, n) in qi.all_batches) or 1
+        percentage_words_counted = 100.0 * counted_words / total_words
+        payload: dict = {
+            "job": qi.hash,
+            "user": self.user,
+            "room": self.room,
+            "hash": self.hash,
+            "batch_name": batch_name,
+            "action": "query_count",
+            "counts": counts,
+            "complete": qi.counts_complete,
+            "batches_counted": f"{len(batch_counts)}/{len(qi.all_batches)}",
+            "percentage_words_counted": percentage_words_counted,
+            "projected_counts": {
+                k: int(100 * n / (percentage_words_counted or 100))
+                for k, n in counts.items()
+            },
+        }
+        print(
+            f"[{self.id}] Sending counts after {payload['batches_counted']} batches (QI {qi.hash})"
+        )
+        if self.to_export:
+            return
+        elif self.synchronous:
+            req_buffer = app["query_buffers"][self.id]
+            req_buffer["counts"] = counts
+        else:
+            await push_msg(
+                app["websockets"],
+                self.room,
+                cast(JSONObject, payload),
+                skip=None,
+                just=(self.room, self.user),
+            )
+
     async def error(
         self, app: web.Application, qi: "QueryInfo", error: str = "unknown"
     ):
@@ -451,24 +890,33 @@ class Request:
             )
         qi.delete_request(self)
 
-    async def respond(self, app: web.Application, payload: dict):
+    async def respond(
+        self, app: web.Application, payload: dict, qi: "QueryInfo | None" = None
+    ):
         """
         This method is called by the main app in sock.py
         after QI publishes a "callback_query" message with the batch name
         """
         typ: str = payload["callback_query"]
-        qi: QueryInfo = QueryInfo(payload["hash"], connection=self._connection)
+        if qi is None:
+            qi = QueryInfo(payload["hash"], connection=self._connection)
         batch_name: str = payload["batch"]
         if typ == "failure":
             await self.error(app, qi, payload.get("batch", "unknown"))
+            self.set_done(app)
             return
         try:
+            if typ == "partial":
+                await self.send_partial(app, qi, payload)
+                return
             if typ == "main":
                 await self.send_query(app, qi, batch_name)
             elif typ == "segments":
                 await self.send_segments(app, qi, batch_name)
-            if not self.to_export:
-                self.delete_if_done(qi)
+            elif typ == "count":
+                await self.send_count(app, qi, batch_name)
+            if not self.to_export and self.delete_if_done(qi):
+                self.set_done(app)
         except Exception as e:
             tb = traceback.format_exc()
             qi.publish("\n".join([str(e), tb]), "failure")
@@ -509,8 +957,11 @@ class QueryInfo:
         post_processes: dict | None = None,
         languages: list[str] | None = None,
         config: dict | None = None,
+        after: dict | None = None,
     ):
         self._connection = connection
+        self._record = RedisRecord(connection, f"query_info::{qhash}")
+        self._requests: tuple[list[str], list[Request]] = ([], [])
         self.hash = qhash
         qi = self.qi
         self.json_query: dict = json_query or qi.get("json_query", {})
@@ -520,6 +971,7 @@ class QueryInfo:
         self.result_sets: list = self.meta_json.get("result_sets", [])
         self.meta_labels: list[str] = qi.get("meta_labels", [])
         self.languages: list[str] = languages or qi.get("languages", [])
+        self.after: dict = after or qi.get("after", {})
         if not qi:
             self.update()
 
@@ -527,18 +979,25 @@ class QueryInfo:
         """
         Update the attributes of this instance and the entry in Redis
         """
-        if obj:
-            _update_query_info(self._connection, self.hash, info=obj)
-            return
-        qi = _get_query_info(self._connection, self.hash)
-        for aname in dir(self):
-            if aname.startswith("_") or aname == "requests":
-                continue
-            attr = getattr(self, aname)
-            if not isinstance(attr, SERIALIZABLES):
-                continue
-            qi[aname] = attr
-        _update_query_info(self._connection, self.hash, info=qi)
+        with self._record.deferred():
+            if obj:
+                for k, v in obj.items():
+                    self._record.set(k, v)
+                return
+            for aname in dir(self):
+                if aname.startswith("_") or aname == "requests":
+                    continue
+                attr = getattr(self, aname)
+                if not isinstance(attr, SERIALIZABLES):
+                    continue
+                self._record.set(aname, attr)
+
+    def refresh(self):
+        """
+        Write any pending change and fetch the latest state from redis
+        (useful after awaiting something long, eg. a DB query)
+        """
+        self._record.refresh()
 
     def enqueue(
         self,
@@ -546,22 +1005,24 @@ class QueryInfo:
         *args,
         job_id: str | None = None,
         callback: Callable | None = None,
+        queue: str = "background",
         **kwargs,
     ) -> Job:
         """
-        Adds a job to the background queue
+        Adds a job to the background queue (or to the specified queue)
         Can be called either from the main app or from a worker
         """
-        q = Queue("background", connection=self._connection)
-        enqueued_job_ids = [jid for jid in self.enqueued_jobs]
-        # Clear any job that needs to be cleared
-        for jid in enqueued_job_ids:
-            try:
-                job = Job.fetch(jid, self._connection)
-                if not (job.is_started or job.is_scheduled or job.is_queued):
-                    self.enqueued_jobs.pop(jid, "")
-            except:
-                self.enqueued_jobs.pop(jid, "")
+        q = Queue(queue, connection=self._connection)
+        enqueued_jobs = self.enqueued_jobs
+        # Clear any job that needs to be cleared (a single write for all of them)
+        with self._record.deferred():
+            for jid in [jid for jid in enqueued_jobs]:
+                try:
+                    job = Job.fetch(jid, self._connection)
+                    if not (job.is_started or job.is_scheduled or job.is_queued):
+                        enqueued_jobs.pop(jid, "")
+                except:
+                    enqueued_jobs.pop(jid, "")
         on_success: Callback | None = (
             Callback(callback, QUERY_TIMEOUT) if callback else None
         )
@@ -580,13 +1041,192 @@ class QueryInfo:
         return j
 
     def set_cache(self, key: str, data: Any):
-        self._connection.set(key, json.dumps(data, cls=CustomEncoder))
-        self._connection.expire(key, QUERY_TTL)
+        self._connection.set(key, cache.dumps(data), ex=QUERY_TTL)
 
     def get_from_cache(self, key: str) -> list:
-        res_json: str = cast(str, self._connection.get(key))
-        self._connection.expire(key, QUERY_TTL)
-        return cast(list, json.loads(res_json))
+        raw = self._connection.getex(key, ex=QUERY_TTL)
+        if raw is None:
+            raise KeyError(f"No results in cache for {key}")
+        return cast(list, cache.loads(cast(bytes, raw)))
+
+    def set_batch_results(
+        self,
+        batch_hash: str,
+        results: list,
+        limit: int | None = None,
+        total_counts: dict[str, int] | None = None,
+    ) -> int:
+        """
+        Cache the results of a batch and return its number of KWIC lines
+
+        The KWIC lines are split in chunks of RESULTS_CHUNK_SIZE lines
+        and the segment IDs of each chunk are stored as a separate column,
+        so that a slice of lines only needs to fetch the chunks it overlaps.
+        The non-KWIC lines (stats, count) are stored together (in parts when
+        streamed, see BatchResultsWriter), and a small index under batch_hash
+        records the number of lines per result set
+
+        If the results were cut by a LIMIT, pass the limit and the actual
+        counts of lines per result set: only the first `limit` lines can be read
+        """
+        writer = BatchResultsWriter(self._connection, batch_hash, self.kwic_keys)
+        writer.add(results)
+        return writer.finish(limit, total_counts)
+
+    @staticmethod
+    def _batch_keys(batch_hash: str) -> tuple[str, str]:
+        return (f"{batch_hash}::chunks", f"{batch_hash}::segments")
+
+    def get_batch_index(self, batch_hash: str) -> dict[str, Any]:
+        """
+        Return the index of a cached batch (raise KeyError if not in cache)
+        and extend the lifetime of the batch in the cache
+        """
+        chunks_key, segments_key = self._batch_keys(batch_hash)
+        with self._connection.pipeline(transaction=False) as pipe:
+            pipe.getex(batch_hash, ex=QUERY_TTL)
+            pipe.expire(chunks_key, QUERY_TTL)
+            pipe.expire(segments_key, QUERY_TTL)
+            raw, *_ = pipe.execute()
+        if raw is None:
+            raise KeyError(f"No results in cache for {batch_hash}")
+        index = cache.loads(cast(bytes, raw))
+        if isinstance(index, list):
+            # Batch cached as a single list of lines: store it in chunks
+            self.set_batch_results(batch_hash, index)
+            return self.get_batch_index(batch_hash)
+        return cast(dict[str, Any], index)
+
+    @staticmethod
+    def _cached_ranges(
+        index: dict[str, Any], offset: int, upper: int | None
+    ) -> list[tuple[int, int]]:
+        """
+        The ranges of cached lines holding the KWIC lines [offset, upper) of a batch
+
+        The lines of a batch are numbered one result set after the other.
+        When the query was cut by a LIMIT, only the first `limit` lines of each
+        result set are cached, so the lines of a result set start further
+        in the batch than in the cache and only its cached lines can be read
+        """
+        if "limit" not in index:
+            n_lines: int = index["n_lines"]
+            upper = n_lines if upper is None else min(upper, n_lines)
+            return [(offset, upper)] if offset < upper else []
+        limit: int = index["limit"]
+        cached: dict[str, int] = index.get("cached") or {
+            k: min(n, limit) for k, n in index["counts"].items()
+        }
+        ranges: list[tuple[int, int]] = []
+        batch_start = cache_start = 0
+        for key, n_cached in cached.items():
+            lower = max(offset, batch_start)
+            end = batch_start + n_cached
+            end = end if upper is None else min(upper, end)
+            if lower < end:
+                shift = cache_start - batch_start
+                ranges.append((lower + shift, end + shift))
+            batch_start += index["counts"].get(key, n_cached)
+            cache_start += n_cached
+        return ranges
+
+    def _get_batch_chunks(
+        self,
+        batch_hash: str,
+        index: dict[str, Any],
+        ranges: list[tuple[int, int]],
+        segments: bool = False,
+    ) -> list:
+        """
+        Fetch the chunks (or their segment IDs) overlapping the ranges of cached lines
+        and return the lines (or segment IDs) of the ranges
+        """
+        if not ranges:
+            return []
+        size: int = index["chunk_size"]
+        first, last = ranges[0][0] // size, (ranges[-1][1] - 1) // size
+        chunks_key, segments_key = self._batch_keys(batch_hash)
+        raws = self._connection.hmget(
+            segments_key if segments else chunks_key,
+            [str(n) for n in range(first, last + 1)],
+        )
+        if any(raw is None for raw in raws):
+            raise KeyError(f"Incomplete results in cache for {batch_hash}")
+        lines = [x for raw in raws for x in cache.loads(cast(bytes, raw))]
+        start = first * size
+        return [x for lower, end in ranges for x in lines[lower - start : end - start]]
+
+    def batch_params(self, batch_name: str) -> dict[str, Any]:
+        """
+        The parameters of the keyset query on the batch: the batch of the line
+        to resume after only yields the lines that sort after it,
+        the other batches yield all their lines
+        """
+        if not self.after:
+            return {}
+        if batch_name != self.after.get("batch"):
+            return {"after_rstype": 0, "after_line": "[]"}
+        return {
+            "after_rstype": int(self.after.get("rstype", 1)),
+            "after_line": json.dumps(self.after.get("line", [])),
+        }
+
+    def batch_in_cache(self, batch_name: str, limit: int | None = None) -> bool:
+        """
+        Whether the results of the batch are cached, including at least
+        its first `limit` lines (all its lines if limit is None)
+        """
+        try:
+            batch_hash, _ = self.query_batches[batch_name]
+            index = self.get_batch_index(batch_hash)
+        except KeyError:
+            return False
+        cached_limit: int | None = index.get("limit")
+        return cached_limit is None or (limit is not None and limit <= cached_limit)
+
+    def batch_limit(self, batch_name: str) -> int | None:
+        """
+        How many lines of each plain result set the query on the batch needs
+        to return to satisfy the requests (None for all of them)
+        """
+        if not LIMIT_PUSHDOWN or self.full or not self.kwic_keys:
+            return None
+        lines_before, _ = self.get_lines_batch(batch_name)
+        needed = self.required - lines_before
+        return needed if needed > 0 else None
+
+    def get_batch_lines(
+        self, batch_hash: str, offset: int = 0, upper: int | None = None
+    ) -> list:
+        """
+        Return the KWIC lines [offset, upper) of a cached batch as (rstype, line)
+        """
+        index = self.get_batch_index(batch_hash)
+        ranges = self._cached_ranges(index, offset, upper)
+        return self._get_batch_chunks(batch_hash, index, ranges)
+
+    def get_batch_segment_ids(
+        self, batch_hash: str, offset: int = 0, upper: int | None = None
+    ) -> dict[str, int]:
+        """
+        Return the unique segment IDs of the KWIC lines [offset, upper) of a cached batch
+        """
+        index = self.get_batch_index(batch_hash)
+        ranges = self._cached_ranges(index, offset, upper)
+        sids = self._get_batch_chunks(batch_hash, index, ranges, True)
+        return {sid: 1 for sid in sids}
+
+    def get_batch_rest(self, batch_hash: str) -> list:
+        """
+        Return the non-KWIC lines of a cached batch
+        """
+        chunks_key, _ = self._batch_keys(batch_hash)
+        n_parts = self.get_batch_index(batch_hash).get("rest_parts", 1)
+        fields = ["rest"] + [f"rest::{n}" for n in range(1, n_parts)]
+        raws = self._connection.hmget(chunks_key, fields)
+        if any(raw is None for raw in raws):
+            raise KeyError(f"Incomplete results in cache for {batch_hash}")
+        return [line for raw in raws for line in cache.loads(cast(bytes, raw))]
 
     async def query(self, qhash: str, script: str, params: dict = {}) -> Any:
         """
@@ -599,9 +1239,13 @@ class QueryInfo:
     def publish(self, batch_name: str, typ: str, custom_payload: dict[str, Any] = {}):
         """
         Notify the app that results are available
+
+        Each web process that handles some of the requests gets a message on its
+        own channel listing them; the requests whose process is unknown (or gone)
+        are listed in a message to all the processes
         """
         if typ == "failure":
-            self.running_batch = ""
+            self.update({"running_batch": "", "running_batches": {}, "prefetching": ""})
         msg_id: str = str(uuid4())
         payload: dict[str, Any] = {
             "callback_query": typ,
@@ -613,11 +1257,38 @@ class QueryInfo:
                 payload.pop(k, None)
                 continue
             payload[k] = v
-        _publish_msg(
-            self._connection,
-            payload,
-            msg_id=msg_id,
-        )
+        unrouted: list[str] = []
+        routes = self.request_routes()
+        for process_id, rids in routes.items():
+            routed = {**payload, "requests": rids, "routed": True}
+            if process_id and _publish_to_process(self._connection, routed, process_id):
+                continue
+            unrouted += rids
+        if unrouted or not routes:
+            if routes:
+                payload["requests"] = unrouted
+            _publish_msg(
+                self._connection,
+                payload,
+                msg_id=msg_id,
+            )
+
+    def request_routes(self) -> dict[str, list[str]]:
+        """
+        Map the web processes with the IDs of the requests they handle
+        ("" for the requests whose process is unknown), see Request.handled_here
+        """
+        routes: dict[str, list[str]] = {}
+        rooms: dict[str, list[str]] = {}
+        for r in self.requests:
+            processes: list[str] = [r.owner]
+            if not (r.synchronous or r.to_export or not r.room):
+                if r.room not in rooms:
+                    rooms[r.room] = socket_processes(self._connection, r.room)
+                processes = rooms[r.room] or [r.owner]
+            for process_id in processes:
+                routes.setdefault(process_id, []).append(r.id)
+        return routes
 
     def get_observer(self, attribute_name: str) -> Callable:
         """
@@ -657,6 +1328,85 @@ class QueryInfo:
     def running_batch(self, value: str):
         self.update({"running_batch": value})
 
+    @property
+    def prefetching(self) -> str:
+        """
+        The batch being queried ahead of time, if any
+        """
+        return self.qi.get("prefetching", "")
+
+    @prefetching.setter
+    def prefetching(self, value: str):
+        self.update({"prefetching": value})
+
+    @property
+    def running_batches(self) -> dict[str, int]:
+        """
+        Parallel mode: the batches currently being queried
+        """
+        running_batches = self.qi.get("running_batches", {})
+        return cast(
+            dict[str, int],
+            ObservableDict(
+                **running_batches, observer=self.get_observer("running_batches")
+            ),
+        )
+
+    @running_batches.setter
+    def running_batches(self, value: dict[str, int]):
+        self.update({"running_batches": value})
+
+    @property
+    def finished_batches(self) -> dict[str, int]:
+        """
+        Parallel mode: the batches whose query is over but which are not done yet
+        because a batch that comes before them is still running
+        """
+        finished_batches = self.qi.get("finished_batches", {})
+        return cast(
+            dict[str, int],
+            ObservableDict(
+                **finished_batches, observer=self.get_observer("finished_batches")
+            ),
+        )
+
+    @finished_batches.setter
+    def finished_batches(self, value: dict[str, int]):
+        self.update({"finished_batches": value})
+
+    @property
+    def batch_counts(self) -> dict[str, dict[str, int]]:
+        """
+        Map batch names with the number of lines of each plain result set
+        (filled by the count queries, see run_count_on_batch)
+        """
+        batch_counts = self.qi.get("batch_counts", {})
+        return cast(
+            dict,
+            ObservableDict(**batch_counts, observer=self.get_observer("batch_counts")),
+        )
+
+    @batch_counts.setter
+    def batch_counts(self, value: dict[str, dict[str, int]]):
+        self.update({"batch_counts": value})
+
+    @property
+    def counting_batches(self) -> dict[str, int]:
+        """
+        The batches whose count query is currently running
+        """
+        counting_batches = self.qi.get("counting_batches", {})
+        return cast(
+            dict[str, int],
+            ObservableDict(
+                **counting_batches, observer=self.get_observer("counting_batches")
+            ),
+        )
+
+    @counting_batches.setter
+    def counting_batches(self, value: dict[str, int]):
+        self.update({"counting_batches": value})
+
     @property
     def done_batches(self) -> list:
         done_batches = self.qi.get("done_batches", [])
@@ -705,23 +1455,27 @@ class QueryInfo:
         self.update({"segments_for_batch": value})
 
     def has_request(self, request: Request):
+        self.refresh()
         return any(r.id == request.id for r in self.requests)
 
     def add_request(self, request: Request):
         request.hash = self.hash
-        requests = self.requests
-        if request in self.requests:
+        if request.room and request.user:
+            readers_key = self.stats_key("readers")
+            with self._connection.pipeline(transaction=False) as pipe:
+                pipe.sadd(readers_key, f"{request.room}::{request.user}")
+                pipe.expire(readers_key, QUERY_TTL)
+                pipe.execute()
+        rids = [r.id for r in self.requests]
+        if request.id in rids:
             return
-        rids = [r.id for r in requests]
-        rids.append(request.id)
-        _update_query_info(self._connection, self.hash, info={"requests": rids})
+        self._record.set("requests", [*rids, request.id])
 
     def delete_request(self, request: Request):
         rids = [r.id for r in self.requests if r.id != request.id]
-        _update_query_info(self._connection, self.hash, info={"requests": rids})
-        rkey = f"request::{request.id}"
+        self._record.set("requests", rids)
         try:
-            self._connection.delete(rkey)
+            request._record.delete()
         except:
             pass
 
@@ -732,16 +1486,31 @@ class QueryInfo:
         self.delete_request(request)
         if self.requests:
             return
-        jids = [jid for jid in self.enqueued_jobs]
-        for jid in jids:
-            try:
-                job = Job.fetch(jid, self._connection)
-                if job.is_started or job.is_scheduled or job.is_queued:
-                    job.cancel()
-                    send_stop_job_command(self._connection, jid)
-                    self.enqueued_jobs.pop(jid, "")
-            except:
-                self.enqueued_jobs.pop(jid, "")
+        enqueued_jobs = self.enqueued_jobs
+        with self._record.deferred():
+            for jid in [jid for jid in enqueued_jobs]:
+                try:
+                    job = Job.fetch(jid, self._connection)
+                    if job.is_started or job.is_scheduled or job.is_queued:
+                        job.cancel()
+                        send_stop_job_command(self._connection, jid)
+                        enqueued_jobs.pop(jid, "")
+                except:
+                    enqueued_jobs.pop(jid, "")
+            # the batches that were running will need to be scheduled again
+            self.running_batches = {}
+            self.counting_batches = {}
+            self.prefetching = ""
+
+    def lock(self, name: str) -> Lock:
+        """
+        A redis lock to run something for this query in one process at a time
+        """
+        return self._connection.lock(
+            f"{self.hash}::lock::{name}",
+            timeout=QUERY_TIMEOUT,
+            blocking_timeout=QUERY_TIMEOUT,
+        )
 
     def get_lines_batch(self, batch_name: str) -> tuple[int, int]:
         """
@@ -750,13 +1519,23 @@ class QueryInfo:
         """
         lines_before_batch: int = 0
         lines_this_batch: int = 0
-        for bn, (_, nlines) in self.query_batches.items():
+        for bn, (_, nlines) in self.ordered_query_batches():
             if bn == batch_name:
                 lines_this_batch = nlines
                 break
             lines_before_batch += nlines
         return (lines_before_batch, lines_this_batch)
 
+    def ordered_query_batches(self) -> list[tuple[str, tuple[str, int]]]:
+        """
+        The items of query_batches in the order in which the batches were done,
+        ie. the order in which their lines are sent
+        """
+        query_batches = self.query_batches
+        names = [bn for bn, *_ in self.done_batches if bn in query_batches]
+        names += [bn for bn in query_batches if bn not in names]
+        return [(bn, cast(tuple[str, int], tuple(query_batches[bn]))) for bn in names]
+
     def get_stats_results(self) -> tuple[list, dict]:
         """
         All the non-KWIC results
@@ -819,31 +1598,77 @@ class QueryInfo:
 
         return []
 
+    def batch_to_prefetch(self, previous_batch: str) -> list:
+        """
+        Return the batch to query ahead of time once the requests are satisfied,
+        or an empty list if there is no need to.
+
+        A batch is prefetched when the lines collected so far would not cover
+        one more page (the largest number of lines requested) past what is
+        currently required, so that the next batch is likely to be ready
+        by the time the user pages past the current results
+        """
+        if not PREFETCH or self.full or self.prefetching:
+            return []
+        requests = self.requests
+        if not requests:
+            return []
+        page: int = max(r.requested for r in requests)
+        if self.total_results_so_far >= self.required + page:
+            return []
+        next_batch = self.decide_next_batch(previous_batch)
+        if not next_batch or list(next_batch) in self.done_batches:
+            return []
+        if self.batch_in_cache(cast(str, next_batch[0])):
+            # Already prefetched, waiting for a request to need it
+            return []
+        return next_batch
+
     # Pseudo-attributes (no need to keep in sync)
     @property
     def qi(self) -> dict:
-        return _get_query_info(self._connection, hash=self.hash)
+        return self._record.data
 
     @property
     def requests(self) -> list[Request]:
         """
         Return the associated requests
-        The class Request already implements utmost recency
+        All the request entries are fetched in a single round trip,
+        and only again when the list of request IDs changes
         """
-        qi = _get_query_info(self._connection, self.hash)
+        rids: list[str] = self.qi.get("requests", [])
+        cached_rids, reqs = self._requests
+        if rids == cached_rids:
+            return [r for r in reqs]
         reqs = []
-        for rid in qi.get("requests", []):
-            try:
-                _get_request(self._connection, f"request::{rid}")
-                reqs.append(Request(self._connection, {"id": rid}))
-            except:
+        with self._connection.pipeline(transaction=False) as pipe:
+            for rid in rids:
+                pipe.hgetall(f"request::{rid}")
+            raws: list[dict] = pipe.execute() if rids else []
+        for rid, raw in zip(rids, raws):
+            if not raw:
                 # Do no create a Request object if the ID isn't in redis
-                pass
-        return reqs
+                continue
+            data = {k.decode(): json.loads(v) for k, v in raw.items()}
+            reqs.append(Request(self._connection, {"id": rid}, data=data))
+        self._requests = ([rid for rid in rids], reqs)
+        return [r for r in reqs]
 
     @property
     def all_batches(self) -> list[list[str | int]]:
-        return _get_query_batches(self.config, self.languages)
+        """
+        When resuming after a line, the batch of that line comes first, followed by
+        the batches not listed in after["skip"] (by default, the batches after it)
+        """
+        batches = _get_query_batches(self.config, self.languages)
+        after_batch = self.after.get("batch")
+        names = [b[0] for b in batches]
+        if after_batch not in names:
+            return batches
+        skip = self.after.get("skip") or names[: names.index(after_batch)]
+        return [b for b in batches if b[0] == after_batch] + [
+            b for b in batches if b[0] != after_batch and b[0] not in skip
+        ]
 
     @property
     def kwic_keys(self) -> list[str]:
@@ -882,9 +1707,44 @@ class QueryInfo:
             max(r.offset + r.requested for r in self.requests) if self.requests else 0
         )
 
+    @property
+    def parallel_batches(self) -> int:
+        """
+        How many batches of a full query can run at the same time
+        (the corpus config can override QUERY_PARALLEL_BATCHES)
+        """
+        return max(1, int(self.config.get("parallel_batches") or PARALLEL_BATCHES))
+
+    @property
+    def parallel(self) -> bool:
+        return self.full and self.parallel_batches > 1
+
+    @property
+    def counts_complete(self) -> bool:
+        batch_counts = self.batch_counts
+        return all(bn in batch_counts for bn, _ in self.all_batches)
+
+    @property
+    def total_counts(self) -> dict[str, int]:
+        """
+        The number of lines of each plain result set over the batches counted so far
+        """
+        totals: dict[str, int] = {k: 0 for k in self.kwic_keys}
+        for counts in self.batch_counts.values():
+            for k, n in counts.items():
+                totals[k] = totals.get(k, 0) + n
+        return totals
+
     @property
     def total_results_so_far(self) -> int:
-        return sum(nlines for _, nlines in self.query_batches.values())
+        """
+        The number of KWIC lines in the done batches (prefetched batches
+        or parallel batches waiting for their turn are not counted yet)
+        """
+        query_batches = self.query_batches
+        return sum(
+            query_batches[bn][1] for bn, *_ in self.done_batches if bn in query_batches
+        )
 
     # methods called from worker
 
@@ -894,62 +1754,406 @@ class QueryInfo:
         batch: list,
     ):
         """
-        Aggregate the stats results, or fetch from cache
+        Aggregate the stats results of a batch into the stats of the query
+
+        The stats are stored in redis hashes, one per result set and aggregate
+        (see stats_key), whose fields are the keys of the rows: a batch only
+        reads and writes the rows it has. Every batch aggregated makes a new
+        version of the stats (the number of batches aggregated so far) and
+        the rows it changed are stored as a delta from the previous version,
+        see get_stats
         """
         if not self.stats_keys:
             return
         batch_name: str = batch[0]
-        stats_key = f"{self.hash}::stats"
-        try:
-            stats_batches, stats_results = self.get_from_cache(stats_key)
+        with self.lock("aggregate"):
+            stats_batches = self.stats_batches
             if batch_name in stats_batches:
-                # No need to run aggregate: cache already has this batch
+                # No need to run aggregate: this batch was already aggregated
                 return
-        except:
-            stats_batches, stats_results = [], {}
-        new_stats_batches = [b for b in stats_batches] + [batch_name]
-        meta_json: dict = self.meta_json
-        post_processes: dict = self.post_processes
-        batch_hash, _ = self.query_batches[batch_name]
-        res: list = self.get_from_cache(batch_hash)
-        lines_so_far, n_res = self.get_lines_batch(batch_name)
-        if n_res == 0 or lines_so_far + n_res < offset:
-            # Indicate we have processed this batch
-            self.set_cache(stats_key, [new_stats_batches, stats_results])
-            return
-        (_, to_send, _, _, _) = _aggregate_results(
-            res,
-            stats_results,
-            meta_json,
-            post_processes,
-            batch,
-            self.done_batches,
-        )
-        new_stats_results = {
-            k: v for k, v in to_send.items() if str(k) in self.stats_keys
-        }
-        self.set_cache(stats_key, [new_stats_batches, new_stats_results])
+            version = len(stats_batches) + 1
+            batch_hash, _ = self.query_batches[batch_name]
+            lines_so_far, n_res = self.get_lines_batch(batch_name)
+            pipe = self._connection.pipeline()
+            delta: dict = {}
+            # unless there is nothing to aggregate, in which case
+            # we only indicate we have processed this batch
+            if n_res > 0 and lines_so_far + n_res >= offset:
+                res: list = self.get_batch_rest(batch_hash)
+                batch_state: AggregationState = {}
+                _merge_batch(
+                    batch_state, res, self.meta_json, batch, [cast(Batch, batch)]
+                )
+                delta = self._store_aggregation(pipe, batch_state, batch)
+            batches_key = self.stats_key("batches")
+            pipe.rpush(batches_key, batch_name)
+            pipe.expire(batches_key, QUERY_TTL)
+            pipe.set(self.stats_delta_key(version), cache.dumps(delta), ex=QUERY_TTL)
+            pipe.execute()
         return
 
-    async def run_query_on_batch(self, batch) -> str:
+    def stats_key(self, *parts: str | int) -> str:
+        return "::".join([f"{self.hash}::stats", *(str(p) for p in parts)])
+
+    def stats_delta_key(self, version: int) -> str:
+        return self.stats_key("delta", version)
+
+    @property
+    def stats_batches(self) -> list[str]:
+        """
+        The names of the batches aggregated so far, in order
+        """
+        batches = self._connection.lrange(self.stats_key("batches"), 0, -1)
+        return [b.decode() if isinstance(b, bytes) else b for b in batches]
+
+    def _read_aggregation(
+        self, rs: str, fields: list[str], collocation: bool, width: int
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray | None]:
+        """
+        Read the aggregates of some rows of a result set: whether each row
+        already exists, their aggregates (0 if not) and E values if collocation
+        """
+        read = self._connection.pipeline(transaction=False)
+        for column in range(width):
+            read.hmget(self.stats_key(rs, column), fields)
+        if collocation:
+            read.hmget(self.stats_key(rs, "e"), fields)
+        columns = read.execute() if fields else [[] for _ in range(width + 1)]
+        known = np.array([v is not None for v in columns[0]], dtype=bool)
+        counts = np.zeros((len(fields), width), dtype=np.int64)
+        for n in range(width):
+            counts[:, n] = [int(v) if v is not None else 0 for v in columns[n]]
+        e: np.ndarray | None = None
+        if collocation:
+            e = np.array(
+                [float(v) if v is not None else 0.0 for v in columns[width]],
+                dtype=np.float64,
+            )
+        return known, counts, e
+
+    def _store_aggregation(
+        self, pipe: Any, batch_state: AggregationState, batch: list
+    ) -> dict:
+        """
+        Add the aggregated rows of a batch to the stats hashes (through pipe)
+        and return the delta: the rows changed and the IDs of the rows removed
+        (by the filters) in each result set
+        """
+        filters = _make_filters(self.post_processes) if self.post_processes else {}
+        e_weights = _e_weights(cast(Batch, batch), self.done_batches)
+        changed: dict[str, list] = {}
+        removed: dict[str, list] = {}
+        limits = self.stats_limits
+        for k, agg in batch_state.items():
+            rs = str(k)
+            if rs in limits:
+                top_changed, top_removed = self._store_top(
+                    pipe, rs, agg, limits[rs], filters.get(k, [])
+                )
+                changed[rs], removed[rs] = top_changed, top_removed
+                continue
+            fields = [_encode_stats_key(key) for key in agg.keys]
+            width = agg.counts.shape[1]
+            known, counts, e = self._read_aggregation(
+                rs, fields, agg.collocation, width
+            )
+            before = Aggregation.from_columns(agg.keys, counts, e)
+            after = Aggregation.from_columns(agg.keys, counts.copy(), e)
+            after.merge(
+                agg.keys,
+                agg.counts.tolist(),
+                agg.e.tolist() if agg.collocation else None,
+                e_weights,
+            )
+            for column in range(width):
+                key = self.stats_key(rs, column)
+                values = after.counts[:, column].tolist()
+                pipe.hset(key, mapping=dict(zip(fields, values)))
+                pipe.expire(key, QUERY_TTL)
+            if agg.collocation:
+                key = self.stats_key(rs, "e")
+                pipe.hset(key, mapping=dict(zip(fields, after.e.tolist())))
+                pipe.expire(key, QUERY_TTL)
+            new_fields = [f for f, k in zip(fields, known.tolist()) if not k]
+            if new_fields:
+                pipe.rpush(self.stats_key(rs, "keys"), *new_fields)
+            pipe.expire(self.stats_key(rs, "keys"), QUERY_TTL)
+            rs_filters = filters.get(k, [])
+            passed_before = known & before.mask(rs_filters)
+            passed_after = after.mask(rs_filters)
+            rows = after.rows()
+            changed[rs] = [rows[i] for i in np.flatnonzero(passed_after).tolist()]
+            removed[rs] = [
+                json.loads(fields[i])
+                for i in np.flatnonzero(passed_before & ~passed_after).tolist()
+            ]
+        return {"changed": changed, "removed": removed}
+
+    def _store_top(
+        self,
+        pipe: Any,
+        rs: str,
+        agg: Aggregation,
+        limit: int,
+        filters: list,
+    ) -> tuple[list, list]:
+        """
+        Add the rows of a batch to a frequency table with a limit: only
+        limit * STATS_TOP_CAPACITY rows are kept, so the table is rewritten
+        as a whole. The counts can be underestimated, by up to the `limit`th
+        count of each batch (which only returned its top rows) plus the highest
+        count evicted, which is added to the error bound of the table.
+        Return the rows of the new top and the IDs of the rows that left it
+        """
+        stored = self._load_aggregation(rs, self.result_sets[int(rs) - 1])
+        old_top = {stored.keys[i] for i in stored.top(limit, filters).tolist()}
+        threshold = int(agg.counts[:, 0].min()) if len(agg) >= limit else 0
+        stored.merge(agg.keys, agg.counts.tolist())
+        error = threshold + stored.prune(limit * STATS_TOP_CAPACITY)
+        fields = [_encode_stats_key(key) for key in stored.keys]
+        columns = [self.stats_key(rs, c) for c in range(stored.counts.shape[1])]
+        pipe.delete(self.stats_key(rs, "keys"), *columns)
+        for n, key in enumerate(columns if fields else []):
+            values = stored.counts[:, n].tolist()
+            pipe.hset(key, mapping=dict(zip(fields, values)))
+            pipe.expire(key, QUERY_TTL)
+        if fields:
+            pipe.rpush(self.stats_key(rs, "keys"), *fields)
+        pipe.expire(self.stats_key(rs, "keys"), QUERY_TTL)
+        if error:
+            pipe.hincrby(self.stats_key("errors"), rs, error)
+            pipe.expire(self.stats_key("errors"), QUERY_TTL)
+        rows = stored.rows()
+        top = stored.top(limit, filters).tolist()
+        new_top = {stored.keys[i] for i in top}
+        removed = [json.loads(_encode_stats_key(k)) for k in old_top - new_top]
+        return [rows[i] for i in top], removed
+
+    def _load_aggregation(self, rs: str, result_set: dict) -> Aggregation:
+        """
+        Read all the rows of a stats result set
+        """
+        fields = self._connection.lrange(self.stats_key(rs, "keys"), 0, -1)
+        collocation = result_set.get("type") == "collocation"
+        width = 1
+        if not collocation:
+            attrs = result_set.get("attributes", [])
+            width = sum(1 for a in attrs if a.get("type") == "aggregate")
+        _, counts, e = self._read_aggregation(rs, fields, collocation, width)
+        keys = [_decode_stats_key(f) for f in fields]
+        return Aggregation.from_columns(keys, counts, e)
+
+    @property
+    def stats_limits(self) -> dict[str, int]:
+        """
+        The result sets that only keep their most frequent rows, and how many
+        """
+        return {
+            str(n): int(mr["limit"])
+            for n, mr in enumerate(self.result_sets, start=1)
+            if mr.get("type") == "analysis" and mr.get("limit")
+        }
+
+    def get_stats_errors(self) -> dict[str, int]:
+        """
+        How much the counts of the frequency tables with a limit can be
+        underestimated
+        """
+        errors = self._connection.hgetall(self.stats_key("errors"))
+        return {
+            (k.decode() if isinstance(k, bytes) else k): int(v)
+            for k, v in errors.items()
+        }
+
+    def get_stats_aggregation(self) -> dict[str, list]:
+        """
+        All the (filtered) rows of the stats result sets,
+        or their top rows for the result sets with a limit
+        """
+        filters = _make_filters(self.post_processes) if self.post_processes else {}
+        limits = self.stats_limits
+        results: dict[str, list] = {}
+        for n, result_set in enumerate(self.result_sets, start=1):
+            rs = str(n)
+            if rs not in self.stats_keys:
+                continue
+            agg = self._load_aggregation(rs, result_set)
+            rows = agg.rows()
+            if rs in limits:
+                top = agg.top(limits[rs], filters.get(n, [])).tolist()
+                results[rs] = [rows[i] for i in top]
+                continue
+            results[rs] = agg.select(rows, filters.get(n, []))
+        return results
+
+    def can_read_stats(self, room: str, user: str) -> bool:
+        """
+        Whether a request of this user in this room was made for the query,
+        even if it is over and was deleted since (see stats_snapshot)
+        """
+        readers_key = self.stats_key("readers")
+        return bool(self._connection.sismember(readers_key, f"{room}::{user}"))
+
+    def stats_snapshot(self) -> dict:
+        """
+        The payload of a full snapshot of the stats, which the next deltas
+        build upon: clients that missed a delta ask for it, with the hash
+        of the query since their request may already be over
+        """
+        stats_version, stats_res, _ = self.get_stats()
+        payload: dict = {
+            "job": self.hash,
+            "hash": self.hash,
+            "action": "stats_snapshot",
+            "stats_version": stats_version,
+            "result": stats_res,
+        }
+        if self.stats_limits:
+            payload["stats_error"] = self.get_stats_errors()
+        return payload
+
+    def get_stats(self, since: int = 0) -> tuple[int, dict, dict | None]:
+        """
+        Return the current version of the stats, their rows and None
+        or, when passed the version a client already has, only the rows
+        changed since then and the IDs of the removed rows
+
+        A full snapshot is returned if since is 0 or if a delta has expired
+        """
+        version = self._connection.llen(self.stats_key("batches"))
+        if not version:
+            return (0, {}, None)
+        if since <= 0 or since > version:
+            return (version, self.get_stats_aggregation(), None)
+        keys = [self.stats_delta_key(v) for v in range(since + 1, version + 1)]
+        raws = self._connection.mget(keys) if keys else []
+        if any(raw is None for raw in raws):
+            return (version, self.get_stats_aggregation(), None)
+        deltas = [cache.loads(cast(bytes, raw)) for raw in raws]
+        changed, removed = _merge_stats_deltas(deltas, self.meta_json)
+        rows = {k: changed.get(k, []) for k in self.stats_keys}
+        return (version, rows, {k: removed.get(k, []) for k in self.stats_keys})
+
+    async def release_finished_batches(self, batch_name: str) -> list[str]:
+        """
+        Parallel mode: mark the batch as finished, then go through the batches
+        in order and mark the finished ones as done, aggregate their stats and
+        publish them, until reaching one that is still running.
+        This way the stats and the lines are processed in the order of the batches
+        whatever order their queries complete in.
+        Return the names of the batches that were published
+        """
+        self.finished_batches[batch_name] = 1
+        released: list[str] = []
+        with self.lock("release"):
+            self.refresh()
+            done = {bn for bn, *_ in self.done_batches}
+            finished = self.finished_batches
+            for batch in self.all_batches:
+                name = cast(str, batch[0])
+                if name in done:
+                    continue
+                if name not in finished:
+                    break
+                self.done_batches.append(batch)
+                min_offset = min((r.offset for r in self.requests), default=0)
+                await self.run_aggregate(min_offset, batch)
+                self.publish(name, "main")
+                released.append(name)
+            if released:
+                with self._record.deferred():
+                    for name in released:
+                        finished.pop(name, "")
+        return released
+
+    async def run_query_on_batch(
+        self,
+        batch,
+        done: bool = True,
+        limit: int | None = None,
+        partial: bool = False,
+    ) -> str:
         """
         Send and run a SQL query againt the DB
         then update the QueryInfo and Request's accordingly
         and launch any required sentence/meta queries
+        (set done to False to not mark the batch as done yet)
+
+        With a limit, the query only returns the first lines of each plain
+        result set, and a count query gets their actual number if the limit was hit
+
+        With partial, the KWIC lines that the requests need are published
+        ("partial" callbacks) as they come, before the query is over
         """
         batch_name, _ = batch
-        sql_query, _, _ = json_to_sql(
-            cast(QueryJSON, self.json_query),
-            schema=self.config.get("schema_path", ""),
-            batch=batch_name,
-            config=self.config,
-            lang=self.languages[0] if self.languages else None,
-        )
-        batch_hash = hasher(sql_query)
-        res = await self.query(batch_hash, sql_query)
-        res = res if res else []
-        n_res = sum(1 if str(r) in self.kwic_keys else 0 for r, *_ in res)
+        lang = self.languages[0] if self.languages else None
+        keyset = bool(self.after)
+        params = self.batch_params(batch_name)
+        sql_query, _, _ = compile_query(
+            self._connection,
+            self.json_query,
+            self.config,
+            batch_name,
+            lang,
+            keyset=keyset,
+        )
+        batch_hash = hasher([sql_query, params]) if params else hasher(sql_query)
+        if limit is not None:
+            sql_query, _, _ = compile_query(
+                self._connection,
+                self.json_query,
+                self.config,
+                batch_name,
+                lang,
+                limit=limit,
+                keyset=keyset,
+            )
+        writer = BatchResultsWriter(self._connection, batch_hash, self.kwic_keys)
+        if STREAM_RESULTS:
+            partials = PartialResults(self, batch_name) if partial else None
+            async for rows in _db_stream(sql_query, params=params, size=STREAM_ROWS):
+                writer.add(rows)
+                if partials:
+                    partials.add(rows)
+        else:
+            writer.add(cast(list, await _db_query(sql_query, params=params) or []))
+        counts: dict[str, int] | None = None
+        if limit is not None and any(n >= limit for n in writer.counts.values()):
+            counts = await self._count_batch(batch_name)
+        n_res = writer.finish(None if counts is None else limit, counts)
         self.query_batches[batch_name] = (batch_hash, n_res)
-        if batch not in self.done_batches:
+        if done and batch not in self.done_batches:
             self.done_batches.append(batch)
         return batch_hash
+
+    async def run_count_on_batch(self, batch) -> dict[str, int]:
+        """
+        Count the lines of each plain result set in the batch, without fetching them
+        (the main query already gives the counts of the batches it ran on)
+        """
+        batch_name, _ = batch
+        try:
+            batch_hash, _ = self.query_batches[batch_name]
+            batch_counts = self.get_batch_index(batch_hash)["counts"]
+            counts = {k: batch_counts.get(k, 0) for k in self.kwic_keys}
+        except:
+            counts = await self._count_batch(batch_name)
+        self.batch_counts[batch_name] = counts
+        return counts
+
+    async def _count_batch(self, batch_name: str) -> dict[str, int]:
+        sql_query, _, _ = compile_query(
+            self._connection,
+            self.json_query,
+            self.config,
+            batch_name,
+            self.languages[0] if self.languages else None,
+            count_only=True,
+            keyset=bool(self.after),
+        )
+        res = await _db_query(sql_query, params=self.batch_params(batch_name))
+        counts = {k: 0 for k in self.kwic_keys}
+        for rstype, (n, *_) in cast(list, res or []):
+            if str(rstype) in counts:
+                counts[str(rstype)] = int(n)
+        return counts
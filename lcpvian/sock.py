@@ -35,7 +35,7 @@ from aiohttp.http_websocket import WSMessage
 from rq.job import Job
 
 from redis.asyncio.client import PubSub
-from redis.exceptions import ConnectionError
+from redis.exceptions import ConnectionError, ResponseError
 
 
 from .configure import _get_batches, CorpusConfig
@@ -46,7 +46,15 @@ from .validate import validate
 
 from .typed import JSON, JSONObject, RedisMessage, Websockets
 from .utils import (
+    MESSAGE_STREAM,
+    PROCESS_ID,
     PUBSUB_CHANNEL,
+    WEBSOCKET_COMPRESS,
+    close_socket_writer,
+    process_channel,
+    register_socket,
+    set_socket_options,
+    socket_queue_stats,
     _filter_corpora,
     _set_config,
     _sign_payload,
@@ -55,6 +63,61 @@ from .utils import (
 
 MESSAGE_TTL = os.getenv("REDIS_WS_MESSSAGE_TTL", 5000)
 QUERY_TTL = os.getenv("QUERY_TTL", 5000)
+# max number of pubsub messages handled per drain cycle
+PUBSUB_DRAIN_SIZE = int(os.getenv("REDIS_PUBSUB_DRAIN_SIZE", 256))
+# max number of groups of messages (one group per query/room) handled at the same time
+PUBSUB_CONCURRENCY = int(os.getenv("REDIS_PUBSUB_CONCURRENCY", 32))
+# each web process reads the whole message stream with its own consumer group:
+# the processes of a same group would share its messages, and the messages for
+# the sockets of one process could be read by another one and lost
+STREAM_GROUP = f"{os.getenv('REDIS_STREAM_GROUP', '') or 'web'}:{PROCESS_ID}"
+
+
+def _decode_message(message: RedisMessage) -> JSONObject | None:
+    """
+    Return the data of a pubsub message, or None for subscribe/empty messages
+    """
+    if not message or not isinstance(message, dict):
+        return None
+    if message.get("type", "") == "subscribe":
+        return None
+    if not message.get("data"):
+        return None
+    return cast(JSONObject, json.loads(cast(bytes, message["data"])))
+
+
+def _fetch_payloads(
+    app: web.Application, datas: list[JSONObject]
+) -> list[JSONObject | None]:
+    """
+    Fetch the payloads referenced by msg_id in one MGET (plus one on the shared
+    redis for those not found); the messages without msg_id are their own payload
+    and the ones published inline come with it
+    """
+    msg_ids = [str(d["msg_id"]) for d in datas if "msg_id" in d and "payload" not in d]
+    raws: dict[str, bytes | None] = {}
+    if msg_ids:
+        raws = dict(zip(msg_ids, app["redis"].mget(msg_ids)))
+        missing = [mid for mid, raw in raws.items() if not raw]
+        if missing and "shared_redis" in app:
+            raws.update(
+                {
+                    mid: raw
+                    for mid, raw in zip(missing, app["shared_redis"].mget(missing))
+                    if raw
+                }
+            )
+    payloads: list[JSONObject | None] = []
+    for data in datas:
+        if "msg_id" not in data:
+            payloads.append(data)
+            continue
+        if "payload" in data:
+            payloads.append(cast(JSONObject, data.pop("payload")))
+            continue
+        raw = raws.get(str(data["msg_id"]))
+        payloads.append(json.loads(raw) if raw else None)
+    return payloads
 
 
 async def _process_message(
@@ -64,27 +127,93 @@ async def _process_message(
     Check that a WS message contains data, and is not a subscribe message,
     then handle it if so.
     """
-    await asyncio.sleep(0.1)
-    if not message or not isinstance(message, dict):
-        return
-    if message.get("type", "") == "subscribe":
-        return
-    if not message.get("data"):
-        return
-    data = json.loads(cast(bytes, message["data"]))
+    data = _decode_message(message)
+    if data is None:
+        return None
+    (payload,) = _fetch_payloads(app, [data])
+    await _process_payload(data, payload, channel, app)
+    return None
+
+
+async def _process_messages(
+    messages: list[RedisMessage], channel: PubSub, app: web.Application
+) -> None:
+    """
+    Handle the messages of a drain cycle: their payloads are fetched at once,
+    then the messages about the same query (or room) are handled in order
+    while the different queries/rooms are handled concurrently (see _process_datas)
+    """
+    datas = [d for d in (_decode_message(m) for m in messages) if d is not None]
+    await _process_datas(datas, channel, app)
+    return None
+
+
+async def _process_datas(
+    datas: list[JSONObject], channel: PubSub | None, app: web.Application
+) -> None:
+    groups: dict[str, list[tuple[JSONObject, JSONObject | None]]] = {}
+    for data, payload in zip(datas, _fetch_payloads(app, datas)):
+        source = payload or data
+        key = str(source.get("hash") or source.get("room") or "")
+        groups.setdefault(key, []).append((data, payload))
+    semaphore = asyncio.Semaphore(PUBSUB_CONCURRENCY)
+
+    async def _process_group(group: list[tuple[JSONObject, JSONObject | None]]):
+        async with semaphore:
+            for data, payload in group:
+                try:
+                    await _process_payload(data, payload, channel, app)
+                except Exception as err:
+                    formed = traceback.format_exc()
+                    print(f"Error while handling a message: {err}\n{formed}")
+
+    async with asyncio.TaskGroup() as group:
+        for messages_group in groups.values():
+            group.create_task(_process_group(messages_group))
+    return None
+
+
+async def _drain(channel: PubSub, timeout: float = 10.0) -> list[RedisMessage]:
+    """
+    Wait for a message, then also take the ones already received
+    (up to PUBSUB_DRAIN_SIZE messages)
+    """
+    message = await channel.get_message(ignore_subscribe_messages=True, timeout=timeout)
+    if message is None:
+        return []
+    messages: list[RedisMessage] = [message]
+    while len(messages) < PUBSUB_DRAIN_SIZE:
+        message = await channel.get_message(ignore_subscribe_messages=True, timeout=0)
+        if message is None:
+            break
+        messages.append(message)
+    return messages
+
+
+async def _process_payload(
+    data: JSONObject,
+    payload: JSONObject | None,
+    channel: PubSub | None,
+    app: web.Application,
+) -> None:
+    """
+    Handle the payload of a pubsub message (None if its msg_id has expired)
+    """
     if "msg_id" in data:
-        raw: bytes = app["redis"].get(data["msg_id"])
-        if not raw and "shared_redis" in app:
-            raw = app["shared_redis"].get(data["msg_id"])
-        if not raw:
+        if not payload:
             return None
-        payload: JSONObject = json.loads(raw)
         if "callback_query" in payload:
             qi_hash: str = str(payload["hash"])
             qi = QueryInfo(qi_hash, app["redis"])
+            rids = cast(list[str] | None, payload.get("requests"))
+            routed = bool(payload.get("routed"))
             async with asyncio.TaskGroup() as group:
                 for req in qi.requests:
-                    group.create_task(req.respond(app, payload))
+                    if rids is not None and req.id not in rids:
+                        continue
+                    if not req.handled_here(app, routed):
+                        continue
+                    group.create_task(req.respond(app, payload, qi))
         if "user" in data or "room" in data:
             # If the incoming data contains fresher information than from redis memory,
             # (as determined by the presence of a user/room in data)
@@ -95,7 +224,7 @@ async def _process_message(
             return
     else:
         payload = data
-    await _handle_message(payload, channel, app)
+    await _handle_message(cast(JSONObject, payload), channel, app)
     return None
 
 
@@ -113,7 +242,6 @@ async def handle_redis_response(
 
     try:
         while True:
-            await asyncio.sleep(0.1)
             try:
                 if app.get("mypy", False) is True:
                     async for message in channel.listen():
@@ -124,14 +252,11 @@ async def handle_redis_response(
                             return None
                 else:
                     while True:
-                        await asyncio.sleep(0.1)
-                        message = await channel.get_message(
-                            ignore_subscribe_messages=True, timeout=10.0
-                        )
-                        if message is None:
+                        messages = await _drain(channel)
+                        if not messages:
                             continue
-                        await _process_message(message, channel, app)
-                        if message and test is True:
+                        await _process_messages(messages, channel, app)
+                        if test is True:
                             return None
             except ConnectionError as err:
                 print("Possibly too much data for redis pubsub?", err)
@@ -162,7 +287,7 @@ async def listen_to_redis(
     while True:
         try:
             async with app[ainstance].pubsub() as channel:
-                await channel.subscribe(PUBSUB_CHANNEL)
+                await channel.subscribe(PUBSUB_CHANNEL, process_channel(PROCESS_ID))
                 await handle_redis_response(channel, app, test=test)
         except ConnectionError as err:
             print("Connection error in listen_to_redis", err)
@@ -172,7 +297,7 @@ async def listen_to_redis(
             raise err
         try:
             print("Attempt unsubscribe")
-            await channel.unsubscribe(PUBSUB_CHANNEL)
+            await channel.unsubscribe(PUBSUB_CHANNEL, process_channel(PROCESS_ID))
             print("unsubscribe success")
         except:
             pass
@@ -188,6 +313,74 @@ async def listen_to_redis(
     return None
 
 
+async def listen_to_stream(app: web.Application, instance: str) -> None:
+    """
+    Read the large messages from the message stream (those for all the web
+    processes and those for this one only), as the consumer of the STREAM_GROUP
+    group of this process. The group remembers what it has read: after
+    a reconnection, the messages added in the meantime are read first, and so
+    are the ones that had been read but not finished handling.
+    The group is deleted when the process stops listening
+    """
+    ainstance = f"a{instance}"
+    if instance not in app or ainstance not in app:
+        return
+    connection = app[ainstance]
+    consumer = STREAM_GROUP
+    while True:
+        try:
+            try:
+                await connection.xgroup_create(
+                    MESSAGE_STREAM, STREAM_GROUP, id="$", mkstream=True
+                )
+            except ResponseError:
+                pass  # the group already exists
+            last_id = "0"  # start with the pending messages of this consumer
+            while True:
+                response = await connection.xreadgroup(
+                    STREAM_GROUP,
+                    consumer,
+                    {MESSAGE_STREAM: last_id},
+                    count=PUBSUB_DRAIN_SIZE,
+                    block=10000,
+                )
+                entries = response[0][1] if response else []
+                if not entries:
+                    last_id = ">"
+                    await asyncio.sleep(0)
+                    continue
+                # skip the messages sent to another process (see _publish_to_process)
+                datas: list[JSONObject] = [
+                    {
+                        "msg_id": fields[b"msg_id"].decode(),
+                        "payload": json.loads(fields[b"payload"]),
+                    }
+                    for _, fields in entries
+                    if fields.get(b"process", b"").decode() in ("", PROCESS_ID)
+                ]
+                if datas:
+                    await _process_datas(datas, None, app)
+                entry_ids = [entry_id for entry_id, _ in entries]
+                await connection.xack(MESSAGE_STREAM, STREAM_GROUP, *entry_ids)
+                if last_id != ">":
+                    last_id = entry_ids[-1]
+        except ConnectionError as err:
+            print("Connection error in listen_to_stream", err)
+            await asyncio.sleep(app["redis_pubsub_limit_sleep"])
+        except asyncio.CancelledError:
+            try:
+                await connection.xgroup_destroy(MESSAGE_STREAM, STREAM_GROUP)
+            except Exception:
+                pass
+            raise
+        except Exception as err:
+            formed = traceback.format_exc()
+            print(f"Error: {str(err)}\n{formed}")
+            extra = {"error": str(err), "status": "failed", "traceback": formed}
+            logging.error(str(err), extra=extra)
+            await asyncio.sleep(1)
+
+
 async def _handle_error(
     app: web.Application, user: str, room: str, payload: JSONObject
 ) -> None:
@@ -204,7 +397,7 @@ async def _handle_error(
 
 
 async def _handle_message(
-    payload: JSONObject, channel: PubSub, app: web.Application
+    payload: JSONObject, channel: PubSub | None, app: web.Application
 ) -> None:
     """
     Build a message, do any extra needed actions and send on to the right websocket(s)
@@ -351,7 +544,7 @@ async def sock(request: web.Request) -> web.WebSocketResponse:
     Socket has to handle incoming messages, but also send a message when
     queries have finished processing
     """
-    ws = web.WebSocketResponse(autoping=True, heartbeat=17)
+    ws = web.WebSocketResponse(autoping=True, heartbeat=17, compress=WEBSOCKET_COMPRESS)
 
     await ws.prepare(request)
 
@@ -369,6 +562,7 @@ async def sock(request: web.Request) -> web.WebSocketResponse:
 
     # connection closed
     # await ws.close(code=WSCloseCode.GOING_AWAY, message=b"Server shutdown")
+    close_socket_writer(ws)
 
     return ws
 
@@ -411,9 +605,12 @@ async def _handle_sock(
 
     # user opens the query page/joins a room
     if action == "joined":
+        set_socket_options(ws, payload)
         originally = len(sockets[session_id])
         sockets[session_id].add((ws, user_id))
         currently = len(sockets[session_id])
+        if originally != currently:
+            register_socket(app["redis"], session_id, 1)
         if session_id and originally != currently:
             response = {"joined": user_id, "room": session_id, "n_users": currently}
             await push_msg(sockets, session_id, response, skip=ident)
@@ -425,6 +622,7 @@ async def _handle_sock(
             sockets[session_id].remove((ws, user_id))
         except KeyError:
             return None
+        register_socket(app["redis"], session_id, -1)
         currently = len(sockets[session_id])
         if not currently:
             qs.cancel_running_jobs(user_id, session_id)
@@ -460,6 +658,37 @@ async def _handle_sock(
         }
         await push_msg(sockets, session_id, response, just=ident)
 
+    # client asks for all the stats of a query, eg. after missing a delta:
+    # its request is deleted once over, so the query is found by its hash
+    elif action == "stats_snapshot":
+        request_id = payload.get("request", "")
+        snapshot_req: Request | None = None
+        if request_id and app["redis"].exists(f"request::{request_id}"):
+            snapshot_req = Request(app["redis"], {"id": request_id})
+        qhash = getattr(snapshot_req, "hash", "") or payload.get("hash", "")
+        snapshot_qi: QueryInfo | None = None
+        if qhash and app["redis"].exists(f"query_info::{qhash}"):
+            snapshot_qi = QueryInfo(qhash, app["redis"])
+        if snapshot_qi is None or not snapshot_qi.can_read_stats(session_id, user_id):
+            response = {
+                "request": request_id,
+                "hash": qhash,
+                "status": "failed",
+                "action": "stats_snapshot",
+                "error": "No such query",
+            }
+            await push_msg(sockets, session_id, response, just=ident)
+            return
+        if snapshot_req is not None:
+            await snapshot_req.send_stats(app, snapshot_qi)
+            return
+        response = snapshot_qi.stats_snapshot()
+        response.update({"user": user_id, "room": session_id, "request": request_id})
+        print(
+            f"[{qhash}] Sending stats snapshot to user '{user_id}' room '{session_id}'"
+        )
+        await push_msg(sockets, session_id, response, just=ident)
+
     # user edited a query, triggering auto-validation of the DQD/JSON
     elif action == "validate":
         payload["config"] = conf
@@ -482,10 +711,11 @@ async def _handle_sock(
             await push_msg(sockets, session_id, response, just=ident)
 
 
-async def ws_cleanup(sockets: Websockets) -> None:
+async def ws_cleanup(sockets: Websockets, connection: Any = None) -> None:
     """
     Periodically remove any closed websocket connections to ensure that app size
-    doesn't irreversibly increase over time
+    doesn't irreversibly increase over time (and keep the registry of the rooms
+    of this process in redis up to date, if a connection is passed)
 
     Send a message to other users about it, too
     """
@@ -501,6 +731,9 @@ async def ws_cleanup(sockets: Websockets) -> None:
                 print(msg)
                 logging.info(msg)
                 conns.remove(conn)
+                close_socket_writer(conn[0])
+            if connection is not None:
+                register_socket(connection, room, -len(to_close))
             n_users = len(conns)
             if not n_users or not to_close:
                 continue
@@ -511,5 +744,6 @@ async def ws_cleanup(sockets: Websockets) -> None:
                     "n_users": n_users,
                 }
                 await push_msg(sockets, room, response)
+        print(f"Websocket queues: {socket_queue_stats()}")
         await asyncio.sleep(interval)
     return None
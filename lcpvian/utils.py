@@ -6,29 +6,36 @@ import asyncio
 import json
 import logging
 import math
+import msgpack
 import numpy as np
 import os
 import re
 import shutil
+import socket
+import time
 import traceback
 import uuid
 
 from dotenv import load_dotenv
 from asyncpg import Connection, Range, Box
 from collections import Counter
-from collections.abc import Awaitable, Callable, Coroutine, Mapping
+from collections.abc import Awaitable, Callable, Coroutine, Iterator, Mapping
+from contextlib import contextmanager
 from datetime import date, datetime
 from hashlib import md5
 from io import BytesIO
 from typing import Any, cast, TypeAlias
 from uuid import uuid4, UUID
+from weakref import WeakKeyDictionary
 from rq.exceptions import NoSuchJobError
 from rq.registry import FinishedJobRegistry
 
-from aiohttp import web
+from aiohttp import WSCloseCode, web
 
 # here we remove __slots__ from these superclasses because mypy can't handle them...
 from redis import Redis as RedisConnection
+from redis.client import Pipeline
+from redis.exceptions import ResponseError
 
 from redis._parsers import _AsyncHiredisParser, _AsyncRESP3Parser  # type: ignore
 
@@ -74,6 +81,14 @@ QUERY_TTL = int(os.getenv("QUERY_TTL", 5000))
 RESULTS_DIR = os.getenv("RESULTS", "results")
 
 PUBSUB_CHANNEL = PUBSUB_CHANNEL_TEMPLATE % "lcpvian"
+# the messages too large to be published inline go to this stream
+MESSAGE_STREAM = f"{PUBSUB_CHANNEL}:stream"
+# max size (in bytes) of the messages published inline
+INLINE_PAYLOAD_SIZE = int(os.getenv("REDIS_INLINE_PAYLOAD_SIZE", 8192))
+# identifies the web process, which also listens to its own channel (process_channel)
+PROCESS_ID = f"{socket.gethostname()}:{os.getpid()}"
+# how long a room stays registered without any socket joining it
+SOCKET_REGISTRY_TTL = int(os.getenv("SOCKET_REGISTRY_TTL", 3600 * 72))
 
 PSQL_NAMEDATALEN = int(os.getenv("PSQL_NAMEDATALEN", 64))
 
@@ -82,6 +97,18 @@ FALSES = {"", "0", "null", "none"}
 
 MESSAGE_TTL = int(os.getenv("REDIS_WS_MESSSAGE_TTL", 5000))
 
+# negotiate permessage-deflate with the clients that support it
+WEBSOCKET_COMPRESS = os.getenv("WEBSOCKET_COMPRESS", "true").lower() in TRUES
+# messages larger than this (bytes) are sent in chunks to the clients accepting them
+WEBSOCKET_CHUNK_SIZE = int(os.getenv("WEBSOCKET_CHUNK_SIZE", 1024 * 1024))
+# actions sent as msgpack binary frames to the clients that joined with format=msgpack
+BINARY_ACTIONS = {"query_result", "segments"}
+WEBSOCKET_FORMATS = ("json", "msgpack")
+# max number of messages waiting to be sent to one socket
+WEBSOCKET_QUEUE_SIZE = int(os.getenv("WEBSOCKET_QUEUE_SIZE", 256))
+# what to do with a socket whose queue is full: "disconnect" it or "drop" the message
+WEBSOCKET_SLOW_POLICY = os.getenv("WEBSOCKET_SLOW_POLICY", "disconnect").lower()
+
 # The query in get_config is complex because we inject the possible values of the global attributes in corpus_template
 CONFIG_SELECT = """
 mc.corpus_id,
@@ -414,9 +441,53 @@ def _get_status(
     return "partial"
 
 
+def _apply_redis_field_op(current: Any, op: str, value: Any) -> Any:
+    """
+    Replay an operation of _diff_redis_field on the stored value of a field
+    """
+    if op == "set":
+        return value
+    if op in ("merge", "unset"):
+        obj: dict[str, Any] = dict(current) if isinstance(current, dict) else {}
+        if op == "merge":
+            obj.update(value)
+        else:
+            for k in value:
+                obj.pop(k, None)
+        return obj
+    items: list[Any] = list(current) if isinstance(current, list) else []
+    if op == "append":
+        seen = {json.dumps(x, sort_keys=True) for x in items}
+        for x in value:
+            encoded = json.dumps(x, sort_keys=True)
+            if encoded not in seen:
+                items.append(x)
+                seen.add(encoded)
+        return items
+    drop = {json.dumps(x, sort_keys=True) for x in value}
+    return [x for x in items if json.dumps(x, sort_keys=True) not in drop]
+
+
 def _get_redis_obj(connection: RedisConnection, key: str) -> dict[str, Any]:
-    obj = json.loads(connection.get(key) or "{}")
-    return obj
+    try:
+        raw = connection.hgetall(key)
+    except ResponseError:
+        # Entry written as a single JSON string by an older version: convert it
+        obj = json.loads(connection.get(key) or "{}")
+        with connection.pipeline() as pipe:
+            pipe.delete(key)
+            if obj:
+                pipe.hset(key, mapping=_encode_redis_fields(obj))
+                pipe.expire(key, MESSAGE_TTL)
+            pipe.execute()
+        return obj
+    return {k.decode(): json.loads(v) for k, v in cast(dict, raw).items()}
+
+
+def _encode_redis_fields(
+    info: dict[str, Any]
+) -> dict[str | bytes, bytes | float | int | str]:
+    return {k: json.dumps(v, cls=CustomEncoder) for k, v in info.items()}
 
 
 def _update_redis_obj(
@@ -424,12 +495,165 @@ def _update_redis_obj(
     key: str,
     info: dict[str, Any] = {},
 ) -> dict[str, Any]:
-    obj = json.loads(connection.get(key) or "{}")
-    for k, v in info.items():
-        obj[k] = v
-    connection.set(key, json.dumps(obj, cls=CustomEncoder))
-    connection.expire(key, MESSAGE_TTL)
-    return obj
+    if not info:
+        return info
+    with connection.pipeline() as pipe:
+        pipe.hset(key, mapping=_encode_redis_fields(info))
+        pipe.expire(key, MESSAGE_TTL)
+        pipe.execute()
+    return info
+
+
+def _diff_redis_field(old: Any, new: Any) -> list[tuple[str, Any]]:
+    """
+    Express the change of a field as a list of (operation, value) pairs
+    that can be replayed on a fresher copy of the object
+    """
+    if isinstance(old, dict) and isinstance(new, dict):
+        ops: list[tuple[str, Any]] = []
+        merged = {k: v for k, v in new.items() if k not in old or old[k] != v}
+        unset = [k for k in old if k not in new]
+        if merged:
+            ops.append(("merge", merged))
+        if unset:
+            ops.append(("unset", unset))
+        return ops
+    if isinstance(old, list) and isinstance(new, list):
+        if new[: len(old)] == old:
+            return [("append", new[len(old) :])] if len(new) > len(old) else []
+        removed = [x for x in old if x not in new]
+        if removed and new == [x for x in old if x not in removed]:
+            return [("remove", removed)]
+    return [] if old == new else [("set", new)]
+
+
+class RedisRecord:
+    """
+    Local copy of an object stored in redis (query_info::*, request::*)
+    as a hash with one JSON value per field
+
+    The object is fetched once, on first access. Changes are tracked per field
+    and written back by flush(): plain assignments become an HSET of that field,
+    changes to dicts and lists become merge/unset/append/remove operations
+    replayed on the stored value of the field under WATCH, so the cost of a write
+    depends on the field and concurrent writers do not overwrite each other's
+    keys or items.
+
+    Writes are flushed right away, unless they happen inside deferred()
+    """
+
+    def __init__(
+        self,
+        connection: RedisConnection,
+        key: str,
+        data: dict[str, Any] | None = None,
+    ) -> None:
+        self._connection = connection
+        self.key = key
+        self._data: dict[str, Any] | None = None
+        self._loaded: dict[str, Any] = {}
+        self._dirty: set[str] = set()
+        self._deferred: int = 0
+        self._deleted: bool = False
+        if data is not None:
+            self._reset(data)
+
+    def _reset(self, data: dict[str, Any]) -> None:
+        self._data = data
+        self._loaded = json.loads(json.dumps(data, cls=CustomEncoder))
+        self._dirty = set()
+
+    @property
+    def data(self) -> dict[str, Any]:
+        if self._data is None:
+            self.load()
+        return cast(dict[str, Any], self._data)
+
+    def load(self) -> dict[str, Any]:
+        """
+        (Re)load the object from redis, discarding any unflushed change
+        """
+        self._reset(_get_redis_obj(self._connection, self.key))
+        return cast(dict[str, Any], self._data)
+
+    def refresh(self) -> dict[str, Any]:
+        """
+        Write any pending change, then fetch the latest version of the object
+        """
+        self.flush()
+        return self.load()
+
+    def get(self, field: str, default: Any = None) -> Any:
+        return self.data.get(field, default)
+
+    def set(self, field: str, value: Any) -> None:
+        self.data[field] = json.loads(json.dumps(value, cls=CustomEncoder))
+        self._dirty.add(field)
+        if not self._deferred:
+            self.flush()
+
+    @contextmanager
+    def deferred(self) -> Iterator["RedisRecord"]:
+        """
+        Accumulate the changes made within the block and flush them once at the end
+        """
+        self._deferred += 1
+        try:
+            yield self
+        finally:
+            self._deferred -= 1
+            if not self._deferred:
+                self.flush()
+
+    def delete(self) -> None:
+        """
+        Remove the object from redis and ignore any further change
+        """
+        self._deleted = True
+        self._dirty = set()
+        self._connection.delete(self.key)
+
+    def flush(self) -> None:
+        if self._deleted or not self._dirty or self._data is None:
+            return
+        data: dict[str, Any] = self._data
+        dirty, self._dirty = self._dirty, set()
+        ops: dict[str, list[tuple[str, Any]]] = {}
+        for field in dirty:
+            field_ops = _diff_redis_field(self._loaded.get(field), data.get(field))
+            if field_ops:
+                ops[field] = field_ops
+        if not ops:
+            return
+        replayed = [f for f, o in ops.items() if any(op != "set" for op, _ in o)]
+        merged: dict[str, Any] = {}
+
+        def _write(pipe: Pipeline) -> None:
+            # the pipeline runs the commands right away until multi()
+            values = cast(list, pipe.hmget(self.key, replayed)) if replayed else []
+            stored = dict(zip(replayed, values))
+            merged.clear()
+            for field, field_ops in ops.items():
+                raw = stored.get(field)
+                value = json.loads(raw) if raw else None
+                for op, change in field_ops:
+                    value = _apply_redis_field_op(value, op, change)
+                merged[field] = value
+            pipe.multi()
+            pipe.hset(self.key, mapping=_encode_redis_fields(merged))
+            pipe.expire(self.key, MESSAGE_TTL)
+
+        if replayed:
+            # retried if another writer changes the entry in the meantime
+            self._connection.transaction(_write, self.key)
+        else:
+            # plain assignments do not depend on the stored values
+            with self._connection.pipeline() as pipe:
+                _write(pipe)
+                pipe.execute()
+        for field, value in merged.items():
+            data[field] = value
+            self._loaded[field] = json.loads(json.dumps(value))
 
 
 def _get_query_info(
@@ -516,6 +740,182 @@ async def gather(
         raise err
 
 
+# format and chunking accepted by each socket, as announced when joining a room
+_SOCKET_OPTIONS: "WeakKeyDictionary[web.WebSocketResponse, tuple[str, bool]]" = (
+    WeakKeyDictionary()
+)
+
+
+def set_socket_options(ws: web.WebSocketResponse, payload: JSONObject) -> None:
+    """
+    Remember the format ("json" or "msgpack") of the large messages
+    and whether chunked messages are accepted by this socket
+    """
+    fmt = str(payload.get("format") or "json").lower()
+    if fmt not in WEBSOCKET_FORMATS:
+        fmt = "json"
+    _SOCKET_OPTIONS[ws] = (fmt, bool(payload.get("chunks", False)))
+
+
+def _encode_ws_msg(msg: JSONObject, fmt: str) -> str | bytes:
+    if fmt == "msgpack":
+        # imported here: cache imports CustomEncoder from this module
+        from .cache import _msgpack_default
+
+        return msgpack.packb(msg, default=_msgpack_default, use_bin_type=True)
+    return json.dumps(msg)
+
+
+def _chunk_ws_msg(encoded: str | bytes, size: int) -> list[str | bytes]:
+    """
+    Split an encoded message into frames of about `size` bytes:
+    each frame is a "chunk" message of the same type (text or binary),
+    the client joins the data of the chunks sharing a chunk_id and decodes it
+    """
+    if len(encoded) <= size:
+        return [encoded]
+    chunk_id = str(uuid4())
+    total = math.ceil(len(encoded) / size)
+    frames: list[str | bytes] = []
+    for index in range(total):
+        chunk: dict[str, Any] = {
+            "action": "chunk",
+            "chunk_id": chunk_id,
+            "index": index,
+            "total": total,
+            "data": encoded[index * size : (index + 1) * size],
+        }
+        frames.append(
+            msgpack.packb(chunk, use_bin_type=True)
+            if isinstance(encoded, bytes)
+            else json.dumps(chunk)
+        )
+    return frames
+
+
+async def _ws_frames(msg: JSONObject, fmt: str, chunks: bool) -> list[str | bytes]:
+    """
+    Encode a message for the sockets accepting fmt/chunks; the large
+    result payloads are encoded in a thread so other rooms are not kept waiting
+    """
+    if msg.get("action") in BINARY_ACTIONS:
+        encoded = await asyncio.to_thread(_encode_ws_msg, msg, fmt)
+    else:
+        encoded = _encode_ws_msg(msg, fmt)
+    if not chunks:
+        return [encoded]
+    return _chunk_ws_msg(encoded, WEBSOCKET_CHUNK_SIZE)
+
+
+class SocketWriter:
+    """
+    Bounded queue of the messages to send to one websocket, written by its
+    own task so that a slow client only delays its own messages
+
+    When the queue is full, the message is dropped and, unless
+    WEBSOCKET_SLOW_POLICY is "drop", the socket is closed: the client
+    reconnects rather than silently missing results
+    """
+
+    # in this process: messages dropped and sockets closed for being too slow
+    total_dropped: int = 0
+    disconnected: int = 0
+
+    def __init__(self, ws: web.WebSocketResponse) -> None:
+        self.ws = ws
+        self.queue: asyncio.Queue[list[str | bytes]] = asyncio.Queue(
+            maxsize=WEBSOCKET_QUEUE_SIZE
+        )
+        self.sent: int = 0
+        self.dropped: int = 0
+        self.max_depth: int = 0
+        self.closing: asyncio.Task | None = None
+        self.task = asyncio.create_task(self._write())
+
+    def put(self, frames: list[str | bytes]) -> bool:
+        """
+        Queue the frames of a message without waiting, False if they were dropped
+        """
+        try:
+            self.queue.put_nowait(frames)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            SocketWriter.total_dropped += 1
+            print(
+                f"Websocket queue full ({self.queue.qsize()} messages), "
+                f"{self.dropped} dropped, policy: {WEBSOCKET_SLOW_POLICY}"
+            )
+            if WEBSOCKET_SLOW_POLICY != "drop":
+                self.disconnect()
+            return False
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+        return True
+
+    def disconnect(self) -> None:
+        close_socket_writer(self.ws)
+        SocketWriter.disconnected += 1
+        self.closing = asyncio.create_task(
+            self.ws.close(code=WSCloseCode.TRY_AGAIN_LATER, message=b"Too slow")
+        )
+
+    async def _write(self) -> None:
+        while not self.ws.closed:
+            frames = await self.queue.get()
+            try:
+                for n, frame in enumerate(frames):
+                    if n:
+                        await asyncio.sleep(0)
+                    if isinstance(frame, bytes):
+                        await self.ws.send_bytes(frame)
+                    else:
+                        await self.ws.send_str(frame)
+                self.sent += 1
+            except Exception as err:
+                # the socket is unusable: close it and stop queueing messages for it
+                print(f"Error while sending a websocket message: {err!r}")
+                self.closing = asyncio.create_task(
+                    self.ws.close(code=WSCloseCode.INTERNAL_ERROR)
+                )
+                close_socket_writer(self.ws)
+                break
+            finally:
+                self.queue.task_done()
+
+
+_SOCKET_WRITERS: dict[web.WebSocketResponse, SocketWriter] = {}
+
+
+def _socket_writer(ws: web.WebSocketResponse) -> SocketWriter:
+    writer = _SOCKET_WRITERS.get(ws)
+    if writer is None or writer.task.done():
+        writer = _SOCKET_WRITERS[ws] = SocketWriter(ws)
+    return writer
+
+
+def close_socket_writer(ws: web.WebSocketResponse) -> None:
+    """
+    Stop the writer task of a socket that is closed or leaving
+    """
+    writer = _SOCKET_WRITERS.pop(ws, None)
+    if writer is not None:
+        writer.task.cancel()
+
+
+def socket_queue_stats() -> dict[str, int]:
+    """
+    Backpressure of the websockets of this process
+    """
+    writers = list(_SOCKET_WRITERS.values())
+    return {
+        "sockets": len(writers),
+        "queued": sum(w.queue.qsize() for w in writers),
+        "max_depth": max((w.max_depth for w in writers), default=0),
+        "sent": sum(w.sent for w in writers),
+        "dropped": SocketWriter.total_dropped,
+        "disconnected": SocketWriter.disconnected,
+    }
+
+
 async def push_msg(
     sockets: Websockets,
     session_id: str,
@@ -527,8 +927,18 @@ async def push_msg(
     Send JSON websocket message to one or more users/rooms
 
     A message can be sent to all users by passing an empty string as session_id
+
+    The message is encoded once for each format/chunking used by the recipients:
+    query results and segments go as msgpack binary frames to the sockets
+    that joined with format=msgpack, and large messages are sent in chunks
+    to the sockets that joined with chunks=true
+
+    The frames are only queued here (see SocketWriter), so a slow client
+    does not hold up the other recipients
     """
     sent_to: set[tuple[str | None, str]] = set()
+    encoded: dict[tuple[str, bool], list[str | bytes]] = {}
+    binary = isinstance(msg, dict) and msg.get("action") in BINARY_ACTIONS
     for room, users in sockets.items():
         if session_id and room != session_id:
             continue
@@ -539,14 +949,18 @@ async def push_msg(
                 continue
             if just and (room, user_id) != just:
                 continue
-            try:
-                if isinstance(msg, bytes):
-                    await conn.send_bytes(msg)
-                else:
-                    await conn.send_json(msg)
-            except ConnectionResetError:
-                print(f"Connection reset: {room}/{user_id}")
-                pass
+            if conn.closed:
+                print(f"Connection closed: {room}/{user_id}")
+                continue
+            if isinstance(msg, bytes):
+                frames: list[str | bytes] = [msg]
+            else:
+                fmt, chunks = _SOCKET_OPTIONS.get(conn, ("json", False))
+                key = (fmt if binary else "json", chunks)
+                if key not in encoded:
+                    encoded[key] = await _ws_frames(msg, *key)
+                frames = encoded[key]
+            _socket_writer(conn).put(frames)
             sent_to.add((room, user_id))
 
 
@@ -1127,16 +1541,99 @@ def _publish_msg(
     connection: "RedisConnection[bytes]", message: JSONObject | str | bytes, msg_id: str
 ) -> None:
     """
-    Store a message with msg_id as key, and notify listener
+    Notify the listeners of the web app about a message: messages up to
+    INLINE_PAYLOAD_SIZE bytes are published along with their msg_id,
+    larger ones are added to MESSAGE_STREAM, where they are kept for
+    MESSAGE_TTL seconds so that a web process can read the ones it missed
+    (and the ID of their stream entry is kept under msg_id, see get_message)
     """
     if not isinstance(message, (str, bytes)):
         message = json.dumps(message, cls=CustomEncoder)
-    connection.set(msg_id, message)
-    connection.expire(msg_id, MESSAGE_TTL)
-    connection.publish(PUBSUB_CHANNEL, json.dumps({"msg_id": msg_id}))
+    if isinstance(message, bytes):
+        message = message.decode("utf-8")
+    if len(message) <= INLINE_PAYLOAD_SIZE:
+        data = f'{{"msg_id": {json.dumps(msg_id)}, "payload": {message}}}'
+        connection.publish(PUBSUB_CHANNEL, data)
+        return None
+    _add_to_stream(connection, message, msg_id)
     return None
 
 
+def _add_to_stream(
+    connection: "RedisConnection[bytes]",
+    message: str,
+    msg_id: str,
+    process_id: str = "",
+) -> None:
+    """
+    Add a large message to MESSAGE_STREAM, for the web process process_id only
+    if given (see sock.listen_to_stream), and keep the ID of its entry under msg_id
+    """
+    fields: dict[str | bytes, str] = {"msg_id": msg_id, "payload": message}
+    if process_id:
+        fields["process"] = process_id
+    min_id = int((time.time() - MESSAGE_TTL) * 1000)
+    entry_id = connection.xadd(
+        MESSAGE_STREAM, fields, minid=str(min_id), approximate=True
+    )
+    connection.set(msg_id, entry_id, ex=MESSAGE_TTL)
+
+
+def process_channel(process_id: str) -> str:
+    """
+    The channel on which a web process receives the messages meant for it only
+    """
+    return f"{PUBSUB_CHANNEL}:{process_id}"
+
+
+def _publish_to_process(
+    connection: "RedisConnection[bytes]", message: JSONObject, process_id: str
+) -> bool:
+    """
+    Send a message to a web process only: on its channel if it is up to
+    INLINE_PAYLOAD_SIZE bytes, to MESSAGE_STREAM otherwise, like _publish_msg
+    Return False if no process is listening to it (eg. it has stopped)
+    """
+    msg_id = str(uuid4())
+    payload = json.dumps(message, cls=CustomEncoder)
+    channel = process_channel(process_id)
+    if len(payload) <= INLINE_PAYLOAD_SIZE:
+        data = f'{{"msg_id": {json.dumps(msg_id)}, "payload": {payload}}}'
+        return bool(connection.publish(channel, data))
+    ((_, listening),) = connection.pubsub_numsub(channel)
+    if not listening:
+        return False
+    _add_to_stream(connection, payload, msg_id, process_id)
+    return True
+
+
+def _room_key(room: str) -> str:
+    return f"websockets::{room}"
+
+
+def register_socket(connection: "RedisConnection[bytes]", room: str, n: int) -> None:
+    """
+    Record that this process holds n more (or fewer) sockets for the room
+    """
+    if not room:
+        return
+    key = _room_key(room)
+    with connection.pipeline(transaction=False) as pipe:
+        pipe.hincrby(key, PROCESS_ID, n)
+        pipe.expire(key, SOCKET_REGISTRY_TTL)
+        count, _ = pipe.execute()
+    if count <= 0:
+        connection.hdel(key, PROCESS_ID)
+
+
+def socket_processes(connection: "RedisConnection[bytes]", room: str) -> list[str]:
+    """
+    The web processes that hold sockets for the room
+    """
+    registered = cast(dict, connection.hgetall(_room_key(room)))
+    return [k.decode() for k, v in registered.items() if int(v) > 0]
+
+
 def hasher(arg):
     str_arg = json.dumps(arg)
     return md5(str_arg.encode("utf-8")).digest().hex()
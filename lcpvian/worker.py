@@ -21,24 +21,41 @@ resources on the deployment server.
 from __future__ import annotations
 
 import asyncio
+import inspect
+import json
 import logging
 import os
+import signal
+import sys
+import traceback
 import urllib.parse
 
-from typing import Any
+from contextvars import ContextVar
+from datetime import timedelta
+from typing import Any, Callable, cast
+from uuid import uuid4
 
 import uvloop
 
+import rq.job
+
 from redis import Redis
+from rq.command import parse_payload
 from rq.connections import Connection
+from rq.exceptions import DequeueTimeout
 from rq.job import Job
-from rq.worker import Worker
-from sqlalchemy.ext.asyncio import create_async_engine
+from rq.queue import Queue
+from rq.suspension import is_suspended
+from rq.timeouts import BaseDeathPenalty, JobTimeoutException
+from rq.utils import utcnow
+from rq.worker import SimpleWorker, Worker, WorkerStatus
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
 from sqlalchemy.pool import NullPool
 
 from sshtunnel import SSHTunnelForwarder
 
-from .utils import load_env
+from .jobfuncs import POOL_WAITS
+from .utils import load_env, TRUES
 
 load_env()
 
@@ -87,6 +104,21 @@ UPLOAD_TIMEOUT = int(os.getenv("UPLOAD_TIMEOUT", 43200))
 
 PORT = int(os.getenv("SQL_PORT", 25432))
 
+# run each job in a forked process, as rq does by default: the DB engines
+# and their connections then only last as long as the job
+WORKER_FORK = os.getenv("WORKER_FORK", "false").strip().lower() in TRUES
+# run up to this many jobs at the same time in each worker process
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", 1))
+
+# prepared statements kept per connection of the query pool, keyed by their SQL
+# (so by compiled query and batch): repeated queries are neither parsed nor,
+# when they have no parameters or get a generic plan, planned again
+QUERY_STATEMENT_CACHE_SIZE = int(os.getenv("QUERY_STATEMENT_CACHE_SIZE", 100))
+# force_generic_plan, force_custom_plan or auto (empty: the server's setting)
+QUERY_PLAN_CACHE_MODE = os.getenv("QUERY_PLAN_CACHE_MODE", "").strip()
+# connections go through pgbouncer: give prepared statements unique names
+SQL_PGBOUNCER = os.getenv("SQL_PGBOUNCER", "false").strip().lower() in TRUES
+
 REDIS_DB_INDEX = int(os.getenv("REDIS_DB_INDEX", 0))
 REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
 redis_url: str = f"{REDIS_URL}/{REDIS_DB_INDEX}" if REDIS_DB_INDEX > -1 else REDIS_URL
@@ -117,14 +149,29 @@ query_connstr = (
 web_connstr = f"postgresql+asyncpg://{WEB_USER}:{WEB_PASSWORD}@{HOST}:{PORT}/{DBNAME}"
 
 
+def _statement_name() -> str:
+    """
+    Unique names, so that pgbouncer never hands a statement prepared by one
+    client connection to another one (needs max_prepared_statements in
+    pgbouncer >= 1.21, or QUERY_STATEMENT_CACHE_SIZE=0 with older versions)
+    """
+    return f"__asyncpg_{uuid4()}__"
+
+
+query_connect_args: dict[str, Any] = {
+    "timeout": QUERY_TIMEOUT,
+    "statement_cache_size": QUERY_STATEMENT_CACHE_SIZE,
+    "prepared_statement_cache_size": QUERY_STATEMENT_CACHE_SIZE,
+    "server_settings": {"jit": "off"},
+}
+if QUERY_PLAN_CACHE_MODE:
+    query_connect_args["server_settings"]["plan_cache_mode"] = QUERY_PLAN_CACHE_MODE
+if SQL_PGBOUNCER:
+    query_connect_args["prepared_statement_name_func"] = _statement_name
+
 query_kwargs = dict(
     pool_size=QUERY_MAX_NUM_CONNS,
-    connect_args={
-        "timeout": QUERY_TIMEOUT,
-        "statement_cache_size": 0,
-        "prepared_statement_cache_size": 0,
-        "server_settings": {"jit": "off"},
-    },
+    connect_args=query_connect_args,
     echo_pool=True,
     pool_recycle=3600,
     pool_timeout=3600,
@@ -145,33 +192,404 @@ upload_kwargs = dict(
     isolation_level="READ COMMITTED",
 )
 if not UPLOAD_POOL:
-    upload_kwargs["pool_class"] = NullPool  # type: ignore
+    upload_kwargs.pop("pool_size")
+    upload_kwargs.pop("pool_timeout")
+    upload_kwargs["poolclass"] = NullPool  # type: ignore
+
+
+# process-level DB engines, created on first use and shared by all the jobs
+_ENGINES: dict[str, AsyncEngine] = {}
+# the event loop the async jobs run in (the engines' connections belong to it)
+_LOOP: asyncio.AbstractEventLoop | None = None
+# job id -> task of the async job running in _event_loop (see SQLJob._execute)
+_TASKS: dict[str, asyncio.Task] = {}
+
+
+def _engine(name: str) -> AsyncEngine:
+    if name not in _ENGINES:
+        connstr, kwargs = {
+            "_pool": (query_connstr, query_kwargs),
+            "_upool": (upload_connstr, upload_kwargs),
+            "_wpool": (web_connstr, upload_kwargs),
+        }[name]
+        _ENGINES[name] = create_async_engine(connstr, **kwargs)
+    return _ENGINES[name]
+
+
+def _event_loop() -> asyncio.AbstractEventLoop:
+    global _LOOP
+    if _LOOP is None or _LOOP.is_closed():
+        concurrent = WORKER_CONCURRENCY > 1
+        _LOOP = uvloop.new_event_loop() if concurrent else asyncio.new_event_loop()
+    return _LOOP
+
+
+class _TaskJobStack:
+    """
+    The stack of the jobs being performed, which rq.job.get_current_job reads,
+    kept per asyncio task rather than per thread, so that each of the jobs
+    run concurrently by ConcurrentWorker gets its own job
+    """
+
+    def __init__(self) -> None:
+        self._jobs: ContextVar[tuple[Job, ...]] = ContextVar("rq_jobs", default=())
+
+    def push(self, job: Job) -> None:
+        self._jobs.set((*self._jobs.get(), job))
+
+    def pop(self) -> Job | None:
+        jobs = self._jobs.get()
+        if not jobs:
+            return None
+        self._jobs.set(jobs[:-1])
+        return jobs[-1]
+
+    @property
+    def top(self) -> Job | None:
+        jobs = self._jobs.get()
+        return jobs[-1] if jobs else None
+
+
+if WORKER_CONCURRENCY > 1:
+    rq.job._job_stack = _TaskJobStack()  # type: ignore
+
+
+class _NoDeathPenalty(BaseDeathPenalty):
+    """
+    The callbacks of concurrent jobs cannot be timed out with a signal
+    (which would interrupt the whole event loop): they run without a timeout
+    """
+
+    def setup_death_penalty(self) -> None:
+        pass
+
+    def cancel_death_penalty(self) -> None:
+        pass
+
+
+def pool_stats() -> dict[str, dict[str, int | float]]:
+    """
+    The state of the DB pools of this process: their size, the connections
+    checked out and in overflow, and how long the jobs waited to get one
+    """
+    stats: dict[str, dict[str, int | float]] = {}
+    for name, engine in _ENGINES.items():
+        pool = engine.pool
+        waits = POOL_WAITS.get(name, {})
+        taken = int(waits.get("taken", 0))
+        stats[name] = {
+            "size": getattr(pool, "size", lambda: 0)(),
+            "checked_out": getattr(pool, "checkedout", lambda: 0)(),
+            "overflow": max(0, getattr(pool, "overflow", lambda: 0)()),
+            "taken": taken,
+            "mean_wait_ms": 1000 * waits.get("wait", 0.0) / taken if taken else 0.0,
+            "max_wait_ms": 1000 * waits.get("max_wait", 0.0),
+        }
+    return stats
 
 
 class SQLJob(Job):
+    """
+    The DB engines of the jobs are those of the process, and async jobs all
+    run in the same event loop, so that the connections of the pools are reused
+    """
+
+    @property
+    def _pool(self) -> AsyncEngine:
+        return _engine("_pool")
+
+    @property
+    def _upool(self) -> AsyncEngine:
+        return _engine("_upool")
+
+    @property
+    def _wpool(self) -> AsyncEngine:
+        return _engine("_wpool")
+
+    def _execute(self) -> Any:
+        """
+        Run async jobs as a task of the event loop, which a stop-job command
+        cancels (see MyWorker.kill_horse). If the job is interrupted instead,
+        by the job timeout (SIGALRM), the tasks it left pending are cancelled
+        so that they release their DB connections
+        """
+        result = self.func(*self.args, **self.kwargs)
+        if not asyncio.iscoroutine(result):
+            return result
+        loop = _event_loop()
+        task = loop.create_task(result)
+        _TASKS[self.id] = task
+        try:
+            return loop.run_until_complete(task)
+        finally:
+            _TASKS.pop(self.id, None)
+            if not task.done():
+                pending = asyncio.all_tasks(loop)
+                for pending_task in pending:
+                    pending_task.cancel()
+                loop.run_until_complete(
+                    asyncio.gather(*pending, return_exceptions=True)
+                )
+
+    async def perform_async(self) -> Any:
+        """
+        Like perform, as a task of the event loop (see ConcurrentWorker):
+        the functions that are not async run in a thread
+        """
+        self.connection.persist(self.key)
+        rq.job._job_stack.push(self)
+        result: Any = None
+        try:
+            if inspect.iscoroutinefunction(self.func):
+                result = await self.func(*self.args, **self.kwargs)
+            else:
+                func = cast(Callable[..., Any], self.func)
+                result = await asyncio.to_thread(func, *self.args, **self.kwargs)
+        finally:
+            rq.job._job_stack.pop()
+        self._result = result
+        return result
+
+
+class MyWorker(Worker if WORKER_FORK else SimpleWorker):  # type: ignore
     def __init__(self, *args: Any, **kwargs: Any) -> None:
-        super().__init__(*args)
-        self._pool = create_async_engine(query_connstr, **query_kwargs)
-        self._upool = create_async_engine(upload_connstr, **upload_kwargs)
-        self._wpool = create_async_engine(web_connstr, **upload_kwargs)
+        kwargs["job_class"] = SQLJob
+        super().__init__(*args, **kwargs)
 
+    def heartbeat(self, timeout: int | None = None, pipeline: Any = None) -> None:
+        """
+        Also store the state of the DB pools along with the worker in redis
+        (under rq:worker:<name>:pools)
+        """
+        super().heartbeat(timeout, pipeline)
+        stats = pool_stats()
+        if not stats:
+            return
+        connection = pipeline if pipeline is not None else self.connection
+        key = f"{self.key}:pools"
+        connection.set(key, json.dumps(stats), ex=timeout or self.worker_ttl + 60)
+
+    def kill_horse(self, sig: signal.Signals = signal.SIGKILL) -> None:
+        """
+        Without forking (WORKER_FORK=false) the job runs in the worker process:
+        rather than killing the process, stop the job by cancelling its task
+        (the jobs that are not async cannot be stopped)
+        """
+        if self.horse_pid:
+            super().kill_horse(sig)
+            return
+        task = _TASKS.get(self.get_current_job_id() or "")
+        if task is None:
+            self.log.warning("No async job to stop")
+            return
+        _event_loop().call_soon_threadsafe(task.cancel)
+
+
+class ConcurrentWorker(MyWorker):
+    """
+    Run up to WORKER_CONCURRENCY jobs at the same time, as tasks of the event
+    loop of the process, all sharing the DB engines
+
+    Each job goes through the same steps as in rq's perform_job: it is marked
+    as started, its success or failure callback is run, then its result or
+    failure is recorded. The job timeout is enforced with asyncio.timeout
+    rather than a signal, and a stop-job command (send_stop_job_command)
+    cancels the task of the job, which is then marked as stopped
+    """
 
-class MyWorker(Worker):
     def __init__(self, *args: Any, **kwargs: Any) -> None:
-        kwargs["job_class"] = SQLJob
         super().__init__(*args, **kwargs)
+        self.concurrency = max(1, WORKER_CONCURRENCY)
+        self._tasks: dict[str, asyncio.Task] = {}
+
+    def work(self, burst: bool = False, logging_level: str = "INFO", **_: Any) -> bool:
+        return _event_loop().run_until_complete(self._work(burst, logging_level))
+
+    async def _work(self, burst: bool, logging_level: str) -> bool:
+        self.bootstrap(logging_level)
+        self._install_signal_handlers()
+        started = 0
+        try:
+            while not self._stop_requested:
+                # not check_for_suspension, which blocks the loop with time.sleep:
+                # the running jobs go on while no new job is taken
+                if is_suspended(self.connection, self):
+                    if burst:
+                        self.log.info("Suspended in burst mode, exiting")
+                        break
+                    if self.get_state() != WorkerStatus.SUSPENDED:
+                        self.log.info("Worker suspended, run `rq resume` to resume")
+                        self.set_state(WorkerStatus.SUSPENDED)
+                    await asyncio.sleep(1)
+                    continue
+                if self.should_run_maintenance_tasks:
+                    self.run_maintenance_tasks()
+                self.heartbeat()
+                busy = WorkerStatus.BUSY if self._tasks else WorkerStatus.IDLE
+                if self.get_state() != busy:
+                    self.set_state(busy)
+                if len(self._tasks) >= self.concurrency:
+                    tasks = list(self._tasks.values())
+                    await asyncio.wait(tasks, timeout=1, return_when="FIRST_COMPLETED")
+                    continue
+                result = await asyncio.to_thread(self._dequeue, None if burst else 1)
+                if result is None:
+                    if burst and not self._tasks:
+                        break
+                    if burst:
+                        await asyncio.sleep(0.1)
+                    continue
+                job, queue = result
+                self.log.info("%s: %s", queue.name, job.id)
+                task = self._perform(cast(SQLJob, job), queue)
+                self._tasks[job.id] = asyncio.create_task(task)
+                started += 1
+        finally:
+            if self._tasks:
+                await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+            self.teardown()
+        return bool(started)
+
+    def _dequeue(self, timeout: int | None) -> tuple[Job, Queue] | None:
+        try:
+            result = self.queue_class.dequeue_any(
+                self._ordered_queues,
+                timeout,
+                connection=self.connection,
+                job_class=self.job_class,
+                serializer=self.serializer,
+                death_penalty_class=self.death_penalty_class,
+            )
+        except DequeueTimeout:
+            return None
+        if result is not None:
+            job, queue = result
+            self.reorder_queues(reference_queue=queue)
+            job.redis_server_version = self.get_redis_server_version()
+        return result
+
+    async def _job_heartbeat(self, job: SQLJob) -> None:
+        """
+        Renew the heartbeat of a running job, as the work horse monitor does
+        in rq: otherwise the job drops out of its StartedJobRegistry once
+        the first heartbeat expires, and is marked as abandoned
+        """
+        ttl = self.job_monitoring_interval + 60
+        while True:
+            await asyncio.sleep(self.job_monitoring_interval)
+            job.heartbeat(utcnow(), ttl, xx=True)
+
+    async def _perform(self, job: SQLJob, queue: Queue) -> None:
+        started_job_registry = queue.started_job_registry
+        heartbeat = asyncio.create_task(self._job_heartbeat(job))
+        try:
+            self.prepare_job_execution(job, len(self.queues) == 1)
+            job.started_at = utcnow()
+            timeout = job.timeout or self.queue_class.DEFAULT_TIMEOUT
+            try:
+                async with asyncio.timeout(timeout if timeout > 0 else None):
+                    result = await job.perform_async()
+            except TimeoutError:
+                raise JobTimeoutException(
+                    f"Task exceeded maximum timeout value ({timeout} seconds)"
+                )
+            job.ended_at = utcnow()
+            job._result = result
+            job.heartbeat(utcnow(), job.success_callback_timeout)
+            job.execute_success_callback(_NoDeathPenalty, result)
+            self.handle_job_success(
+                job=job, queue=queue, started_job_registry=started_job_registry
+            )
+        except asyncio.CancelledError:
+            job.ended_at = utcnow()
+            self.log.warning("Job %s stopped by user", job.id)
+            self._stopped_job_id = job.id
+            if job.stopped_callback:
+                job.execute_stopped_callback(_NoDeathPenalty)
+            self.handle_job_failure(
+                job, queue=queue, exc_string="Job stopped by user, task cancelled."
+            )
+        except Exception:
+            job.ended_at = utcnow()
+            exc_info = sys.exc_info()
+            exc_string = "".join(traceback.format_exception(*exc_info))
+            try:
+                job.heartbeat(utcnow(), job.failure_callback_timeout)
+                job.execute_failure_callback(_NoDeathPenalty, *exc_info)
+            except Exception:
+                exc_info = sys.exc_info()
+                exc_string = "".join(traceback.format_exception(*exc_info))
+            self.handle_job_failure(
+                job=job,
+                exc_string=exc_string,
+                queue=queue,
+                started_job_registry=started_job_registry,
+            )
+            self.handle_exception(job, *exc_info)
+        finally:
+            heartbeat.cancel()
+            self._tasks.pop(job.id, None)
+
+    def handle_payload(self, message: dict) -> None:
+        """
+        Stop-job commands cancel the task of the job (called from the thread
+        listening to the commands of the worker)
+        """
+        payload = parse_payload(message)
+        if payload.get("command") != "stop-job":
+            return super().handle_payload(message)
+        job_id = payload.get("job_id", "")
+        task = self._tasks.get(job_id)
+        if task is None:
+            self.log.info("Not working on job %s, command ignored.", job_id)
+            return
+        self.log.info("Stopping job %s", job_id)
+        _event_loop().call_soon_threadsafe(task.cancel)
+
+    def kill_horse(self, sig: signal.Signals = signal.SIGKILL) -> None:
+        """
+        There is no horse to kill: cancel the tasks of all the running jobs
+        (kill-horse command), which are then marked as stopped
+        """
+        for task in list(self._tasks.values()):
+            _event_loop().call_soon_threadsafe(task.cancel)
+
+    def request_force_stop(self, signum: int, frame: Any) -> None:
+        """
+        Cold shutdown: stop taking jobs and cancel the running ones
+        """
+        if (utcnow() - self._shutdown_requested_date) < timedelta(seconds=1):
+            return
+        self.log.warning("Cold shut down")
+        self._stop_requested = True
+        self.kill_horse()
+
+    def _shutdown(self) -> None:
+        """
+        Warm shutdown: stop taking jobs and wait for the running ones
+        """
+        self._stop_requested = True
+
+
+def _work() -> None:
+    with Connection(redis_conn):
+        queues = ["internal", "query", "background", "prefetch"]
+        w = ConcurrentWorker(queues) if WORKER_CONCURRENCY > 1 else MyWorker(queues)
+        w.work()
 
 
 async def work() -> None:
-    with Connection(redis_conn):
-        w = MyWorker(["internal", "query", "background"])
-        w.work()
+    _work()
 
 
 def start_worker() -> None:
     try:
-        with asyncio.Runner(loop_factory=uvloop.new_event_loop) as runner:
-            runner.run(work())
+        if WORKER_FORK and WORKER_CONCURRENCY <= 1:
+            with asyncio.Runner(loop_factory=uvloop.new_event_loop) as runner:
+                runner.run(work())
+        else:
+            # the async jobs run in _event_loop: no other loop can be running
+            _work()
     except KeyboardInterrupt:
         print("Worker stopped.")
 
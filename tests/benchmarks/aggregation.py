@@ -0,0 +1,113 @@
+"""
+Time the aggregation of frequency tables over batches (lcpvian/query_classes.py):
+each batch added to the stats hashes in redis by QueryInfo.run_aggregate, then
+the stats read back by the clients, as a full snapshot or as the delta of the
+last batch, with the filters on the result
+
+Needs a redis server (REDIS_URL, redis://localhost:6379 by default)
+
+    python -m tests.benchmarks.aggregation [n_rows ...]
+"""
+
+import asyncio
+import os
+import random
+import sys
+import time
+
+from uuid import uuid4
+
+from redis import Redis
+
+from lcpvian.query_classes import QueryInfo
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
+
+N_BATCHES = 10
+
+META = {
+    "result_sets": [
+        {"type": "plain", "name": "kwic"},
+        {
+            "type": "analysis",
+            "name": "freq",
+            "attributes": [
+                {"name": "lemma", "type": "token.lemma"},
+                {"name": "upos", "type": "token.upos"},
+                {"name": "frequency", "type": "aggregate"},
+            ],
+        },
+    ]
+}
+
+POST = {2: [{"comparison": {"entity": "frequency", "operator": ">", "value": "10"}}]}
+
+
+def synthetic_batches(n_rows: int, seed: int = 1) -> list[list]:
+    """
+    N_BATCHES batches of n_rows // N_BATCHES frequency rows each,
+    about half of the keys of a batch being seen in an earlier batch
+    """
+    rnd = random.Random(seed)
+    per_batch = max(1, n_rows // N_BATCHES)
+    batches: list[list] = []
+    for n in range(N_BATCHES):
+        keys = rnd.sample(range((n + 2) * per_batch // 2), per_batch)
+        rows: list = [[0, [per_batch]], [1, [f"s{n}", [1]]]]
+        rows += [[2, [f"lemma{k}", "NOUN", rnd.randint(1, 20)]] for k in keys]
+        batches.append(rows)
+    return batches
+
+
+def aggregate(
+    connection: Redis, batches: list[list]
+) -> tuple[float, float, float, int]:
+    """
+    Aggregate all the batches, return the total time of the aggregation,
+    of reading a snapshot and of reading the last delta in ms,
+    and the number of rows in the snapshot
+    """
+    qhash = f"benchmark-{uuid4()}"
+    config = {"_batches": {f"batch{n}": 100 for n in range(len(batches))}}
+    qi = QueryInfo(
+        qhash, connection, meta_json=META, post_processes=POST, config=config
+    )
+    try:
+        aggregate_ms = 0.0
+        for n, rows in enumerate(batches):
+            name = f"{qhash}::batch{n}"
+            qi.query_batches[name] = (name, qi.set_batch_results(name, rows))
+            batch = [name, len(rows)]
+            start = time.perf_counter()
+            asyncio.run(qi.run_aggregate(0, batch))
+            aggregate_ms += (time.perf_counter() - start) * 1000
+            qi.done_batches.append(batch)
+        start = time.perf_counter()
+        version, snapshot, _ = qi.get_stats()
+        snapshot_ms = (time.perf_counter() - start) * 1000
+        start = time.perf_counter()
+        qi.get_stats(since=version - 1)
+        delta_ms = (time.perf_counter() - start) * 1000
+    finally:
+        keys = list(connection.scan_iter(f"{qhash}*"))
+        connection.delete(f"query_info::{qhash}", *keys)
+    return aggregate_ms, snapshot_ms, delta_ms, len(snapshot["2"])
+
+
+def main(sizes: list[int]) -> None:
+    connection = Redis.from_url(REDIS_URL)
+    print(
+        f"{'rows':>10}{'kept':>10}{'aggregate (ms)':>16}"
+        f"{'snapshot (ms)':>15}{'delta (ms)':>12}"
+    )
+    for n_rows in sizes:
+        batches = synthetic_batches(n_rows)
+        aggregate_ms, snapshot_ms, delta_ms, kept = aggregate(connection, batches)
+        print(
+            f"{n_rows:>10}{kept:>10}{aggregate_ms:>16.1f}"
+            f"{snapshot_ms:>15.1f}{delta_ms:>12.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main([int(a) for a in sys.argv[1:]] or [10_000, 100_000, 1_000_000])
@@ -0,0 +1,47 @@
+"""
+Compare the size and the (de)serialization time of the formats
+available for the results cache (lcpvian/cache.py)
+
+    python -m tests.benchmarks.cache_format [n_lines ...]
+"""
+
+import sys
+
+from lcpvian import cache
+
+from .common import synthetic_results, synthetic_segments, test_queries, timeit
+
+VARIANTS: list[tuple[str, str, bool]] = [
+    ("json", "json", False),
+    ("json+zstd", "json", True),
+    ("msgpack", "msgpack", False),
+    ("msgpack+zstd", "msgpack", True),
+]
+
+
+def bench(label: str, rows: list) -> None:
+    print(f"\n{label}")
+    print(f"{'format':<14}{'size (KB)':>12}{'dumps (ms)':>12}{'loads (ms)':>12}")
+    for name, fmt, compress in VARIANTS:
+        if compress and cache.zstandard is None:
+            continue
+        raw = cache.dumps(rows, fmt=fmt, compress=compress)
+        assert cache.loads(raw) == cache.loads(cache.dumps(rows, fmt="json"))
+        dump_ms = timeit(lambda: cache.dumps(rows, fmt=fmt, compress=compress))
+        load_ms = timeit(lambda: cache.loads(raw))
+        print(f"{name:<14}{len(raw) / 1024:>12.1f}{dump_ms:>12.2f}{load_ms:>12.2f}")
+
+
+def main(sizes: list[int]) -> None:
+    for n_lines in sizes:
+        for name, _, meta_json in test_queries():
+            rows = synthetic_results(meta_json, n_lines)
+            bench(f"Query {name}: batch results, {n_lines} KWIC lines", rows)
+        bench(
+            f"Segments+meta, {n_lines} segments",
+            synthetic_segments(n_lines),
+        )
+
+
+if __name__ == "__main__":
+    main([int(a) for a in sys.argv[1:]] or [1000, 10000, 100000])
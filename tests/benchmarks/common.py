@@ -0,0 +1,112 @@
+"""
+Helpers shared by the benchmarks: build synthetic query results
+shaped like the results of the queries in tests/test_data
+"""
+
+import json
+import os
+import random
+import time
+import uuid
+
+from collections.abc import Callable, Iterator
+from typing import Any
+
+from lcpvian.abstract_query.create import json_to_sql
+from lcpvian.dqd_parser import convert as dqd_to_json
+from lcpvian.utils import _determine_language
+
+TEST_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "test_data")
+
+LEMMAS = [f"lemma{n}" for n in range(2000)]
+
+
+def test_queries() -> Iterator[tuple[str, dict, dict]]:
+    """
+    Yield the name, the corpus config and the meta_json of each test query
+    """
+    names = sorted(
+        {
+            os.path.splitext(i)[0]
+            for i in os.listdir(TEST_DIR)
+            if os.path.splitext(i)[0].isnumeric()
+        }
+    )
+    for name in names:
+        base = os.path.join(TEST_DIR, name)
+        with open(f"{base}.meta") as meta_file:
+            meta = json.load(meta_file)
+        with open(f"{base}.dqd") as dqd_file:
+            dqd = dqd_file.read().strip() + "\n"
+        json_query = dqd_to_json(dqd, meta)
+        _, meta_json, _ = json_to_sql(
+            json_query,
+            schema=meta["schema"],
+            batch=meta["batch"],
+            config=meta,
+            lang=_determine_language(meta["batch"]) or "",
+        )
+        yield name, meta, meta_json
+
+
+def _entity(entity: dict, rnd: random.Random) -> Any:
+    if entity.get("multiple"):
+        return [rnd.randint(1, 10**8) for _ in range(rnd.randint(1, 4))]
+    return rnd.randint(1, 10**8)
+
+
+def synthetic_results(meta_json: dict, n_lines: int, seed: int = 1) -> list:
+    """
+    Rows as returned by the main query of a batch: [rstype, line]
+    with n_lines lines for each KWIC result set, and one line per lemma
+    for the other result sets
+    """
+    rnd = random.Random(seed)
+    rows: list = [[0, [n_lines]]]
+    for n, result_set in enumerate(meta_json.get("result_sets", []), start=1):
+        if result_set.get("type") == "plain":
+            entities = next(
+                (
+                    a["data"]
+                    for a in result_set["attributes"]
+                    if a["name"] == "entities"
+                ),
+                [],
+            )
+            for _ in range(n_lines):
+                sid = str(uuid.UUID(int=rnd.getrandbits(128)))
+                rows.append([n, [sid, [_entity(e, rnd) for e in entities]]])
+        else:
+            for lemma in LEMMAS[: max(1, n_lines // 10)]:
+                rows.append([n, [lemma, rnd.randint(1, 1000)]])
+    return rows
+
+
+def synthetic_segments(n_segments: int, seed: int = 1) -> list:
+    """
+    Rows as returned by the segment+meta query: prepared segments and their meta
+    """
+    rnd = random.Random(seed)
+    rows: list = []
+    for _ in range(n_segments):
+        sid = str(uuid.UUID(int=rnd.getrandbits(128)))
+        offset = rnd.randint(1, 10**8)
+        tokens = [
+            [rnd.choice(LEMMAS), rnd.choice(LEMMAS), "NOUN", "_"]
+            for _ in range(rnd.randint(5, 40))
+        ]
+        rows.append([-1, [sid, offset, tokens]])
+        rows.append([-2, [sid, [offset, offset + len(tokens)], {"year": 2000}]])
+    return rows
+
+
+def timeit(fn: Callable[[], Any], repeat: int = 5) -> float:
+    """
+    Best wall time of fn in milliseconds
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
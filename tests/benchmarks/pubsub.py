@@ -0,0 +1,113 @@
+"""
+Throughput of the redis listener of the web app (lcpvian/sock.py),
+in messages per second: the listener that drains the channel, with
+the payloads published inline (utils._publish_msg) or stored under their msg_id
+and fetched with one MGET per cycle, compared with handling the messages
+one at a time like the listener used to (two 100 ms sleeps and one GET each)
+
+Needs a redis server (REDIS_URL, redis://localhost:6379 by default)
+
+    python -m tests.benchmarks.pubsub [n_messages ...]
+"""
+
+import asyncio
+import json
+import os
+import sys
+import time
+
+from typing import Any
+from uuid import uuid4
+
+from redis import Redis
+from redis import asyncio as aioredis
+
+from lcpvian import sock
+from lcpvian.utils import MESSAGE_TTL, PUBSUB_CHANNEL, _publish_msg
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
+
+# the legacy listener handles 5 messages per second at best: only time a few
+LEGACY_MESSAGES = 20
+
+
+def connect() -> tuple[Redis, aioredis.Redis]:
+    return Redis.from_url(REDIS_URL), aioredis.Redis.from_url(REDIS_URL)
+
+
+def _stored_publish(redis: Redis, message: dict, msg_id: str) -> None:
+    """
+    How messages used to be published: stored under msg_id, which is published
+    """
+    redis.set(msg_id, json.dumps(message))
+    redis.expire(msg_id, MESSAGE_TTL)
+    redis.publish(PUBSUB_CHANNEL, json.dumps({"msg_id": msg_id}))
+
+
+async def _legacy_cycle(channel: Any, app: dict) -> None:
+    await asyncio.sleep(0.1)
+    message = await channel.get_message(ignore_subscribe_messages=True, timeout=1.0)
+    await asyncio.sleep(0.1)
+    data = sock._decode_message(message)
+    if data is None:
+        return
+    raw = app["redis"].get(data["msg_id"])
+    await sock._process_payload(data, json.loads(raw) if raw else None, channel, app)
+
+
+async def throughput(n_messages: int, mode: str = "inline") -> float:
+    """
+    Publish n_messages status updates, then time how long the listener takes
+    to hand them all to _handle_message (mode: inline, stored or legacy)
+    """
+    publish = _publish_msg if mode == "inline" else _stored_publish
+    redis, aredis = connect()
+    app: dict = {"redis": redis}
+    handled = 0
+
+    async def count(payload: Any, channel: Any, app: Any) -> None:
+        nonlocal handled
+        handled += 1
+
+    handle_message = sock._handle_message
+    sock._handle_message = count
+    try:
+        async with aredis.pubsub() as channel:
+            await channel.subscribe(PUBSUB_CHANNEL)
+            await channel.get_message(timeout=1.0)  # subscribe confirmation
+            for n in range(n_messages):
+                payload = {
+                    "action": "background_job_progress",
+                    "room": f"room{n % 16}",
+                    "user": "benchmark",
+                    "n": n,
+                }
+                publish(redis, payload, msg_id=f"benchmark::{uuid4()}")
+            start = time.perf_counter()
+            while handled < n_messages:
+                if mode == "legacy":
+                    await _legacy_cycle(channel, app)
+                    continue
+                messages = await sock._drain(channel, timeout=1.0)
+                await sock._process_messages(messages, channel, app)
+            elapsed = time.perf_counter() - start
+            await channel.unsubscribe(PUBSUB_CHANNEL)
+    finally:
+        sock._handle_message = handle_message
+        await aredis.aclose()
+        redis.close()
+    return n_messages / elapsed
+
+
+def main(sizes: list[int]) -> None:
+    print(f"{'listener':<10}{'messages':>10}{'msg/s':>12}")
+    legacy = asyncio.run(throughput(LEGACY_MESSAGES, mode="legacy"))
+    print(f"{'legacy':<10}{LEGACY_MESSAGES:>10}{legacy:>12.1f}")
+    for n_messages in sizes:
+        for mode in ("stored", "inline"):
+            rate = asyncio.run(throughput(n_messages, mode=mode))
+            print(f"{mode:<10}{n_messages:>10}{rate:>12.1f}")
+
+
+if __name__ == "__main__":
+    main([int(a) for a in sys.argv[1:]] or [1000, 10000])
@@ -0,0 +1,144 @@
+"""
+Batch results cache (lcpvian/query_classes.py): KWIC lines stored in chunks,
+the other lines apart, and the lines of batches cut by a LIMIT
+
+Needs a redis server (REDIS_URL, redis://localhost:6379 by default)
+"""
+
+import os
+import unittest
+
+from unittest.mock import patch
+from uuid import uuid4
+
+from redis import Redis
+
+from lcpvian import query_classes
+from lcpvian.query_classes import BatchResultsWriter, QueryInfo
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
+
+META_JSON = {
+    "result_sets": [
+        {"type": "plain", "name": "kwic1"},
+        {"type": "plain", "name": "kwic2"},
+        {"type": "analysis", "name": "freq"},
+    ]
+}
+
+CONFIG = {"_batches": {"token1": 100, "tokenrest": 1000}}
+
+
+def kwic(rstype: int, n: int) -> list:
+    return [[rstype, [f"sid{rstype}-{i}", [i]]] for i in range(n)]
+
+
+class BatchCacheTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.connection = Redis.from_url(REDIS_URL)
+        self.qhash = f"test-{uuid4()}"
+        self.batch_hash = f"test-batch-{uuid4()}"
+        self.qi = QueryInfo(
+            self.qhash, self.connection, meta_json=META_JSON, config=CONFIG
+        )
+        for name, value in (("RESULTS_CHUNK_SIZE", 3), ("STREAM_ROWS", 2)):
+            patcher = patch.object(query_classes, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self) -> None:
+        chunks_key, segments_key = QueryInfo._batch_keys(self.batch_hash)
+        self.connection.delete(
+            self.batch_hash, chunks_key, segments_key, f"query_info::{self.qhash}"
+        )
+        self.connection.close()
+
+    def test_chunks(self):
+        rows = [[0, [7]], *kwic(1, 4), *kwic(2, 3), [3, ["lemma", 2]]]
+        n_lines = self.qi.set_batch_results(self.batch_hash, rows)
+        self.assertEqual(n_lines, 7)
+        index = self.qi.get_batch_index(self.batch_hash)
+        self.assertEqual(index["n_chunks"], 3)
+        self.assertEqual(index["counts"], {"1": 4, "2": 3})
+        self.assertEqual(self.qi.get_batch_lines(self.batch_hash), rows[1:8])
+        self.assertEqual(self.qi.get_batch_lines(self.batch_hash, 2, 5), rows[3:6])
+        self.assertEqual(
+            list(self.qi.get_batch_segment_ids(self.batch_hash, 3, 6)),
+            ["sid1-3", "sid2-0", "sid2-1"],
+        )
+        self.assertEqual(
+            self.qi.get_batch_rest(self.batch_hash), [[0, [7]], [3, ["lemma", 2]]]
+        )
+
+    def test_limited(self):
+        """
+        Each result set is cut by the LIMIT: the lines of the second one
+        are numbered after all the lines of the first one
+        """
+        rows = [*kwic(1, 2), *kwic(2, 2)]
+        n_lines = self.qi.set_batch_results(
+            self.batch_hash, rows, limit=2, total_counts={"1": 10, "2": 5}
+        )
+        self.assertEqual(n_lines, 15)
+        self.qi.query_batches = {"batch1": (self.batch_hash, n_lines)}
+        self.assertTrue(self.qi.batch_in_cache("batch1", 2))
+        self.assertFalse(self.qi.batch_in_cache("batch1", 3))
+        self.assertFalse(self.qi.batch_in_cache("batch1"))
+        self.assertEqual(self.qi.get_batch_lines(self.batch_hash, 0, 2), rows[:2])
+        # the uncached lines of the first result set cannot be read
+        self.assertEqual(self.qi.get_batch_lines(self.batch_hash, 2, 10), [])
+        self.assertEqual(self.qi.get_batch_lines(self.batch_hash, 10, 12), rows[2:])
+        self.assertEqual(self.qi.get_batch_lines(self.batch_hash, 1, 11), rows[1:3])
+        self.assertEqual(self.qi.get_batch_lines(self.batch_hash), rows)
+        self.assertEqual(
+            list(self.qi.get_batch_segment_ids(self.batch_hash, 0, 11)),
+            ["sid1-0", "sid1-1", "sid2-0"],
+        )
+
+    def test_writer(self):
+        """
+        The lines are written as they come, the other lines by parts
+        """
+        rows = [*kwic(1, 4), [3, ["a", 1]], *kwic(2, 3), [3, ["b", 1]], [3, ["c", 1]]]
+        writer = BatchResultsWriter(self.connection, self.batch_hash, ["1", "2"])
+        self.addCleanup(self.connection.delete, writer.chunks_key, writer.segments_key)
+        writer.add(rows[:5])
+        self.assertEqual((writer.n_chunks, writer.n_rest), (1, 0))
+        writer.add(rows[5:9])
+        self.assertEqual((writer.n_chunks, writer.n_rest), (2, 1))
+        writer.add(rows[9:])
+        self.assertEqual((writer.n_chunks, writer.n_rest), (2, 1))
+        self.assertFalse(self.connection.exists(self.batch_hash))
+        self.assertEqual(writer.finish(), 7)
+        self.assertEqual(self.qi.get_batch_index(self.batch_hash)["rest_parts"], 2)
+        self.assertEqual(self.qi.get_batch_lines(self.batch_hash), rows[:4] + rows[5:8])
+        self.assertEqual(
+            self.qi.get_batch_rest(self.batch_hash),
+            [[3, ["a", 1]], [3, ["b", 1]], [3, ["c", 1]]],
+        )
+        self.assertFalse(self.connection.exists(writer.chunks_key))
+
+    def test_failed_writer(self):
+        """
+        The entry of a batch stays in the cache until a new one is complete
+        """
+        rows = [*kwic(1, 4), [3, ["a", 1]]]
+        self.qi.set_batch_results(self.batch_hash, rows)
+        writer = BatchResultsWriter(self.connection, self.batch_hash, ["1"])
+        self.addCleanup(self.connection.delete, writer.chunks_key, writer.segments_key)
+        writer.add(kwic(1, 7))
+        # the stream fails here: finish is never called
+        self.assertEqual(self.qi.get_batch_lines(self.batch_hash), rows[:4])
+        self.assertEqual(self.qi.get_batch_rest(self.batch_hash), [[3, ["a", 1]]])
+        # a new entry with fewer lines replaces all the chunks of the old one
+        self.qi.set_batch_results(self.batch_hash, kwic(1, 2))
+        chunks_key, segments_key = QueryInfo._batch_keys(self.batch_hash)
+        self.assertEqual(self.connection.hkeys(chunks_key), [b"0", b"rest"])
+        self.assertEqual(self.qi.get_batch_lines(self.batch_hash), kwic(1, 2))
+        self.qi.set_batch_results(self.batch_hash, [[3, ["b", 1]]])
+        self.assertFalse(self.connection.exists(segments_key))
+        self.assertEqual(self.qi.get_batch_lines(self.batch_hash), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
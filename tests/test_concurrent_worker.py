@@ -0,0 +1,151 @@
+"""
+Jobs run concurrently as tasks of the event loop (lcpvian/worker.py):
+ConcurrentWorker in burst mode, on queues of its own
+
+Needs a redis server (REDIS_URL, redis://localhost:6379 by default)
+"""
+
+import asyncio
+import os
+import threading
+import time
+import unittest
+
+from uuid import uuid4
+
+from redis import Redis
+from rq import Callback
+from rq.command import send_stop_job_command
+from rq.job import JobStatus
+from rq.queue import Queue
+
+# the DB engines are only created by the jobs that use them
+for name in ("UPLOAD", "QUERY", "WEB"):
+    os.environ.setdefault(f"SQL_{name}_USERNAME", "test")
+    os.environ.setdefault(f"SQL_{name}_PASSWORD", "test")
+os.environ.setdefault("SQL_HOST", "localhost")
+os.environ.setdefault("SQL_DATABASE", "test")
+
+from lcpvian.worker import ConcurrentWorker, SQLJob
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
+
+
+async def sleep_job(seconds: float) -> tuple[float, float]:
+    start = time.time()
+    await asyncio.sleep(seconds)
+    return start, time.time()
+
+
+def failing_job() -> None:
+    raise ValueError("failing job")
+
+
+def on_success(job, connection, result) -> None:
+    connection.rpush(f"{job.key.decode()}:test_callbacks", "success")
+
+
+def on_failure(job, connection, exc_type, exc_value, traceback) -> None:
+    connection.rpush(f"{job.key.decode()}:test_callbacks", exc_type.__name__)
+
+
+def on_stopped(job, connection) -> None:
+    connection.rpush(f"{job.key.decode()}:test_callbacks", "stopped")
+
+
+class ConcurrentWorkerTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.connection = Redis.from_url(REDIS_URL)
+        self.queue = Queue(
+            f"test-{uuid4()}", connection=self.connection, job_class=SQLJob
+        )
+        self.worker = ConcurrentWorker([self.queue], connection=self.connection)
+        self.worker.concurrency = 3
+
+    def tearDown(self) -> None:
+        for job_id in self.queue.get_job_ids():
+            self.queue.remove(job_id)
+        for registry in (
+            self.queue.finished_job_registry,
+            self.queue.failed_job_registry,
+            self.queue.canceled_job_registry,
+        ):
+            for job_id in registry.get_job_ids():
+                self.connection.delete(
+                    f"rq:job:{job_id}", f"rq:job:{job_id}:test_callbacks"
+                )
+                registry.remove(job_id)
+        self.queue.delete()
+        self.connection.close()
+
+    def enqueue(self, func, *args, **kwargs) -> SQLJob:
+        return self.queue.enqueue(
+            func,
+            *args,
+            on_success=Callback(on_success),
+            on_failure=Callback(on_failure),
+            on_stopped=Callback(on_stopped),
+            **kwargs,
+        )
+
+    def callbacks(self, job: SQLJob) -> list[str]:
+        key = f"{job.key.decode()}:test_callbacks"
+        return [c.decode() for c in self.connection.lrange(key, 0, -1)]
+
+    def test_concurrent(self):
+        jobs = [self.enqueue(sleep_job, 0.5) for _ in range(3)]
+        start = time.time()
+        self.assertTrue(self.worker.work(burst=True))
+        self.assertLess(time.time() - start, 1.4)
+        times = []
+        for job in jobs:
+            job.refresh()
+            self.assertEqual(job.get_status(), JobStatus.FINISHED)
+            self.assertEqual(self.callbacks(job), ["success"])
+            times.append(job.return_value())
+        # every job started before the others were over
+        self.assertLess(max(t[0] for t in times), min(t[1] for t in times))
+
+    def test_failure(self):
+        job = self.enqueue(failing_job)
+        self.worker.work(burst=True)
+        self.assertEqual(job.get_status(), JobStatus.FAILED)
+        self.assertEqual(self.callbacks(job), ["ValueError"])
+        self.assertIn("failing job", job.latest_result().exc_string)
+
+    def test_timeout(self):
+        job = self.enqueue(sleep_job, 5, job_timeout=1)
+        other = self.enqueue(sleep_job, 0.1)
+        start = time.time()
+        self.worker.work(burst=True)
+        self.assertLess(time.time() - start, 4)
+        self.assertEqual(job.get_status(), JobStatus.FAILED)
+        self.assertEqual(self.callbacks(job), ["JobTimeoutException"])
+        self.assertEqual(other.get_status(), JobStatus.FINISHED)
+
+    def test_stop(self):
+        """
+        A stop-job command cancels the task of the job, the other jobs go on
+        """
+        job = self.enqueue(sleep_job, 5)
+        other = self.enqueue(sleep_job, 0.5)
+
+        def stop() -> None:
+            while job.get_status() != JobStatus.STARTED:
+                time.sleep(0.05)
+            send_stop_job_command(self.connection, job.id)
+
+        thread = threading.Thread(target=stop)
+        thread.start()
+        start = time.time()
+        self.worker.work(burst=True)
+        thread.join()
+        self.assertLess(time.time() - start, 4)
+        self.assertEqual(job.get_status(), JobStatus.STOPPED)
+        self.assertEqual(self.callbacks(job), ["stopped"])
+        self.assertEqual(other.get_status(), JobStatus.FINISHED)
+        self.assertEqual(self.callbacks(other), ["success"])
+
+
+if __name__ == "__main__":
+    unittest.main()
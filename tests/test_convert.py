@@ -0,0 +1,129 @@
+"""
+Aggregation of the stats results over batches (lcpvian/convert.py)
+"""
+
+import json
+import unittest
+
+import numpy as np
+
+from lcpvian.convert import (
+    Aggregation,
+    AggregationState,
+    _make_filters,
+    _merge_batch,
+    _merge_stats_deltas,
+)
+
+META_JSON = {
+    "result_sets": [
+        {"type": "plain", "name": "kwic"},
+        {
+            "type": "analysis",
+            "name": "freq",
+            "attributes": [
+                {"name": "lemma", "type": "token.lemma"},
+                {"name": "frequency", "type": "aggregate"},
+            ],
+        },
+        {
+            "type": "collocation",
+            "name": "coll",
+            "attributes": [
+                {"name": "text", "type": "token.form"},
+                {"name": "frequency", "type": "aggregate"},
+                {"name": "E", "type": "aggregate"},
+            ],
+        },
+    ]
+}
+
+# as returned by json_to_sql: "frequency > 2" on the second result set
+POST_PROCESSES = {
+    2: [{"comparison": {"entity": "frequency", "operator": ">", "value": "2"}}]
+}
+
+
+class AggregationTestCase(unittest.TestCase):
+    def test_merge(self):
+        agg = Aggregation()
+        agg.merge([("a",), ("b",)], [[1, 10], [2, 20]])
+        agg.merge([("b",), ("c",), ("b",)], [[3, 30], [4, 40], [1, 1]])
+        self.assertEqual(len(agg), 3)
+        self.assertEqual(agg.rows(), [["a", 1, 10], ["b", 6, 51], ["c", 4, 40]])
+
+    def test_merge_collocation(self):
+        agg = Aggregation(collocation=True)
+        agg.merge(["x", "y"], [[2], [3]], [1.0, 2.0])
+        # E of the second batch weighs 1 against 3 for the batches before
+        agg.merge(["x"], [[1]], [5.0], (1, 3))
+        self.assertEqual(agg.rows(), [["x", 3, 2.0], ["y", 3, 2.0]])
+
+    def test_filters(self):
+        agg = Aggregation()
+        agg.merge([("a",), ("b",), ("c",)], [[1], [5], [3]])
+        filters = _make_filters(POST_PROCESSES)[2]
+        self.assertEqual(agg.select(agg.rows(), filters), [["b", 5], ["c", 3]])
+        self.assertEqual(agg.mask(filters).tolist(), [False, True, True])
+
+    def test_top(self):
+        agg = Aggregation()
+        agg.merge([("a",), ("b",), ("c",), ("d",)], [[2], [5], [2], [1]])
+        self.assertEqual(agg.top(3).tolist(), [1, 0, 2])
+        filters = [("frequency", "<", 5)]
+        self.assertEqual(agg.top(2, filters).tolist(), [0, 2])
+
+    def test_prune(self):
+        agg = Aggregation()
+        agg.merge([("a",), ("b",), ("c",), ("d",)], [[2, 1], [5, 1], [3, 1], [1, 1]])
+        self.assertEqual(agg.prune(4), 0)
+        self.assertEqual(agg.prune(2), 2)
+        self.assertEqual(agg.keys, [("b",), ("c",)])
+        self.assertEqual(agg.index, {("b",): 0, ("c",): 1})
+        self.assertTrue(np.array_equal(agg.counts, [[5, 1], [3, 1]]))
+        agg.merge([("a",)], [[1, 1]])
+        self.assertEqual(agg.rows(), [["b", 5, 1], ["c", 3, 1], ["a", 1, 1]])
+
+
+class FiltersTestCase(unittest.TestCase):
+    def test_make_filters(self):
+        expected = {2: [("frequency", ">", 2)]}
+        self.assertEqual(_make_filters(POST_PROCESSES), expected)
+        # post_processes are stored as JSON, which turns their keys into strings
+        stored = json.loads(json.dumps(POST_PROCESSES))
+        self.assertEqual(_make_filters(stored), expected)
+        decimal = {"2": [{"comparison": {**stored["2"][0]["comparison"]}}]}
+        decimal["2"][0]["comparison"]["value"] = "2.5"
+        self.assertEqual(_make_filters(decimal), {2: [("frequency", ">", 2.5)]})
+
+    def test_merge_batch(self):
+        """
+        The stats rows of consecutive batches go to one aggregation per result set
+        """
+        filters = _make_filters(json.loads(json.dumps(POST_PROCESSES)))
+        batch1 = [[0, [10]], [1, ["sid", [1]]], [2, ["a", 2]], [2, ["b", 1]]]
+        batch2 = [[0, [5]], [2, ["a", 1]], [2, ["b", 1]], [3, ["x", 1, 0.5]]]
+        done = [("batch1", 100)]
+        state: AggregationState = {}
+        self.assertEqual(_merge_batch(state, batch1, META_JSON, done[0], done), 10)
+        self.assertEqual(set(state), {2})
+        self.assertEqual(state[2].select(state[2].rows(), filters[2]), [])
+        done.append(("batch2", 100))
+        self.assertEqual(_merge_batch(state, batch2, META_JSON, done[1], done), 5)
+        self.assertEqual(state[2].rows(), [["a", 3], ["b", 2]])
+        self.assertEqual(state[2].select(state[2].rows(), filters[2]), [["a", 3]])
+        # weighed against the first batch, of the same size, which had no "x"
+        self.assertEqual(state[3].rows(), [["x", 1, 0.25]])
+
+    def test_merge_stats_deltas(self):
+        deltas = [
+            {"changed": {"2": [["a", 1], ["b", 1]]}},
+            {"changed": {"2": [["a", 3]]}, "removed": {"2": [["b"]]}},
+        ]
+        changed, removed = _merge_stats_deltas(deltas, META_JSON)
+        self.assertEqual(changed, {"2": [["a", 3]]})
+        self.assertEqual(removed, {"2": [["b"]]})
+
+
+if __name__ == "__main__":
+    unittest.main()
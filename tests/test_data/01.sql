@@ -49,7 +49,8 @@ WITH RECURSIVE fixed_parts AS
                res1 AS
   (SELECT DISTINCT 1::int2 AS rstype,
                    jsonb_build_array(s, jsonb_build_array(t1, t2, t3))
-   FROM match_list) ,
+   FROM match_list
+   ORDER BY 2) ,
                res2 AS
   (SELECT 2::int2 AS rstype,
           jsonb_build_array(t3_lemma, frequency)
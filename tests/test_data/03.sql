@@ -101,7 +101,8 @@ SET ordercol ,
     res1 AS
   (SELECT DISTINCT 1::int2 AS rstype,
                    jsonb_build_array(s, jsonb_build_array(seq))
-   FROM match_list) ,
+   FROM match_list
+   ORDER BY 2) ,
     res0 AS
   (SELECT 0::int2 AS rstype,
           jsonb_build_array(count(match_list.*))
@@ -50,7 +50,8 @@ WITH RECURSIVE fixed_parts AS
                res1 AS
   (SELECT DISTINCT 1::int2 AS rstype,
                    jsonb_build_array(s, jsonb_build_array(tv, disjunction_matches))
-   FROM match_list) ,
+   FROM match_list
+   ORDER BY 2) ,
                res0 AS
   (SELECT 0::int2 AS rstype,
           jsonb_build_array(count(match_list.*))
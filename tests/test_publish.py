@@ -0,0 +1,81 @@
+"""
+Messages sent to the web processes (lcpvian/utils.py): published inline
+on a pubsub channel when small, added to the message stream when large
+
+Needs a redis server (REDIS_URL, redis://localhost:6379 by default)
+"""
+
+import json
+import os
+import unittest
+
+from uuid import uuid4
+
+from redis import Redis
+
+from lcpvian.utils import (
+    INLINE_PAYLOAD_SIZE,
+    MESSAGE_STREAM,
+    _publish_to_process,
+    process_channel,
+)
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
+
+
+class PublishToProcessTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.connection = Redis.from_url(REDIS_URL)
+        self.process_id = f"test:{uuid4()}"
+        self.pubsub = self.connection.pubsub(ignore_subscribe_messages=True)
+        self.pubsub.subscribe(process_channel(self.process_id))
+        self.pubsub.get_message(timeout=1)
+
+    def tearDown(self) -> None:
+        self.pubsub.close()
+        self.connection.close()
+
+    def stream_entries(self) -> list[dict]:
+        entries = self.connection.xrange(MESSAGE_STREAM)
+        return [
+            {k.decode(): v.decode() for k, v in fields.items()}
+            for _, fields in entries
+            if fields.get(b"process", b"").decode() == self.process_id
+        ]
+
+    def test_small(self):
+        message = {"callback_query": True, "hash": "qhash", "result": [1, 2]}
+        self.assertTrue(_publish_to_process(self.connection, message, self.process_id))
+        received = self.pubsub.get_message(timeout=1)
+        self.assertIsNotNone(received)
+        self.assertEqual(json.loads(received["data"])["payload"], message)
+        self.assertEqual(self.stream_entries(), [])
+
+    def test_large(self):
+        """
+        Large messages go to the stream for this process, with only its ID kept
+        """
+        lines = ["x" * 100] * (INLINE_PAYLOAD_SIZE // 100 + 1)
+        message = {"callback_query": True, "hash": "qhash", "result": lines}
+        self.assertTrue(_publish_to_process(self.connection, message, self.process_id))
+        self.assertIsNone(self.pubsub.get_message(timeout=0.1))
+        (entry,) = self.stream_entries()
+        self.assertEqual(json.loads(entry["payload"]), message)
+        entry_id = self.connection.get(entry["msg_id"])
+        self.assertEqual(
+            len(self.connection.xrange(MESSAGE_STREAM, entry_id, entry_id)), 1
+        )
+        self.connection.xdel(MESSAGE_STREAM, entry_id)
+        self.connection.delete(entry["msg_id"])
+
+    def test_no_listener(self):
+        lines = ["x" * 100] * (INLINE_PAYLOAD_SIZE // 100 + 1)
+        for message in ({"result": []}, {"result": lines}):
+            self.assertFalse(
+                _publish_to_process(self.connection, message, f"test:{uuid4()}")
+            )
+        self.assertEqual(self.stream_entries(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
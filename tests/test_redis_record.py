@@ -0,0 +1,107 @@
+"""
+RedisRecord (lcpvian/utils.py): local copies of the query_info/request entries
+written back to their redis hash field by field
+
+Needs a redis server (REDIS_URL, redis://localhost:6379 by default)
+"""
+
+import os
+import unittest
+
+from uuid import uuid4
+
+from redis import Redis
+
+from lcpvian.utils import RedisRecord
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
+
+
+class RedisRecordTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.connection = Redis.from_url(REDIS_URL)
+        self.key = f"test::record::{uuid4()}"
+
+    def tearDown(self) -> None:
+        self.connection.delete(self.key)
+        self.connection.close()
+
+    def record(self) -> RedisRecord:
+        return RedisRecord(self.connection, self.key)
+
+    def test_set_and_load(self):
+        record = self.record()
+        record.set("status", "started")
+        record.set("done_batches", [["batch1", 10]])
+        self.assertEqual(self.connection.hget(self.key, "status"), b'"started"')
+        fresh = self.record()
+        self.assertEqual(fresh.get("status"), "started")
+        self.assertEqual(fresh.get("done_batches"), [["batch1", 10]])
+        self.assertIsNone(fresh.get("missing"))
+
+    def test_deferred(self):
+        record = self.record()
+        with record.deferred():
+            record.set("status", "started")
+            record.set("total_results_so_far", 12)
+            self.assertFalse(self.connection.exists(self.key))
+        self.assertEqual(
+            self.record().data, {"status": "started", "total_results_so_far": 12}
+        )
+
+    def test_concurrent_writers(self):
+        self.record().set("done_batches", [["batch1", 10]])
+        self.record().set("locations", {"batch1": [0, 10]})
+        first, second = self.record(), self.record()
+        first.data["done_batches"].append(["batch2", 5])
+        first.data["locations"]["batch2"] = [10, 15]
+        first.set("done_batches", first.data["done_batches"])
+        first.set("locations", first.data["locations"])
+        # second was loaded before the writes of first, which must not be lost
+        second.data["done_batches"].append(["batch3", 7])
+        second.data["locations"]["batch3"] = [15, 22]
+        second.set("done_batches", second.data["done_batches"])
+        second.set("locations", second.data["locations"])
+        expected_batches = [["batch1", 10], ["batch2", 5], ["batch3", 7]]
+        expected_locations = {"batch1": [0, 10], "batch2": [10, 15], "batch3": [15, 22]}
+        self.assertEqual(second.get("done_batches"), expected_batches)
+        self.assertEqual(second.get("locations"), expected_locations)
+        fresh = self.record()
+        self.assertEqual(fresh.get("done_batches"), expected_batches)
+        self.assertEqual(fresh.get("locations"), expected_locations)
+
+    def test_remove_and_unset(self):
+        self.record().set("done_batches", [["batch1", 10], ["batch2", 5]])
+        self.record().set("locations", {"batch1": [0, 10], "batch2": [10, 15]})
+        record = self.record()
+        record.set("done_batches", [["batch2", 5]])
+        record.set("locations", {"batch2": [10, 15]})
+        fresh = self.record()
+        self.assertEqual(fresh.get("done_batches"), [["batch2", 5]])
+        self.assertEqual(fresh.get("locations"), {"batch2": [10, 15]})
+
+    def test_values_round_trip(self):
+        """
+        Merged fields keep their empty lists and the precision of their numbers
+        """
+        self.record().set("stats", {"1": {"rows": []}})
+        record = self.record()
+        record.data["stats"]["2"] = {"rows": [], "duration": 1.2345678901234567}
+        record.set("stats", record.data["stats"])
+        expected = {
+            "1": {"rows": []},
+            "2": {"rows": [], "duration": 1.2345678901234567},
+        }
+        self.assertEqual(record.get("stats"), expected)
+        self.assertEqual(self.record().get("stats"), expected)
+
+    def test_delete(self):
+        record = self.record()
+        record.set("status", "started")
+        record.delete()
+        record.set("status", "finished")
+        self.assertFalse(self.connection.exists(self.key))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,183 @@
+"""
+Stats of a query (lcpvian/query_classes.py) aggregated batch after batch
+in redis hashes, and read as a snapshot or as the delta since a version
+
+Needs a redis server (REDIS_URL, redis://localhost:6379 by default)
+"""
+
+import asyncio
+import os
+import unittest
+
+from copy import deepcopy
+from unittest.mock import patch
+from uuid import uuid4
+
+from redis import Redis
+
+from lcpvian import query_classes
+from lcpvian.query_classes import QueryInfo, Request
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
+
+META_JSON = {
+    "result_sets": [
+        {"type": "plain", "name": "kwic"},
+        {
+            "type": "analysis",
+            "name": "freq",
+            "attributes": [
+                {"name": "lemma", "type": "token.lemma"},
+                {"name": "frequency", "type": "aggregate"},
+            ],
+        },
+    ]
+}
+
+# "frequency > 2" on the second result set
+POST_PROCESSES = {
+    2: [{"comparison": {"entity": "frequency", "operator": ">", "value": "2"}}]
+}
+
+CONFIG = {"_batches": {"token1": 100, "tokenrest": 1000}}
+
+
+class StatsTestCase(unittest.TestCase):
+    meta_json: dict = META_JSON
+
+    def setUp(self) -> None:
+        self.connection = Redis.from_url(REDIS_URL)
+        self.qhash = f"test-{uuid4()}"
+        self.qi = QueryInfo(
+            self.qhash,
+            self.connection,
+            meta_json=self.meta_json,
+            post_processes=POST_PROCESSES,
+            config=CONFIG,
+        )
+
+    def tearDown(self) -> None:
+        keys = list(self.connection.scan_iter(f"{self.qhash}*"))
+        keys += [f"query_info::{self.qhash}"]
+        self.connection.delete(*keys)
+        self.connection.close()
+
+    def aggregate(self, name: str, rows: list) -> None:
+        batch_hash = f"{self.qhash}::batch::{name}"
+        n_lines = self.qi.set_batch_results(batch_hash, rows)
+        self.qi.query_batches[name] = (batch_hash, n_lines)
+        batch = [name, 100]
+        asyncio.run(self.qi.run_aggregate(0, batch))
+        self.qi.done_batches.append(batch)
+
+
+class StatsAggregationTestCase(StatsTestCase):
+    def test_aggregate(self):
+        self.aggregate("batch1", [[0, [2]], [1, ["s1", [1]]], [2, ["a", 2]]])
+        self.aggregate(
+            "batch2", [[0, [1]], [1, ["s2", [1]]], [2, ["a", 1]], [2, ["b", 3]]]
+        )
+        self.assertEqual(self.qi.stats_batches, ["batch1", "batch2"])
+        version, rows, removed = self.qi.get_stats()
+        self.assertEqual(version, 2)
+        self.assertIsNone(removed)
+        # post_processes went through JSON, the filter still applies
+        self.assertEqual(rows, {"2": [["a", 3], ["b", 3]]})
+        _, agg_rows, _ = self.qi.get_stats(since=1)
+        self.assertEqual(agg_rows, {"2": [["a", 3], ["b", 3]]})
+
+    def test_aggregate_once(self):
+        rows = [[0, [1]], [1, ["s1", [1]]], [2, ["a", 5]]]
+        self.aggregate("batch1", rows)
+        asyncio.run(self.qi.run_aggregate(0, ["batch1", 100]))
+        self.assertEqual(self.qi.get_stats(), (1, {"2": [["a", 5]]}, None))
+
+    def test_deltas(self):
+        self.aggregate("batch1", [[0, [1]], [1, ["s1", [1]]], [2, ["a", 3]]])
+        self.aggregate("batch2", [[0, [1]], [1, ["s2", [1]]], [2, ["b", 1]]])
+        self.aggregate(
+            "batch3", [[0, [1]], [1, ["s3", [1]]], [2, ["b", 2]], [2, ["c", 1]]]
+        )
+        # batch2 changed no row above the filter, batch3 made "b" pass it
+        self.assertEqual(self.qi.get_stats(since=1), (3, {"2": [["b", 3]]}, {"2": []}))
+        self.assertEqual(self.qi.get_stats(since=3), (3, {"2": []}, {"2": []}))
+        self.connection.delete(self.qi.stats_delta_key(2))
+        # an expired delta gives a full snapshot
+        self.assertEqual(
+            self.qi.get_stats(since=1), (3, {"2": [["a", 3], ["b", 3]]}, None)
+        )
+
+    def test_snapshot(self):
+        """
+        The stats stay readable by the room and user of a request once it is over
+        """
+        request = Request(self.connection, {"room": "room1", "user": "user1"})
+        self.addCleanup(self.connection.delete, f"request::{request.id}")
+        self.qi.add_request(request)
+        self.aggregate("batch1", [[0, [1]], [1, ["s1", [1]]], [2, ["a", 3]]])
+        self.qi.delete_request(request)
+        self.assertFalse(self.connection.exists(f"request::{request.id}"))
+        self.assertTrue(self.qi.can_read_stats("room1", "user1"))
+        self.assertFalse(self.qi.can_read_stats("room1", "user2"))
+        self.assertFalse(self.qi.can_read_stats("room2", "user1"))
+        snapshot = self.qi.stats_snapshot()
+        self.assertEqual(snapshot["stats_version"], 1)
+        self.assertEqual(snapshot["result"], {"2": [["a", 3]]})
+
+
+class StatsTopTestCase(StatsTestCase):
+    """
+    A frequency analysis with a limit only keeps limit * STATS_TOP_CAPACITY rows
+    """
+
+    meta_json = deepcopy(META_JSON)
+    meta_json["result_sets"][1]["limit"] = 2
+
+    def setUp(self) -> None:
+        super().setUp()
+        patcher = patch.object(query_classes, "STATS_TOP_CAPACITY", 2)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_aggregate(self):
+        self.aggregate(
+            "batch1", [[0, [1]], [1, ["s1", [1]]], [2, ["a", 5]], [2, ["b", 4]]]
+        )
+        self.assertEqual(self.qi.get_stats(), (1, {"2": [["a", 5], ["b", 4]]}, None))
+        # batch2 returned its top 2 rows: its other rows counted 1 at most
+        self.aggregate(
+            "batch2", [[0, [1]], [1, ["s2", [1]]], [2, ["c", 6]], [2, ["d", 1]]]
+        )
+        self.assertEqual(
+            self.qi.get_stats(since=1), (2, {"2": [["c", 6], ["a", 5]]}, {"2": [["b"]]})
+        )
+        self.assertEqual(self.qi.get_stats_errors(), {"2": 5})
+        # 6 rows for a capacity of 4: "d" and "f" are evicted
+        self.aggregate(
+            "batch3", [[0, [1]], [1, ["s3", [1]]], [2, ["e", 3]], [2, ["f", 2]]]
+        )
+        self.assertEqual(self.qi.get_stats_errors(), {"2": 9})
+        stored = self.qi._load_aggregation("2", self.meta_json["result_sets"][1])
+        self.assertEqual(
+            sorted(stored.rows()), [["a", 5], ["b", 4], ["c", 6], ["e", 3]]
+        )
+        self.assertEqual(
+            self.qi.get_stats(since=2), (3, {"2": [["c", 6], ["a", 5]]}, {"2": []})
+        )
+
+    def test_filters(self):
+        """
+        The top rows are the most frequent ones that pass the filters
+        """
+        self.aggregate(
+            "batch1", [[0, [1]], [1, ["s1", [1]]], [2, ["a", 2]], [2, ["b", 1]]]
+        )
+        self.assertEqual(self.qi.get_stats(), (1, {"2": []}, None))
+        self.aggregate(
+            "batch2", [[0, [1]], [1, ["s2", [1]]], [2, ["a", 2]], [2, ["c", 3]]]
+        )
+        self.assertEqual(self.qi.get_stats(), (2, {"2": [["a", 4], ["c", 3]]}, None))
+
+
+if __name__ == "__main__":
+    unittest.main()